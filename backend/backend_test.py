@@ -1,5 +1,6 @@
 import unittest
 import requests
+import docx
 import os
 from datetime import datetime
 
@@ -113,8 +114,9 @@ class BookFormatAITester:
         """Test file upload and download"""
         # Create a test DOCX file
         test_file_path = "test_document.docx"
-        with open(test_file_path, "w") as f:
-            f.write("Test content")
+        document = docx.Document()
+        document.add_paragraph("Test content")
+        document.save(test_file_path)
 
         try:
             files = {'file': ('test.docx', open(test_file_path, 'rb'), 'application/vnd.openxmlformats-officedocument.wordprocessingml.document')}
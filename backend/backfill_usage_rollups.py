@@ -0,0 +1,22 @@
+"""
+Rebuild the usage_rollups collection from existing uploads.
+
+Run once after deploying rollups, or whenever they need to be recomputed:
+
+    python backfill_usage_rollups.py
+
+Rollups are replaced one at a time, so analytics keep working while it runs.
+A job that finishes between the rebuild reading uploads and replacing its rollup
+may be counted twice or not at all, so run it when the service is quiet.
+"""
+import asyncio
+
+from server import backfill_usage_rollups, client
+
+async def main():
+    count = await backfill_usage_rollups()
+    print(f"Wrote {count} usage rollup documents")
+    client.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,45 +1,453 @@
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Depends, Header, Request
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, Response
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel, EmailStr
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReplaceOne, ReturnDocument, monitoring
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 import uvicorn
 import os
+import sys
 import logging
+import traceback
+import asyncio
+import time
+import threading
+import contextvars
+import math
+import functools
+import contextlib
+import random
 import uuid
 import io
+import mmap
+import signal
+import multiprocessing
 import tempfile
+import queue
 from pathlib import Path
+from urllib.parse import urlencode
 from typing import List, Optional, Dict, Any
 from datetime import datetime, timedelta
 import docx
 from docx.shared import Inches, Pt
 from docx.enum.text import WD_ALIGN_PARAGRAPH
+from docx.enum.style import WD_STYLE_TYPE
+from docx.text.paragraph import Paragraph as DocxParagraph
+from docx.oxml import parse_xml
+from docx.oxml.ns import qn
+from lxml import etree
 import PyPDF2
+from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject, NullObject, StreamObject
+
+# Resource limits for job workers are only available on Unix
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# pikepdf (qpdf) is only needed to linearize PDFs for fast first-page display; it is in
+# requirements.txt, but servers without qpdf wheels still run and report it as unavailable
+try:
+    import pikepdf
+except ImportError:
+    pikepdf = None
 from reportlab.lib.pagesizes import letter
 from reportlab.lib import colors
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, PageBreak
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.lib.styles import ParagraphStyle
 import shutil
 import json
+import gzip
+import hashlib
+import hmac
+import base64
+import zlib
+import re
+import zipfile
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import pdfplumber
+import numpy as np
+from PIL import Image
 
 # /backend 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Connection pool monitoring (feeds the readiness check)
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    """Tracks Motor connection-pool checkouts and how long they wait"""
+
+    def __init__(self):
+        self.in_use = 0
+        self.waiting = 0
+        self.last_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def snapshot(self):
+        with self._lock:
+            stats = {
+                "in_use": self.in_use,
+                "waiting": self.waiting,
+                "last_checkout_wait_ms": round(self.last_wait_ms, 2),
+                "max_checkout_wait_ms": round(self.max_wait_ms, 2),
+            }
+            # Report the worst wait since the previous snapshot
+            self.max_wait_ms = self.last_wait_ms
+        return stats
+
+    def connection_check_out_started(self, event):
+        # Check-out start and completion happen on the same thread
+        self._local.started = time.perf_counter()
+        with self._lock:
+            self.waiting += 1
+
+    def connection_checked_out(self, event):
+        wait_ms = (time.perf_counter() - getattr(self._local, "started", time.perf_counter())) * 1000
+        with self._lock:
+            self.waiting = max(0, self.waiting - 1)
+            self.in_use += 1
+            self.last_wait_ms = wait_ms
+            self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.waiting = max(0, self.waiting - 1)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.in_use = max(0, self.in_use - 1)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+pool_monitor = PoolMonitor()
+
+# Tracing - spans for one request (and the job worker it starts) share a trace id
+# and are written by the TRACE_EXPORTERS, so a slow upload can be explained
+# after the fact without running a collector. Off unless TRACE_EXPORTERS is set.
+TRACE_EXPORTERS = {name.strip() for name in os.environ.get("TRACE_EXPORTERS", "none").split(",") if name.strip()}
+TRACE_FILE = Path(os.environ.get("TRACE_FILE", Path(tempfile.gettempdir()) / "book_editor_traces.jsonl"))
+TRACE_FILE_MAX_MB = int(os.environ.get("TRACE_FILE_MAX_MB", 100))  # Rotated to TRACE_FILE.1 past this
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 0.1))
+TRACE_SKIP_PATHS = ("/api/health",)  # Probes would drown out real traffic
+TRACEPARENT_RE = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+current_span = contextvars.ContextVar("current_span", default=None)
+
+class Span:
+    def __init__(self, name, trace_id, parent_id, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.status = "ok"
+        self.start_ns = time.time_ns()
+        self._started = time.perf_counter()
+        self.duration_ms = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def record_exception(self, exc):
+        self.status = "error"
+        self.attributes["error.type"] = type(exc).__name__
+        self.attributes["error.message"] = str(exc)
+
+    def end(self):
+        self.duration_ms = (time.perf_counter() - self._started) * 1000
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_unix_nano": self.start_ns,
+            "duration_ms": round(self.duration_ms, 3),
+            "status": self.status,
+            "pid": os.getpid(),
+            "attributes": self.attributes,
+        }
+
+class RemoteSpanContext:
+    """The parent of a trace continued from another process (an HTTP caller or the API worker)"""
+
+    def __init__(self, trace_id, span_id):
+        self.trace_id = trace_id
+        self.span_id = span_id
+
+    def set_attribute(self, key, value):
+        pass
+
+class TraceFileWriter:
+    """
+    Appends spans to the trace file from a background thread, so the event loop
+    never waits on the disk. Job and render worker processes aren't serving
+    requests and append directly.
+    """
+
+    def __init__(self, path, max_bytes, max_pending=10000):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.max_pending = max_pending
+        self.pid = os.getpid()
+        self.pending = queue.SimpleQueue()
+        self.dropped = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        if os.getpid() != self.pid:
+            self._append([record])
+            return
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="trace-writer", daemon=True)
+                    self._thread.start()
+        if self.pending.qsize() >= self.max_pending:
+            self.dropped += 1  # The disk can't keep up; losing spans beats growing without bound
+            return
+        self.pending.put(record)
+
+    def _run(self):
+        while True:
+            records = [self.pending.get()]
+            while len(records) < 1000 and not self.pending.empty():
+                records.append(self.pending.get())
+            self._append(records)
+
+    def _append(self, records):
+        try:
+            if os.getpid() == self.pid and self.path.exists() and self.path.stat().st_size > self.max_bytes:
+                os.replace(self.path, self.path.with_name(self.path.name + ".1"))
+            # One append per batch keeps lines whole when API and worker processes share the file
+            with open(self.path, "a") as f:
+                f.write("".join(json.dumps(record, default=str) + "\n" for record in records))
+        except OSError as e:
+            logger.warning(f"Could not write spans to {self.path}: {str(e)}")
+
+class Tracer:
+    """
+    Minimal span tracer. The active span lives in a contextvar, so spans nest
+    across awaits and into executor threads that copy the caller's context;
+    job workers continue the trace from the context passed to them.
+    """
+
+    def __init__(self, exporters, trace_file, sample_rate=1.0, max_file_bytes=TRACE_FILE_MAX_MB * 1024 * 1024):
+        self.exporters = exporters
+        self.file_writer = TraceFileWriter(trace_file, max_file_bytes)
+        self.sample_rate = sample_rate
+        self.exported = 0
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        """Record a span under the current one; a trace is started if there isn't one (and it's sampled)"""
+        parent = current_span.get()
+        if parent is None:
+            if not self.exporters or random.random() >= self.sample_rate:
+                # Unsampled - the whole request is skipped, and attributes are dropped
+                token = current_span.set(RemoteSpanContext(None, None))
+                try:
+                    yield current_span.get()
+                finally:
+                    current_span.reset(token)
+                return
+            span = Span(name, os.urandom(16).hex(), None, attributes)
+        elif parent.trace_id is None:
+            yield parent
+            return
+        else:
+            span = Span(name, parent.trace_id, parent.span_id, attributes)
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.record_exception(e)
+            raise
+        finally:
+            current_span.reset(token)
+            span.end()
+            self.export(span)
+
+    def traced(self, name):
+        """Decorator recording a span around each call of a sync or async function"""
+        def decorator(func):
+            if asyncio.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    with self.span(name):
+                        return await func(*args, **kwargs)
+                return async_wrapper
+            
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record_span(self, name, duration_ms, **attributes):
+        """Record an already-finished operation (e.g. a Mongo command) under the current span"""
+        parent = current_span.get()
+        if parent is None or parent.trace_id is None:
+            return
+        span = Span(name, parent.trace_id, parent.span_id, attributes)
+        span.duration_ms = duration_ms
+        span.start_ns -= int(duration_ms * 1_000_000)
+        self.export(span)
+
+    def inject(self):
+        """The current trace context in W3C traceparent form, or None outside a sampled trace"""
+        span = current_span.get()
+        if span is None or span.trace_id is None:
+            return None
+        return f"00-{span.trace_id}-{span.span_id}-01"
+
+    def extract(self, traceparent):
+        """Make the trace described by a traceparent the current context (used in new processes and requests)"""
+        match = TRACEPARENT_RE.match(traceparent or "")
+        if not match or match.group(1) == "0" * 32:
+            return None
+        if not int(match.group(3), 16) & 1:
+            return current_span.set(RemoteSpanContext(None, None))
+        return current_span.set(RemoteSpanContext(match.group(1), match.group(2)))
+
+    def export(self, span):
+        self.exported += 1
+        record = span.to_dict()
+        if "console" in self.exporters:
+            logger.info(
+                f"span {record['name']} {record['duration_ms']:.1f}ms trace={record['trace_id']} "
+                f"status={record['status']} {record['attributes']}"
+            )
+        if "file" in self.exporters:
+            self.file_writer.write(record)
+
+tracer = Tracer(TRACE_EXPORTERS - {"none"}, TRACE_FILE, TRACE_SAMPLE_RATE)
+
+def traced_call(traceparent, name, func, *args):
+    """
+    Run `func(*args)` in a pool process as a span of the trace that submitted it.
+    Returns the result and what the pool process's caches gained - see pool_result.
+    """
+    token = tracer.extract(traceparent)
+    since = cache_snapshot()
+    try:
+        with tracer.span(name):
+            return func(*args), cache_report(since)
+    finally:
+        if token is not None:
+            current_span.reset(token)
+
+def pool_result(value):
+    """Unwrap a traced_call result, folding the pool process's cache activity into this one"""
+    result, report = value
+    merge_cache_report(report)
+    return result
+
+# Database commands issued while handling the current request, see instrument_db_commands
+request_db_stats = contextvars.ContextVar("request_db_stats", default=None)
+
+class CommandMonitor(monitoring.CommandListener):
+    """
+    Attributes every Mongo command to the request that issued it. Motor runs
+    commands on executor threads with a copy of the caller's context, so the
+    per-request stats object set by the middleware is visible here.
+    """
+
+    def __init__(self):
+        self.commands = 0
+        self.failures = 0
+        self.total_ms = 0.0
+        self._lock = threading.Lock()
+
+    def _record(self, event, failed=False):
+        duration_ms = event.duration_micros / 1000
+        with self._lock:
+            self.commands += 1
+            self.failures += failed
+            self.total_ms += duration_ms
+        stats = request_db_stats.get()
+        if stats is not None:
+            stats["commands"] += 1
+            stats["ms"] += duration_ms
+            stats["by_command"][event.command_name] = stats["by_command"].get(event.command_name, 0) + 1
+        tracer.record_span(f"mongo {event.command_name}", duration_ms, **{"db.failed": failed})
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "commands": self.commands,
+                "failures": self.failures,
+                "total_ms": round(self.total_ms, 2),
+            }
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        self._record(event, failed=True)
+
+command_monitor = CommandMonitor()
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", 100))
+client = AsyncIOMotorClient(mongo_url, maxPoolSize=MONGO_MAX_POOL_SIZE, event_listeners=[pool_monitor, command_monitor])
 db = client[os.environ.get('DB_NAME', 'book_editor')]
 
 # JWT configuration
 SECRET_KEY = os.environ.get("SECRET_KEY", "your-secret-key-for-jwt")
 ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 1 week
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.environ.get("ACCESS_TOKEN_EXPIRE_MINUTES", 15))
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.environ.get("REFRESH_TOKEN_EXPIRE_DAYS", 30))
+
+# Signed download URLs - checked without a database lookup, so downloads can be
+# served from a static-file tier at DOWNLOAD_BASE_URL
+DOWNLOAD_URL_SECRET = (
+    os.environ.get("DOWNLOAD_URL_SECRET")
+    or hmac.new(SECRET_KEY.encode(), b"download-urls", hashlib.sha256).hexdigest()
+).encode()
+DOWNLOAD_URL_TTL_SECONDS = int(os.environ.get("DOWNLOAD_URL_TTL_SECONDS", 900))
+DOWNLOAD_BASE_URL = os.environ.get("DOWNLOAD_BASE_URL", "").rstrip("/")
+
+# Users allowed to read the analytics endpoints
+ADMIN_EMAILS = {email.strip().lower() for email in os.environ.get("ADMIN_EMAILS", "").split(",") if email.strip()}
 
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -57,6 +465,71 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def instrument_db_commands(request: Request, call_next):
+    """Report each request's Mongo round trips in a Server-Timing header and flag routes over budget"""
+    stats = {"commands": 0, "ms": 0.0, "by_command": {}}
+    token = request_db_stats.set(stats)
+    try:
+        response = await call_next(request)
+    finally:
+        request_db_stats.reset(token)
+    
+    route = request.scope.get("route")
+    path = route.path if route is not None else "unmatched"
+    response.headers.append(
+        "Server-Timing",
+        f'db;dur={stats["ms"]:.2f};desc="{stats["commands"]} commands"'
+    )
+    
+    route_stats = db_route_stats.setdefault(
+        path, {"requests": 0, "commands": 0, "ms": 0.0, "max_commands": 0, "over_budget": 0}
+    )
+    route_stats["requests"] += 1
+    route_stats["commands"] += stats["commands"]
+    route_stats["ms"] += stats["ms"]
+    route_stats["max_commands"] = max(route_stats["max_commands"], stats["commands"])
+    budget = DB_ROUNDTRIP_BUDGETS.get(path, DB_ROUNDTRIP_BUDGET)
+    if stats["commands"] > budget:
+        route_stats["over_budget"] += 1
+        logger.warning(
+            f"{request.method} {path} made {stats['commands']} Mongo round trips "
+            f"(budget {budget}): {stats['by_command']}"
+        )
+    span = current_span.get()
+    if span is not None:
+        span.set_attribute("db.commands", stats["commands"])
+        span.set_attribute("db.ms", round(stats["ms"], 2))
+    return response
+
+db_route_stats = {}
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """Record a root span per request, continuing the caller's trace if it sent a traceparent header"""
+    if request.url.path.startswith(TRACE_SKIP_PATHS):
+        # Unsampled context, so the probe's own spans (e.g. Mongo pings) are skipped too
+        token = current_span.set(RemoteSpanContext(None, None))
+        try:
+            return await call_next(request)
+        finally:
+            current_span.reset(token)
+    token = tracer.extract(request.headers.get("traceparent"))
+    try:
+        with tracer.span(f"{request.method} {request.url.path}", **{"http.method": request.method}) as span:
+            response = await call_next(request)
+            route = request.scope.get("route")
+            if route is not None:
+                span.name = f"{request.method} {route.path}"
+                span.set_attribute("http.route", route.path)
+            span.set_attribute("http.status_code", response.status_code)
+        if span.trace_id is not None:
+            response.headers["X-Trace-Id"] = span.trace_id
+        return response
+    finally:
+        if token is not None:
+            current_span.reset(token)
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -68,6 +541,123 @@ logger = logging.getLogger(__name__)
 TEMP_DIR = Path(tempfile.gettempdir()) / "book_editor"
 TEMP_DIR.mkdir(exist_ok=True)
 
+# Readiness thresholds - past any of these the worker reports itself unready
+HEALTH_MAX_MONGO_PING_MS = float(os.environ.get("HEALTH_MAX_MONGO_PING_MS", 250))
+HEALTH_MAX_POOL_UTILIZATION = float(os.environ.get("HEALTH_MAX_POOL_UTILIZATION", 0.9))
+HEALTH_MAX_POOL_WAIT_MS = float(os.environ.get("HEALTH_MAX_POOL_WAIT_MS", 500))
+HEALTH_MAX_QUEUE_DEPTH = int(os.environ.get("HEALTH_MAX_QUEUE_DEPTH", 20))
+HEALTH_MIN_FREE_DISK_MB = float(os.environ.get("HEALTH_MIN_FREE_DISK_MB", 500))
+HEALTH_MAX_LOOP_LAG_MS = float(os.environ.get("HEALTH_MAX_LOOP_LAG_MS", 250))
+
+# A callback holding the event loop longer than this is logged with its stack and route
+LOOP_BLOCK_THRESHOLD_MS = float(os.environ.get("LOOP_BLOCK_THRESHOLD_MS", 100))
+LOOP_WATCHDOG_INTERVAL_SECONDS = LOOP_BLOCK_THRESHOLD_MS / 4000
+LOOP_BLOCK_STACK_DEPTH = 12
+
+# Mongo round trips a request may make before it's logged as over budget.
+# DB_ROUNDTRIP_BUDGETS takes a JSON object of route path -> budget to override these.
+DB_ROUNDTRIP_BUDGET = int(os.environ.get("DB_ROUNDTRIP_BUDGET", 4))
+DB_ROUNDTRIP_BUDGETS = {
+    "/api/upload": 7,
+    "/api/uploads/{session_id}/finalize": 11,
+    "/api/reformat/{file_id}": 6,
+    "/api/token/refresh": 5,
+    "/api/files/{file_id}": 6,
+    "/api/download/{file_id}": 0,
+    **json.loads(os.environ.get("DB_ROUNDTRIP_BUDGETS", "{}"))
+}
+
+# Admission control - formatting jobs run concurrently on this worker, and
+# new uploads are shed once the expected queue wait passes the deadline
+MAX_CONCURRENT_FORMATTING_JOBS = int(os.environ.get("MAX_CONCURRENT_FORMATTING_JOBS", os.cpu_count() or 2))
+MAX_QUEUE_WAIT_SECONDS = float(os.environ.get("MAX_QUEUE_WAIT_SECONDS", 30))
+# A queued job moves up one priority class for every JOB_AGING_SECONDS it waits
+JOB_AGING_SECONDS = float(os.environ.get("JOB_AGING_SECONDS", 20))
+
+# Each formatting job runs in its own worker process under these limits
+JOB_WALL_TIMEOUT_SECONDS = float(os.environ.get("JOB_WALL_TIMEOUT_SECONDS", 180))
+# JOB_CPU_SECONDS bounds the whole job: the worker and the render pool processes it forks
+# share one process group, whose CPU time the parent samples every JOB_CPU_POLL_SECONDS
+JOB_CPU_SECONDS = int(os.environ.get("JOB_CPU_SECONDS", 120))
+JOB_CPU_POLL_SECONDS = 0.5
+JOB_MEMORY_MB = int(os.environ.get("JOB_MEMORY_MB", 1024))  # On top of what the worker inherits
+
+# Parsed manuscripts are cached (in memory and gzipped on disk) so re-renders skip parsing
+PARSE_CACHE_DIR = TEMP_DIR / "parsed"
+PARSE_CACHE_DIR.mkdir(exist_ok=True)
+PARSE_CACHE_SIZE = int(os.environ.get("PARSE_CACHE_SIZE", 32))
+
+# Uploaded manuscripts are stored once per content hash and reference counted;
+# blobs untouched for BLOB_COLD_AFTER_SECONDS are gzipped in place
+BLOBS_DIR = TEMP_DIR / "blobs"
+BLOBS_DIR.mkdir(exist_ok=True)
+BLOB_COLD_AFTER_SECONDS = float(os.environ.get("BLOB_COLD_AFTER_SECONDS", 24 * 3600))
+BLOB_SWEEP_INTERVAL_SECONDS = float(os.environ.get("BLOB_SWEEP_INTERVAL_SECONDS", 3600))
+
+# DOCX packages are checked from their zip directory before anything is decompressed
+DOCX_MAX_UNCOMPRESSED_MB = int(os.environ.get("DOCX_MAX_UNCOMPRESSED_MB", 250))
+DOCX_MAX_COMPRESSION_RATIO = int(os.environ.get("DOCX_MAX_COMPRESSION_RATIO", 100))
+DOCX_MAX_MEMBERS = int(os.environ.get("DOCX_MAX_MEMBERS", 5000))
+DOCX_MAX_XML_PART_MB = int(os.environ.get("DOCX_MAX_XML_PART_MB", 64))
+DOCX_REQUIRED_PARTS = ("[Content_Types].xml", "word/document.xml")
+
+# Embedded DOCX images are resampled to this resolution at their printed size
+PRINT_IMAGE_DPI = int(os.environ.get("PRINT_IMAGE_DPI", 300))
+JPEG_QUALITY = int(os.environ.get("JPEG_QUALITY", 85))
+MIN_OPTIMIZED_IMAGE_BYTES = 32 * 1024
+
+# Resumable uploads - large manuscripts arrive as chunks written straight to disk at their offsets
+UPLOAD_SESSIONS_DIR = TEMP_DIR / "sessions"
+UPLOAD_SESSIONS_DIR.mkdir(exist_ok=True)
+MAX_RESUMABLE_UPLOAD_MB = int(os.environ.get("MAX_RESUMABLE_UPLOAD_MB", 200))
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024  # Suggested to clients
+MAX_UPLOAD_CHUNK_BYTES = 16 * 1024 * 1024
+UPLOAD_SESSION_TTL_HOURS = int(os.environ.get("UPLOAD_SESSION_TTL_HOURS", 24))
+UPLOAD_SESSION_SWEEP_INTERVAL_SECONDS = float(os.environ.get("UPLOAD_SESSION_SWEEP_INTERVAL_SECONDS", 600))
+UPLOAD_SESSION_PURGE_BATCH = 500  # Expired sessions removed per sweep
+
+# Long books are rendered one chapter per worker process and merged in order
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", os.cpu_count() or 1))
+# Up to MAX_CONCURRENT_FORMATTING_JOBS jobs run at once, each with its own pool - keep them small
+RENDER_WORKERS_PER_JOB = int(os.environ.get("RENDER_WORKERS_PER_JOB", 2))
+PARALLEL_RENDER_MIN_PARAGRAPHS = int(os.environ.get("PARALLEL_RENDER_MIN_PARAGRAPHS", 400))
+
+# Rendered chunks kept for incremental re-rendering of revised manuscripts
+CHUNKS_DIR = TEMP_DIR / "chunks"
+CHUNKS_DIR.mkdir(exist_ok=True)
+CHUNK_TTL_DAYS = int(os.environ.get("CHUNK_TTL_DAYS", 14))
+DOCX_BLOCK_PARAGRAPHS = 16  # Average block size; boundaries are content-defined
+
+# PDF text extraction is split into page ranges across the same workers for long PDFs;
+# pages slower than SLOW_PDF_PAGE_MS are logged
+PARALLEL_EXTRACT_MIN_PAGES = int(os.environ.get("PARALLEL_EXTRACT_MIN_PAGES", 32))
+EXTRACT_RANGES_PER_WORKER = 4
+SLOW_PDF_PAGE_MS = float(os.environ.get("SLOW_PDF_PAGE_MS", 2000))
+
+# PDF export profiles
+EXPORT_PROFILES = {
+    "standard": {"optimize": False, "linearize": False},
+    # Compressed streams and a single copy of each identical font/image
+    "optimized": {"optimize": True, "linearize": False},
+    # Optimized and linearized so viewers can show page one before the download finishes
+    "web": {"optimize": True, "linearize": True},
+}
+
+# Output formats - "print" keeps the upload's own format (DOCX or PDF), "epub" is a reflowable ebook
+OUTPUT_FORMATS = ["print", "epub"]
+
+# First-pages previews - free of quota, cached per parameter set
+PREVIEW_MAX_PAGES = 10
+PREVIEW_CACHE_SIZE = int(os.environ.get("PREVIEW_CACHE_SIZE", 64))
+PREVIEW_LATENCY_BUDGET_MS = float(os.environ.get("PREVIEW_LATENCY_BUDGET_MS", 500))
+# Previews render in their own long-lived worker processes, apart from the formatting job queue
+PREVIEW_WORKERS = int(os.environ.get("PREVIEW_WORKERS", 2))
+PREVIEW_MAX_WAITING = int(os.environ.get("PREVIEW_MAX_WAITING", 16))
+PREVIEW_TIMEOUT_SECONDS = float(os.environ.get("PREVIEW_TIMEOUT_SECONDS", 10))
+
+# Most recent event-loop lag measurement (milliseconds)
+event_loop_lag_ms = 0.0
+
 # Book sizes in inches (width, height)
 BOOK_SIZES = {
     "5x8": (5, 8),
@@ -79,6 +669,62 @@ BOOK_SIZES = {
 # Font options
 FONT_OPTIONS = ["Times New Roman", "Arial", "Georgia", "Garamond", "Baskerville", "Caslon"]
 
+# TrueType files tried for each font, by variant (first match wins). Open-licensed
+# metric-compatible families are listed after the commercial originals.
+FONT_FILES = {
+    "Times New Roman": {
+        "regular": ["times.ttf", "Times New Roman.ttf", "LiberationSerif-Regular.ttf"],
+        "bold": ["timesbd.ttf", "Times New Roman Bold.ttf", "LiberationSerif-Bold.ttf"],
+        "italic": ["timesi.ttf", "Times New Roman Italic.ttf", "LiberationSerif-Italic.ttf"],
+        "bold_italic": ["timesbi.ttf", "Times New Roman Bold Italic.ttf", "LiberationSerif-BoldItalic.ttf"],
+    },
+    "Arial": {
+        "regular": ["arial.ttf", "Arial.ttf", "LiberationSans-Regular.ttf"],
+        "bold": ["arialbd.ttf", "Arial Bold.ttf", "LiberationSans-Bold.ttf"],
+        "italic": ["ariali.ttf", "Arial Italic.ttf", "LiberationSans-Italic.ttf"],
+        "bold_italic": ["arialbi.ttf", "Arial Bold Italic.ttf", "LiberationSans-BoldItalic.ttf"],
+    },
+    "Georgia": {
+        "regular": ["georgia.ttf", "Georgia.ttf", "Gelasio-Regular.ttf"],
+        "bold": ["georgiab.ttf", "Georgia Bold.ttf", "Gelasio-Bold.ttf"],
+        "italic": ["georgiai.ttf", "Georgia Italic.ttf", "Gelasio-Italic.ttf"],
+        "bold_italic": ["georgiaz.ttf", "Georgia Bold Italic.ttf", "Gelasio-BoldItalic.ttf"],
+    },
+    "Garamond": {
+        "regular": ["GARA.TTF", "Garamond.ttf", "EBGaramond-Regular.ttf"],
+        "bold": ["GARABD.TTF", "Garamond Bold.ttf", "EBGaramond-Bold.ttf"],
+        "italic": ["GARAIT.TTF", "Garamond Italic.ttf", "EBGaramond-Italic.ttf"],
+        "bold_italic": ["Garamond Bold Italic.ttf", "EBGaramond-BoldItalic.ttf"],
+    },
+    "Baskerville": {
+        "regular": ["BASKVILL.TTF", "Baskerville.ttf", "LibreBaskerville-Regular.ttf"],
+        "bold": ["Baskerville Bold.ttf", "LibreBaskerville-Bold.ttf"],
+        "italic": ["Baskerville Italic.ttf", "LibreBaskerville-Italic.ttf"],
+        "bold_italic": ["Baskerville Bold Italic.ttf"],
+    },
+    "Caslon": {
+        "regular": ["Caslon.ttf", "LibreCaslonText-Regular.ttf"],
+        "bold": ["Caslon Bold.ttf", "LibreCaslonText-Bold.ttf"],
+        "italic": ["Caslon Italic.ttf", "LibreCaslonText-Italic.ttf"],
+        "bold_italic": ["Caslon Bold Italic.ttf"],
+    },
+}
+
+# Built-in PDF fonts used when no TrueType file is installed
+FALLBACK_FONTS = {
+    "sans": ("Helvetica", "Helvetica-Bold", "Helvetica-Oblique", "Helvetica-BoldOblique"),
+    "serif": ("Times-Roman", "Times-Bold", "Times-Italic", "Times-BoldItalic"),
+}
+FONTS_DIR = Path(os.environ.get("FONTS_DIR", ROOT_DIR / "fonts"))
+FONT_SEARCH_DIRS = [
+    FONTS_DIR,
+    Path("/usr/share/fonts"),
+    Path("/usr/local/share/fonts"),
+    Path.home() / ".fonts",
+    Path("/Library/Fonts"),
+    Path("C:/Windows/Fonts"),
+]
+
 # Genre options with formatting specifications
 GENRE_OPTIONS = {
     "literary_fiction": {
@@ -149,19 +795,37 @@ SUBSCRIPTION_TIERS = {
         "name": "Free",
         "monthly_limit": 2,
         "price": 0,
-        "allowed_genres": ["non_fiction", "poetry", "romance"]
+        "allowed_genres": ["non_fiction", "poetry", "romance"],
+        "uploads_per_minute": 2,
+        "upload_burst": 2,
+        "max_concurrent_jobs": 1,
+        "tier_uploads_per_minute": 60,
+        "priority": 2,  # Scheduling class - lower runs first
+        "target_queue_wait_seconds": 60
     },
     "creator": {
         "name": "Creator",
         "monthly_limit": 10,
         "price": 5,
-        "allowed_genres": list(GENRE_OPTIONS.keys())
+        "allowed_genres": list(GENRE_OPTIONS.keys()),
+        "uploads_per_minute": 6,
+        "upload_burst": 5,
+        "max_concurrent_jobs": 2,
+        "tier_uploads_per_minute": 120,
+        "priority": 1,
+        "target_queue_wait_seconds": 20
     },
     "business": {
         "name": "Business",
         "monthly_limit": 50,
         "price": 25,
-        "allowed_genres": list(GENRE_OPTIONS.keys())
+        "allowed_genres": list(GENRE_OPTIONS.keys()),
+        "uploads_per_minute": 20,
+        "upload_burst": 10,
+        "max_concurrent_jobs": 4,
+        "tier_uploads_per_minute": 300,
+        "priority": 0,
+        "target_queue_wait_seconds": 5
     }
 }
 
@@ -170,9 +834,16 @@ class Token(BaseModel):
     access_token: str
     token_type: str
     user_tier: str
+    refresh_token: Optional[str] = None
 
 class TokenData(BaseModel):
     email: Optional[str] = None
+    tier: str = "free"
+    is_active: bool = True
+    is_admin: bool = False
+
+class RefreshTokenRequest(BaseModel):
+    refresh_token: str
 
 class User(BaseModel):
     email: EmailStr
@@ -231,7 +902,43 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme)):
+async def create_refresh_token(email: str, family: Optional[str] = None):
+    """Issue a single-use refresh token; rotated tokens share the family of the original login"""
+    jti = str(uuid.uuid4())
+    expires_at = datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+    await db.refresh_tokens.insert_one({
+        "jti": jti,
+        "family": family or jti,
+        "email": email,
+        "used": False,
+        "expires_at": expires_at
+    })
+    return create_access_token(
+        data={"sub": email, "type": "refresh", "jti": jti},
+        expires_delta=timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+    )
+
+async def issue_tokens(user: User, family: Optional[str] = None):
+    """Create an access token carrying the user's tier and status plus a refresh token"""
+    access_token = create_access_token(
+        data={
+            "sub": user.email,
+            "type": "access",
+            "tier": user.tier,
+            "active": user.is_active,
+            "admin": user.email.lower() in ADMIN_EMAILS
+        },
+        expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    )
+    refresh_token = await create_refresh_token(user.email, family)
+    return {
+        "access_token": access_token,
+        "token_type": "bearer",
+        "user_tier": user.tier,
+        "refresh_token": refresh_token
+    }
+
+def decode_access_token(token: str):
     credentials_exception = HTTPException(
         status_code=401,
         detail="Could not validate credentials",
@@ -239,15 +946,45 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
     )
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            raise credentials_exception
-        token_data = TokenData(email=email)
     except JWTError:
         raise credentials_exception
+    email: str = payload.get("sub")
+    if email is None or payload.get("type") != "access":
+        raise credentials_exception
+    return TokenData(
+        email=email,
+        tier=payload.get("tier", "free"),
+        is_active=payload.get("active", True),
+        is_admin=payload.get("admin", False)
+    )
+
+@tracer.traced("get_current_claims")
+async def get_current_claims(token: str = Depends(oauth2_scheme)):
+    """Authorize from the access token claims alone, without a database lookup"""
+    return decode_access_token(token)
+
+async def get_current_active_claims(claims: TokenData = Depends(get_current_claims)):
+    if not claims.is_active:
+        raise HTTPException(status_code=400, detail="Inactive user")
+    if claims.tier not in SUBSCRIPTION_TIERS:
+        raise HTTPException(status_code=401, detail="Could not validate credentials")
+    return claims
+
+async def get_current_admin_claims(claims: TokenData = Depends(get_current_active_claims)):
+    if not claims.is_admin:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return claims
+
+@tracer.traced("get_current_user")
+async def get_current_user(token: str = Depends(oauth2_scheme)):
+    token_data = decode_access_token(token)
     user = await get_user(email=token_data.email)
     if user is None:
-        raise credentials_exception
+        raise HTTPException(
+            status_code=401,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
     return user
 
 async def get_current_active_user(current_user: User = Depends(get_current_user)):
@@ -260,6 +997,7 @@ async def get_usage_for_month(user: User, month: str = None):
         month = datetime.now().strftime("%Y-%m")
     return user.usage_count.get(month, 0)
 
+@tracer.traced("check_usage_limit")
 async def check_usage_limit(user: User):
     current_month = datetime.now().strftime("%Y-%m")
     current_usage = await get_usage_for_month(user, current_month)
@@ -271,6 +1009,7 @@ async def check_usage_limit(user: User):
             detail=f"Monthly usage limit reached for {SUBSCRIPTION_TIERS[user.tier]['name']} tier. Please upgrade your subscription."
         )
 
+@tracer.traced("increment_usage")
 async def increment_usage(user: User):
     current_month = datetime.now().strftime("%Y-%m")
     usage_count = user.usage_count.copy()
@@ -283,6 +1022,7 @@ async def increment_usage(user: User):
         {"$set": {"usage_count": usage_count}}
     )
 
+@tracer.traced("check_genre_allowed")
 async def check_genre_allowed(user: User, genre: str):
     allowed_genres = SUBSCRIPTION_TIERS[user.tier]["allowed_genres"]
     if genre not in allowed_genres:
@@ -292,6 +1032,541 @@ async def check_genre_allowed(user: User, genre: str):
             detail=f"Genre '{GENRE_OPTIONS[genre]['name']}' is not available on your {SUBSCRIPTION_TIERS[user.tier]['name']} plan. Please upgrade to {SUBSCRIPTION_TIERS[upgrade_to]['name']} tier."
         )
 
+# Font registry
+class FontRegistry:
+    """
+    Registers every FONT_OPTIONS typeface with ReportLab once per process.
+    Parsing a TrueType file and subsetting it are the expensive parts of PDF
+    font setup, so faces (and their glyph-width tables) are shared by all jobs
+    and generated subsets are cached per face.
+    """
+
+    VARIANTS = ("regular", "bold", "italic", "bold_italic")
+    SUBSET_CACHE_SIZE = 256
+
+    def __init__(self, search_dirs):
+        self.search_dirs = search_dirs
+        self.families = {}
+        self.embedded = []
+        self.fallbacks = []
+        self.load_ms = 0.0
+        self.subset_stats = {"hits": 0, "misses": 0}
+        self._subsets = {}  # Registered face name -> OrderedDict of glyph subset -> font program
+        self._lock = threading.Lock()
+
+    def _index_font_files(self):
+        files = {}
+        for directory in self.search_dirs:
+            if not directory.is_dir():
+                continue
+            for path in directory.rglob("*"):
+                if path.suffix.lower() == ".ttf":
+                    files.setdefault(path.name.lower(), path)
+        return files
+
+    def _cache_subsets(self, name, face):
+        make_subset = face.makeSubset
+        subsets = self._subsets[name] = OrderedDict()
+
+        def cached_make_subset(subset):
+            key = tuple(subset)
+            data = subsets.get(key)
+            if data is None:
+                self.subset_stats["misses"] += 1
+                data = subsets[key] = make_subset(subset)
+                if len(subsets) > self.SUBSET_CACHE_SIZE:
+                    subsets.popitem(last=False)
+            else:
+                self.subset_stats["hits"] += 1
+                subsets.move_to_end(key)
+            return data
+
+        face.makeSubset = cached_make_subset
+
+    def load(self):
+        """Register all fonts; safe to call repeatedly (e.g. as a worker-process initializer)"""
+        with self._lock:
+            if self.families:
+                return
+            started = time.perf_counter()
+            files = self._index_font_files()
+            for font, variants in FONT_FILES.items():
+                paths = {}
+                for variant in self.VARIANTS:
+                    path = next((files[name.lower()] for name in variants[variant] if name.lower() in files), None)
+                    if path is not None:
+                        paths[variant] = path
+                if "regular" not in paths:
+                    self.families[font] = FALLBACK_FONTS["sans" if font == "Arial" else "serif"]
+                    self.fallbacks.append(font)
+                    continue
+
+                names = []
+                for variant in self.VARIANTS:
+                    # Missing styles reuse the regular face so <b>/<i> markup still resolves
+                    name = font if variant == "regular" else f"{font}-{variant}"
+                    if variant in paths:
+                        try:
+                            ttfont = TTFont(name, str(paths[variant]))
+                        except Exception as e:
+                            logger.warning(f"Could not load {paths[variant]}: {str(e)}")
+                            name = font
+                        else:
+                            self._cache_subsets(name, ttfont.face)
+                            pdfmetrics.registerFont(ttfont)
+                    else:
+                        name = font
+                    names.append(name)
+                pdfmetrics.registerFontFamily(font, normal=names[0], bold=names[1], italic=names[2], boldItalic=names[3])
+                self.families[font] = tuple(names)
+                self.embedded.append(font)
+            self.load_ms = (time.perf_counter() - started) * 1000
+            if self.fallbacks:
+                logger.warning(f"No TrueType files found for {', '.join(self.fallbacks)}; using built-in PDF fonts")
+
+    def subset_keys(self):
+        return {(name, key) for name, subsets in self._subsets.items() for key in subsets}
+
+    def subset_entries(self, known_keys):
+        """Cached subsets not in `known_keys`, as (face name, glyph subset) -> font program"""
+        return {(name, key): self._subsets[name][key] for name, key in self.subset_keys() - known_keys}
+
+    def adopt_subsets(self, entries):
+        """Add subsets generated by another process, so processes forked later start with them"""
+        for (name, key), data in entries.items():
+            subsets = self._subsets.get(name)
+            if subsets is None or key in subsets:
+                continue
+            subsets[key] = data
+            if len(subsets) > self.SUBSET_CACHE_SIZE:
+                subsets.popitem(last=False)
+
+    def resolve(self, font):
+        """ReportLab names for (regular, bold, italic, bold italic) of a FONT_OPTIONS font"""
+        if not self.families:
+            self.load()
+        return self.families.get(font, FALLBACK_FONTS["serif"])
+
+    def stats(self):
+        return {
+            "embedded": self.embedded,
+            "fallback": self.fallbacks,
+            "load_ms": round(self.load_ms, 1),
+            "subset_cache": dict(self.subset_stats)
+        }
+
+font_registry = FontRegistry(FONT_SEARCH_DIRS)
+
+# Formatting profiles
+class FormattingProfile:
+    """Everything a renderer needs for one (genre, font, book_size, template), computed once"""
+
+    def __init__(self, genre, font, book_size, template):
+        genre_options = GENRE_OPTIONS[genre]
+        width, height = BOOK_SIZES[book_size]
+        margins = template["margins"]
+        self.font = font
+        self.font_size = genre_options["font_size"]
+        self.line_spacing = genre_options["line_spacing"]
+        self.page_numbers = template["page_numbers"]
+        self.page_size = (width * 72, height * 72)
+        self.page_width, self.page_height = width, height
+        self.margins = margins
+        # SimpleDocTemplate takes points; single-sided output puts the inside margin on the left
+        self.pdf_margins = {
+            "leftMargin": margins["inside"] * 72,
+            "rightMargin": margins["outside"] * 72,
+            "topMargin": margins["top"] * 72,
+            "bottomMargin": margins["bottom"] * 72,
+        }
+        self.first_line_indent = template["first_line_indent"]
+        self.paragraph_spacing = template["paragraph_spacing"]
+        self.justify = template["justify"]
+        self.heading_alignment = template["heading_alignment"]
+        
+        regular_font, bold_font = font_registry.resolve(font)[:2]
+        heading_size = self.font_size + template["heading_size_delta"]
+        self.pdf_normal_style = ParagraphStyle(
+            name='ManuscriptNormal',
+            fontName=regular_font,
+            fontSize=self.font_size,
+            leading=self.font_size * self.line_spacing,
+            firstLineIndent=self.first_line_indent,
+            spaceAfter=self.paragraph_spacing,
+            alignment=4 if self.justify else 0,  # TA_JUSTIFY / TA_LEFT
+        )
+        self.pdf_heading_style = ParagraphStyle(
+            name='ManuscriptHeading',
+            fontName=bold_font,
+            fontSize=heading_size,
+            leading=heading_size * 1.2,
+            alignment=1 if self.heading_alignment == "center" else 0,
+            spaceBefore=12,
+            spaceAfter=12
+        )
+        
+        self.docx_font_size = Pt(self.font_size)
+        self.docx_first_line_indent = Pt(self.first_line_indent)
+        self.docx_paragraph_spacing = Pt(self.paragraph_spacing)
+        self.docx_body_alignment = WD_ALIGN_PARAGRAPH.JUSTIFY if self.justify else None
+        self.docx_heading_alignment = (
+            WD_ALIGN_PARAGRAPH.CENTER if self.heading_alignment == "center" else WD_ALIGN_PARAGRAPH.LEFT
+        )
+
+class FormattingProfileRegistry:
+    """
+    Compiles formatting profiles on first use and keeps the most recent ones.
+    Template definitions are read from a JSON file and reloaded when it changes;
+    a file that fails validation is logged and the previous definitions stay in use.
+    """
+
+    TEMPLATE_FIELDS = {
+        "name": str,
+        "margins": dict,
+        "first_line_indent": (int, float),
+        "paragraph_spacing": (int, float),
+        "justify": bool,
+        "heading_size_delta": (int, float),
+        "heading_alignment": str,
+        "page_numbers": bool,
+    }
+    MARGIN_SIDES = ("top", "bottom", "inside", "outside")
+
+    def __init__(self, templates_file, cache_size=64, reload_interval=2.0):
+        self.templates_file = Path(templates_file)
+        self.cache_size = cache_size
+        self.reload_interval = reload_interval
+        self.templates = {}
+        self.version = 0
+        self._mtime = None
+        self._checked_at = 0.0
+        self._profiles = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def validate_templates(cls, templates):
+        if not isinstance(templates, dict) or not templates:
+            raise ValueError("Template file must be a non-empty object")
+        for name, template in templates.items():
+            for field, kind in cls.TEMPLATE_FIELDS.items():
+                if not isinstance(template.get(field), kind):
+                    raise ValueError(f"Template '{name}': '{field}' is missing or has the wrong type")
+            for side in cls.MARGIN_SIDES:
+                margin = template["margins"].get(side)
+                if not isinstance(margin, (int, float)) or not 0.25 <= margin <= 2:
+                    raise ValueError(f"Template '{name}': {side} margin must be between 0.25 and 2 inches")
+            if template["heading_alignment"] not in ("center", "left"):
+                raise ValueError(f"Template '{name}': heading_alignment must be 'center' or 'left'")
+            if not 0 <= template["first_line_indent"] <= 72 or not 0 <= template["paragraph_spacing"] <= 36:
+                raise ValueError(f"Template '{name}': indent or paragraph spacing out of range")
+
+    def reload_if_changed(self):
+        now = time.monotonic()
+        if self.templates and now - self._checked_at < self.reload_interval:
+            return
+        self._checked_at = now
+        try:
+            mtime = self.templates_file.stat().st_mtime_ns
+            if mtime == self._mtime:
+                return
+            with open(self.templates_file) as f:
+                templates = json.load(f)
+            self.validate_templates(templates)
+        except (OSError, ValueError) as e:
+            if not self.templates:
+                raise
+            logger.error(f"Keeping previous formatting templates, could not load {self.templates_file}: {str(e)}")
+            return
+        with self._lock:
+            self.templates = templates
+            self._mtime = mtime
+            self._profiles.clear()
+            self.version += 1
+        logger.info(f"Loaded {len(templates)} formatting templates (version {self.version})")
+
+    def get(self, genre, font, book_size, template="standard"):
+        self.reload_if_changed()
+        key = (genre, font, book_size, template)
+        with self._lock:
+            profile = self._profiles.get(key)
+            if profile is not None:
+                self._profiles.move_to_end(key)
+                self.hits += 1
+                return profile
+        if template not in self.templates:
+            raise ValueError(f"Unknown template '{template}'")
+        profile = FormattingProfile(genre, font, book_size, self.templates[template])
+        with self._lock:
+            self.misses += 1
+            self._profiles[key] = profile
+            while len(self._profiles) > self.cache_size:
+                self._profiles.popitem(last=False)
+        return profile
+
+    def compiled_keys(self):
+        with self._lock:
+            return set(self._profiles)
+
+    def adopt(self, keys):
+        """Compile profiles another process used, so processes forked later start with them"""
+        if keys:
+            self.reload_if_changed()
+        for key in keys:
+            genre, font, book_size, template = key
+            with self._lock:
+                if key in self._profiles or template not in self.templates:
+                    continue
+            profile = FormattingProfile(genre, font, book_size, self.templates[template])
+            with self._lock:
+                self._profiles[key] = profile
+                while len(self._profiles) > self.cache_size:
+                    self._profiles.popitem(last=False)
+
+    def stats(self):
+        return {
+            "templates": list(self.templates),
+            "version": self.version,
+            "compiled": len(self._profiles),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+formatting_profiles = FormattingProfileRegistry(
+    os.environ.get("FORMAT_TEMPLATES_FILE", ROOT_DIR / "format_templates.json"),
+    cache_size=int(os.environ.get("FORMAT_PROFILE_CACHE_SIZE", 64))
+)
+
+# Admission control and rate limiting
+class TokenBucket:
+    """Classic token bucket - refills at `rate` tokens per second up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def try_acquire(self):
+        """Take one token; returns the seconds to wait when the bucket is empty, else 0"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+def rate_limited(detail: str, retry_after: float):
+    return HTTPException(
+        status_code=429,
+        detail=detail,
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+    )
+
+class JobDeadlineExceeded(Exception):
+    pass
+
+class FairShareScheduler:
+    """
+    Hands out job slots by tier priority, then fairly between users of the same tier.
+    Within a priority class each user's jobs get start-time fair queuing tags, so a
+    user with many queued jobs is interleaved with everyone else instead of going
+    first. Waiting jobs age into higher classes so free jobs keep moving under load.
+    """
+
+    WAIT_SAMPLES = 1000
+
+    def __init__(self, slots: int, aging_seconds: float):
+        self.slots = slots
+        self.aging_seconds = aging_seconds
+        self.busy = 0
+        self.waiting = []
+        self.virtual_time = {}
+        self.user_tags = {}
+        self.queue_waits = {tier: deque(maxlen=self.WAIT_SAMPLES) for tier in SUBSCRIPTION_TIERS}
+        self._sequence = 0
+
+    def jobs_ahead(self, tier: str):
+        """Waiting jobs that would be dispatched before a new job in `tier`"""
+        priority = SUBSCRIPTION_TIERS[tier]["priority"]
+        return sum(1 for entry in self.waiting if entry["priority"] <= priority)
+
+    async def acquire(self, user):
+        tier = SUBSCRIPTION_TIERS[user.tier]
+        priority = tier["priority"]
+        tag = max(self.virtual_time.get(priority, 0.0), self.user_tags.get(user.email, 0.0)) + 1
+        self.user_tags[user.email] = tag
+        self._sequence += 1
+        entry = {
+            "priority": priority,
+            "tag": tag,
+            "sequence": self._sequence,
+            "tier": user.tier,
+            "email": user.email,
+            "enqueued": time.monotonic(),
+            "future": asyncio.get_running_loop().create_future()
+        }
+        self.waiting.append(entry)
+        self._dispatch()
+        try:
+            await entry["future"]
+        except asyncio.CancelledError:
+            if entry in self.waiting:
+                self.waiting.remove(entry)
+            elif entry["future"].done() and not entry["future"].cancelled():
+                self.release()  # Granted just as we were cancelled
+            raise
+        finally:
+            self._forget_user(user.email)
+
+    def release(self):
+        self.busy -= 1
+        self._dispatch()
+
+    def _forget_user(self, email):
+        if not any(entry["email"] == email for entry in self.waiting):
+            self.user_tags.pop(email, None)
+
+    def _dispatch(self):
+        now = time.monotonic()
+        while self.busy < self.slots and self.waiting:
+            entry = min(self.waiting, key=lambda e: (
+                e["priority"] - (now - e["enqueued"]) // self.aging_seconds,
+                e["tag"],
+                e["sequence"]
+            ))
+            self.waiting.remove(entry)
+            if entry["future"].done():
+                continue  # Cancelled while queued; its acquire() hasn't run its cleanup yet
+            self.virtual_time[entry["priority"]] = max(self.virtual_time.get(entry["priority"], 0.0), entry["tag"])
+            self.queue_waits[entry["tier"]].append(now - entry["enqueued"])
+            self.busy += 1
+            entry["future"].set_result(None)
+
+    def stats(self):
+        tiers = {}
+        for tier, waits in self.queue_waits.items():
+            samples = np.array(waits) if waits else None
+            tiers[tier] = {
+                "waiting": sum(1 for entry in self.waiting if entry["tier"] == tier),
+                "samples": len(waits),
+                "target_queue_wait_seconds": SUBSCRIPTION_TIERS[tier]["target_queue_wait_seconds"],
+                **{
+                    f"queue_wait_p{q}_seconds": round(float(np.percentile(samples, q)), 3) if samples is not None else None
+                    for q in (50, 90, 99)
+                }
+            }
+        return {"slots": self.slots, "busy": self.busy, "tiers": tiers}
+
+class AdmissionController:
+    """Rate limits, per-user concurrency caps and queue backpressure for formatting jobs"""
+
+    def __init__(self, max_concurrent: int, max_queue_wait: float):
+        self.max_concurrent = max_concurrent
+        self.max_queue_wait = max_queue_wait
+        self.user_buckets: Dict[str, TokenBucket] = {}
+        self.tier_buckets: Dict[str, TokenBucket] = {}
+        self.user_jobs: Dict[str, int] = {}
+        self.queued = 0
+        self.running = 0
+        self.avg_job_seconds = 5.0
+        self.scheduler = FairShareScheduler(max_concurrent, JOB_AGING_SECONDS)
+
+    @property
+    def queue_depth(self):
+        return self.queued + self.running
+
+    def estimated_wait(self, user=None):
+        """Expected seconds a job admitted now would wait before it starts processing"""
+        if user is not None:
+            # Only jobs of the same or a higher priority class are ahead of this one
+            backlog = self.scheduler.jobs_ahead(user.tier) + self.running - self.max_concurrent + 1
+        else:
+            backlog = self.queued + self.running - self.max_concurrent + 1
+        if backlog <= 0:
+            return 0.0
+        return backlog * self.avg_job_seconds / self.max_concurrent
+
+    def check_rate_limit(self, user: User):
+        tier = SUBSCRIPTION_TIERS[user.tier]
+        bucket = self.user_buckets.get(user.email)
+        if bucket is None:
+            if len(self.user_buckets) > 10000:
+                self._prune_buckets()
+            bucket = self.user_buckets[user.email] = TokenBucket(
+                tier["uploads_per_minute"] / 60, tier["upload_burst"]
+            )
+        wait = bucket.try_acquire()
+        if wait:
+            raise rate_limited(
+                f"Upload rate limit reached for {tier['name']} tier. Please retry shortly.", wait
+            )
+
+        tier_bucket = self.tier_buckets.get(user.tier)
+        if tier_bucket is None:
+            tier_bucket = self.tier_buckets[user.tier] = TokenBucket(
+                tier["tier_uploads_per_minute"] / 60, tier["tier_uploads_per_minute"] / 6
+            )
+        wait = tier_bucket.try_acquire()
+        if wait:
+            raise rate_limited(f"The {tier['name']} tier is at capacity. Please retry shortly.", wait)
+
+    def check_admission(self, user: User):
+        """Reject before any work is done when the user or the worker is saturated"""
+        max_jobs = SUBSCRIPTION_TIERS[user.tier]["max_concurrent_jobs"]
+        if self.user_jobs.get(user.email, 0) >= max_jobs:
+            raise rate_limited(
+                f"You already have {max_jobs} file(s) being formatted. Please wait for them to finish.",
+                self.avg_job_seconds
+            )
+        wait = self.estimated_wait(user)
+        if wait > self.max_queue_wait:
+            raise rate_limited("The formatting queue is full. Please retry shortly.", wait)
+
+    @contextlib.contextmanager
+    def reserve(self, user: User):
+        """Admit a job and hold one of the user's concurrent-job slots until the block exits"""
+        # Nothing awaits between the check and the increment, so a burst of requests can't all pass
+        self.check_admission(user)
+        self.user_jobs[user.email] = self.user_jobs.get(user.email, 0) + 1
+        try:
+            yield
+        finally:
+            self.user_jobs[user.email] -= 1
+            if not self.user_jobs[user.email]:
+                del self.user_jobs[user.email]
+
+    def _prune_buckets(self):
+        idle_before = time.monotonic() - 600
+        for email in [e for e, b in self.user_buckets.items() if b.updated < idle_before]:
+            del self.user_buckets[email]
+
+    async def run_job(self, user: User, job, deadline: Optional[float] = None):
+        """Run `job()` once the scheduler grants a slot; drops it if `deadline` (monotonic) passes while queued"""
+        self.queued += 1
+        try:
+            with tracer.span("admission.queue", **{"user.tier": user.tier, "queue.depth": self.queued}):
+                await self.scheduler.acquire(user)
+        finally:
+            self.queued -= 1
+        try:
+            if deadline is not None and time.monotonic() > deadline:
+                raise JobDeadlineExceeded("Job deadline passed while waiting in the queue")
+            self.running += 1
+            started = time.monotonic()
+            try:
+                return await job()
+            finally:
+                self.running -= 1
+                elapsed = time.monotonic() - started
+                self.avg_job_seconds = 0.8 * self.avg_job_seconds + 0.2 * elapsed
+        finally:
+            self.scheduler.release()
+
+admission = AdmissionController(MAX_CONCURRENT_FORMATTING_JOBS, MAX_QUEUE_WAIT_SECONDS)
+
 # Store formatting standards documentation
 FORMATTING_STANDARDS = """Book Formatting Standards by Genre
 Book formatting varies significantly across genres to meet reader expectations and industry standards. Here's a comprehensive breakdown of formatting details by genre:
@@ -465,6 +1740,98 @@ Special Elements
 async def root():
     return {"message": "Book Editor API"}
 
+@app.get("/api/health/live")
+async def liveness():
+    """Liveness probe - the process is up and the event loop is answering"""
+    return {"status": "ok"}
+
+@app.get("/api/health/ready")
+async def readiness():
+    """Readiness probe - reports dependency latency and saturation, 503 past the thresholds"""
+    checks = {}
+    failures = []
+
+    # MongoDB round trip
+    ping_started = time.perf_counter()
+    try:
+        await asyncio.wait_for(db.command("ping"), timeout=HEALTH_MAX_MONGO_PING_MS / 1000 * 4)
+        ping_ms = (time.perf_counter() - ping_started) * 1000
+        checks["mongo"] = {"ping_ms": round(ping_ms, 2)}
+        if ping_ms > HEALTH_MAX_MONGO_PING_MS:
+            failures.append(f"Mongo ping {ping_ms:.0f}ms exceeds {HEALTH_MAX_MONGO_PING_MS:.0f}ms")
+    except Exception as e:
+        checks["mongo"] = {"error": str(e) or e.__class__.__name__}
+        failures.append("Mongo unreachable")
+
+    # Motor connection pool
+    pool_stats = pool_monitor.snapshot()
+    pool_stats["max_size"] = MONGO_MAX_POOL_SIZE
+    checks["mongo_pool"] = pool_stats
+    if pool_stats["in_use"] >= MONGO_MAX_POOL_SIZE * HEALTH_MAX_POOL_UTILIZATION:
+        failures.append(f"Mongo pool saturated ({pool_stats['in_use']}/{MONGO_MAX_POOL_SIZE} in use)")
+    if pool_stats["max_checkout_wait_ms"] > HEALTH_MAX_POOL_WAIT_MS:
+        failures.append(f"Mongo pool checkout wait {pool_stats['max_checkout_wait_ms']:.0f}ms")
+
+    # Formatting work on this worker
+    queue_depth = admission.queue_depth
+    checks["formatting_queue"] = {
+        "depth": queue_depth,
+        "running": admission.running,
+        "estimated_wait_seconds": round(admission.estimated_wait(), 2)
+    }
+    if queue_depth > HEALTH_MAX_QUEUE_DEPTH:
+        failures.append(f"Formatting queue depth {queue_depth} exceeds {HEALTH_MAX_QUEUE_DEPTH}")
+
+    # Scratch disk
+    free_mb = shutil.disk_usage(TEMP_DIR).free / (1024 * 1024)
+    checks["temp_dir"] = {"path": str(TEMP_DIR), "free_mb": round(free_mb, 1)}
+    if free_mb < HEALTH_MIN_FREE_DISK_MB:
+        failures.append(f"Only {free_mb:.0f}MB free in {TEMP_DIR}")
+
+    # Event loop responsiveness
+    checks["event_loop"] = {"lag_ms": round(event_loop_lag_ms, 2)}
+    if event_loop_lag_ms > HEALTH_MAX_LOOP_LAG_MS:
+        failures.append(f"Event loop lag {event_loop_lag_ms:.0f}ms exceeds {HEALTH_MAX_LOOP_LAG_MS:.0f}ms")
+
+    body = {"status": "unhealthy" if failures else "ok", "checks": checks, "failures": failures}
+    return JSONResponse(status_code=503 if failures else 200, content=body)
+
+@app.get("/api/metrics")
+async def get_metrics(current_user: TokenData = Depends(get_current_admin_claims)):
+    """Process-local counters for the caches and queues on this worker (admins only)"""
+    lookups = parse_cache_stats["hits"] + parse_cache_stats["misses"]
+    return {
+        "parse_cache": {
+            **parse_cache_stats,
+            "hit_rate": round(parse_cache_stats["hits"] / lookups, 4) if lookups else None,
+            "entries": len(parsed_manuscripts)
+        },
+        "preview": {**preview_stats, "entries": len(preview_cache)},
+        "fonts": font_registry.stats(),
+        "formatting_profiles": formatting_profiles.stats(),
+        "scheduler": admission.scheduler.stats(),
+        "job_workers": job_worker_stats,
+        "event_loop": loop_watchdog.stats(),
+        "tracing": {
+            "exporters": sorted(tracer.exporters),
+            "sample_rate": tracer.sample_rate,
+            "spans_exported": tracer.exported,
+            "spans_dropped": tracer.file_writer.dropped
+        },
+        "mongo": {
+            **command_monitor.snapshot(),
+            "routes": {
+                path: {
+                    **route_stats,
+                    "ms": round(route_stats["ms"], 2),
+                    "avg_commands": round(route_stats["commands"] / route_stats["requests"], 2),
+                    "budget": DB_ROUNDTRIP_BUDGETS.get(path, DB_ROUNDTRIP_BUDGET)
+                }
+                for path, route_stats in db_route_stats.items()
+            }
+        }
+    }
+
 @app.post("/api/register")
 async def register(user_create: UserCreate):
     existing_user = await db.users.find_one({"email": user_create.email})
@@ -491,11 +1858,41 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
             detail="Incorrect email or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": user.email}, expires_delta=access_token_expires
+    return await issue_tokens(user)
+
+@app.post("/api/token/refresh", response_model=Token)
+async def refresh_access_token(request: RefreshTokenRequest):
+    """Exchange a refresh token for a new access/refresh pair, rotating the refresh token"""
+    credentials_exception = HTTPException(
+        status_code=401,
+        detail="Invalid or expired refresh token",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    try:
+        payload = jwt.decode(request.refresh_token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        raise credentials_exception
+    if payload.get("type") != "refresh" or not payload.get("jti"):
+        raise credentials_exception
+
+    # Atomically consume the token so concurrent refreshes can't both succeed
+    stored = await db.refresh_tokens.find_one_and_update(
+        {"jti": payload["jti"], "used": False, "expires_at": {"$gt": datetime.utcnow()}},
+        {"$set": {"used": True}}
     )
-    return {"access_token": access_token, "token_type": "bearer", "user_tier": user.tier}
+    if not stored:
+        reused = await db.refresh_tokens.find_one({"jti": payload["jti"]})
+        if reused:
+            # A rotated token was presented again - assume it leaked and revoke the whole family
+            logger.warning(f"Refresh token reuse detected for {reused['email']}, revoking session")
+            await db.refresh_tokens.delete_many({"family": reused["family"]})
+        raise credentials_exception
+
+    # Tier and status may have changed since the last token was issued
+    user = await get_user(stored["email"])
+    if user is None or not user.is_active:
+        raise credentials_exception
+    return await issue_tokens(user, family=stored["family"])
 
 @app.post("/api/google-auth", response_model=Token)
 async def google_auth(auth_request: GoogleAuthRequest):
@@ -533,17 +1930,12 @@ async def google_auth(auth_request: GoogleAuthRequest):
                 {"$set": {"oauth_provider": "google"}}
             )
         
-        # Create access token
-        access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-        access_token = create_access_token(
-            data={"sub": google_email}, expires_delta=access_token_expires
-        )
-        
-        return {
-            "access_token": access_token,
-            "token_type": "bearer",
-            "user_tier": user.get("tier", "free")
-        }
+        # Create access and refresh tokens
+        return await issue_tokens(User(
+            email=google_email,
+            tier=user.get("tier", "free"),
+            is_active=user.get("is_active", True)
+        ))
         
     except Exception as e:
         logger.error(f"Google auth error: {str(e)}")
@@ -605,6 +1997,8 @@ async def reset_password(request: ResetPasswordConfirm):
             "$unset": {"reset_token": "", "reset_token_expires": ""}
         }
     )
+    # Sign out every session, including any opened with the old password
+    await db.refresh_tokens.delete_many({"email": user["email"]})
     
     return {"message": "Password has been reset successfully"}
 
@@ -632,12 +2026,20 @@ async def upgrade_subscription(tier: str, current_user: User = Depends(get_curre
         raise HTTPException(status_code=400, detail="Invalid subscription tier")
     
     await db.users.update_one({"email": current_user.email}, {"$set": {"tier": tier}})
-    return {"message": f"Subscription upgraded to {SUBSCRIPTION_TIERS[tier]['name']} successfully"}
-
+    current_user.tier = tier
+    # The tier is carried in the access token, so hand back one that reflects the upgrade
+    tokens = await issue_tokens(current_user)
+    return {
+        "message": f"Subscription upgraded to {SUBSCRIPTION_TIERS[tier]['name']} successfully",
+        **tokens
+    }
+
 @app.get("/api/usage/current")
-async def get_current_usage(current_user: User = Depends(get_current_active_user)):
+async def get_current_usage(current_user: TokenData = Depends(get_current_active_claims)):
     current_month = datetime.now().strftime("%Y-%m")
-    current_usage = await get_usage_for_month(current_user, current_month)
+    # Only the usage counter is needed - tier and status come from the token
+    user_doc = await db.users.find_one({"email": current_user.email}, {"usage_count": 1})
+    current_usage = (user_doc or {}).get("usage_count", {}).get(current_month, 0)
     tier_limit = SUBSCRIPTION_TIERS[current_user.tier]["monthly_limit"]
     
     return {
@@ -648,7 +2050,7 @@ async def get_current_usage(current_user: User = Depends(get_current_active_user
     }
 
 @app.get("/api/genres")
-async def get_genres(current_user: Optional[User] = Depends(get_current_active_user)):
+async def get_genres(current_user: TokenData = Depends(get_current_active_claims)):
     genres = []
     allowed_genres = SUBSCRIPTION_TIERS[current_user.tier]["allowed_genres"]
     
@@ -668,6 +2070,385 @@ async def get_genres(current_user: Optional[User] = Depends(get_current_active_u
 async def get_formatting_standards():
     return {"standards": FORMATTING_STANDARDS}
 
+def validate_format_options(
+    book_size: str, font: str, genre: str, template: str, export_profile: str = "standard", output_format: str = "print"
+):
+    formatting_profiles.reload_if_changed()
+    if template not in formatting_profiles.templates:
+        raise HTTPException(status_code=400, detail=f"Invalid template. Choose from: {', '.join(formatting_profiles.templates)}")
+    
+    if export_profile not in EXPORT_PROFILES:
+        raise HTTPException(status_code=400, detail=f"Invalid export profile. Choose from: {', '.join(EXPORT_PROFILES.keys())}")
+    
+    if output_format not in OUTPUT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Invalid output format. Choose from: {', '.join(OUTPUT_FORMATS)}")
+    
+    if book_size not in BOOK_SIZES:
+        raise HTTPException(status_code=400, detail=f"Invalid book size. Choose from: {', '.join(BOOK_SIZES.keys())}")
+    
+    if font not in FONT_OPTIONS:
+        raise HTTPException(status_code=400, detail=f"Invalid font. Choose from: {', '.join(FONT_OPTIONS)}")
+    
+    if genre not in GENRE_OPTIONS:
+        raise HTTPException(status_code=400, detail=f"Invalid genre. Choose from: {', '.join(GENRE_OPTIONS.keys())}")
+
+@app.get("/api/templates")
+async def get_templates():
+    formatting_profiles.reload_if_changed()
+    return [{"id": template_id, **template} for template_id, template in formatting_profiles.templates.items()]
+
+# Isolated job workers
+class JobResourceLimitExceeded(Exception):
+    pass
+
+job_worker_stats = {"started": 0, "killed": 0, "wall_timeouts": 0, "cpu_limits": 0, "memory_limits": 0}
+
+def _job_worker_main(connection, func, args, traceparent=None):
+    """Child: apply resource limits, run `func(*args)` and send back its result or error"""
+    global _render_pool, RENDER_WORKERS
+    os.setpgid(0, 0)  # Own process group, so chapter render workers are killed with us
+    _render_pool = None  # The parent's pool processes aren't ours to use
+    RENDER_WORKERS = min(RENDER_WORKERS, RENDER_WORKERS_PER_JOB)
+    if resource is not None:
+        resource.setrlimit(resource.RLIMIT_CPU, (JOB_CPU_SECONDS, JOB_CPU_SECONDS + 5))
+        with open("/proc/self/statm") as f:
+            inherited = int(f.read().split()[0]) * resource.getpagesize()
+        memory_limit = inherited + JOB_MEMORY_MB * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    tracer.extract(traceparent)
+    since = cache_snapshot()
+    try:
+        with tracer.span(func.__name__, **{"worker.pid": os.getpid()}):
+            result = func(*args)
+        connection.send(("ok", result, cache_report(since)))
+    except MemoryError:
+        connection.send(("memory", None, None))
+    except BaseException as e:
+        connection.send(("error", (isinstance(e, ValueError), str(e)), cache_report(since)))
+    finally:
+        connection.close()
+        if _render_pool is not None:
+            _render_pool.shutdown(cancel_futures=True)
+
+# Worker processes exit after each job, so whatever they add to the parse, font subset
+# and formatting profile caches is sent back and merged here. Processes forked later
+# inherit the entries, and /api/metrics counts hits and misses from every worker.
+def cache_snapshot():
+    return {
+        "parse": dict(parse_cache_stats),
+        "subsets": dict(font_registry.subset_stats),
+        "subset_keys": font_registry.subset_keys(),
+        "profiles": {"hits": formatting_profiles.hits, "misses": formatting_profiles.misses},
+        "profile_keys": formatting_profiles.compiled_keys(),
+    }
+
+def cache_report(since):
+    """What the caches gained since `since` (a cache_snapshot): counter deltas and new entries"""
+    now = cache_snapshot()
+    return {
+        "parse": {counter: now["parse"][counter] - since["parse"][counter] for counter in now["parse"]},
+        "subsets": {counter: now["subsets"][counter] - since["subsets"][counter] for counter in now["subsets"]},
+        "subset_entries": font_registry.subset_entries(since["subset_keys"]),
+        "profiles": {counter: now["profiles"][counter] - since["profiles"][counter] for counter in now["profiles"]},
+        "profile_keys": now["profile_keys"] - since["profile_keys"],
+    }
+
+def merge_cache_report(report):
+    if not report:
+        return
+    for counter, delta in report["parse"].items():
+        parse_cache_stats[counter] += delta
+    for counter, delta in report["subsets"].items():
+        font_registry.subset_stats[counter] += delta
+    formatting_profiles.hits += report["profiles"]["hits"]
+    formatting_profiles.misses += report["profiles"]["misses"]
+    font_registry.adopt_subsets(report["subset_entries"])
+    formatting_profiles.adopt(report["profile_keys"])
+
+def process_group_cpu_seconds(pgid):
+    """
+    CPU seconds used by every live process in `pgid`, plus the children they
+    have already reaped. Linux only - returns None without /proc.
+    """
+    ticks = 0
+    try:
+        stat_paths = list(Path("/proc").glob("[0-9]*/stat"))
+    except OSError:
+        return None
+    if not stat_paths:
+        return None
+    for stat_path in stat_paths:
+        try:
+            # Fields after "(comm)": state, ppid, pgrp, ... utime, stime, cutime, cstime at 11-14
+            fields = stat_path.read_text().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            continue  # Exited while we were looking
+        if int(fields[2]) == pgid:
+            ticks += sum(int(field) for field in fields[11:15])
+    return ticks / os.sysconf("SC_CLK_TCK")
+
+def _collect_job_worker(process, connection, timeout):
+    # RLIMIT_CPU is per process, so each render pool worker would get a budget of its own;
+    # sample the job's whole process group and stop it once together they pass JOB_CPU_SECONDS
+    deadline = time.monotonic() + timeout
+    while True:
+        process.join(max(min(JOB_CPU_POLL_SECONDS, deadline - time.monotonic()), 0))
+        if not process.is_alive():
+            break
+        if time.monotonic() >= deadline:
+            return "wall", None, None
+        cpu_seconds = process_group_cpu_seconds(process.pid)
+        if cpu_seconds is not None and cpu_seconds > JOB_CPU_SECONDS:
+            return "cpu", cpu_seconds, None
+    if connection.poll():
+        try:
+            return connection.recv()
+        except EOFError:
+            pass  # Killed before it could report
+    return "died", process.exitcode, None
+
+async def run_isolated(func, *args):
+    """
+    Run a formatting job in a fresh worker process under JOB_* wall-clock, CPU and
+    memory limits. A worker over a limit is killed (with its process group) and a
+    JobResourceLimitExceeded explains which limit it hit.
+    """
+    with tracer.span("job_worker", **{"job": func.__name__}) as span:
+        return await _run_isolated(span, func, *args)
+
+async def _run_isolated(span, func, *args):
+    parent_end, child_end = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.get_context("fork").Process(
+        target=_job_worker_main, args=(child_end, func, args, tracer.inject())
+    )
+    process.start()
+    child_end.close()
+    job_worker_stats["started"] += 1
+    span.set_attribute("worker.pid", process.pid)
+    try:
+        loop = asyncio.get_running_loop()
+        status, payload, cache_activity = await loop.run_in_executor(
+            None, _collect_job_worker, process, parent_end, JOB_WALL_TIMEOUT_SECONDS
+        )
+        merge_cache_report(cache_activity)
+    finally:
+        if process.is_alive():
+            job_worker_stats["killed"] += 1
+        # Also when the worker has exited - after SIGXCPU or a crash its pool processes are still running
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        process.join()
+        parent_end.close()
+    
+    if status == "ok":
+        return payload
+    if status == "error":
+        is_validation_error, message = payload
+        raise ValueError(message) if is_validation_error else RuntimeError(message)
+    if status == "wall":
+        job_worker_stats["wall_timeouts"] += 1
+        raise JobResourceLimitExceeded(
+            f"Formatting took longer than {JOB_WALL_TIMEOUT_SECONDS:g} seconds and was stopped. "
+            "The document may be damaged or unusually complex."
+        )
+    if status == "memory":
+        job_worker_stats["memory_limits"] += 1
+        raise JobResourceLimitExceeded(
+            f"Formatting needed more than {JOB_MEMORY_MB}MB of memory and was stopped. "
+            "The document may be damaged or unusually complex."
+        )
+    if status == "cpu" or payload in (-signal.SIGXCPU, -signal.SIGKILL):
+        job_worker_stats["cpu_limits"] += 1
+        raise JobResourceLimitExceeded(
+            f"Formatting used more than {JOB_CPU_SECONDS} seconds of CPU time and was stopped. "
+            "The document may be damaged or unusually complex."
+        )
+    raise RuntimeError(f"Formatting worker exited unexpectedly (exit code {payload})")
+
+def format_upload_job(
+    input_path, file_id, file_extension, book_size, font, genre, template, export_profile, cache_key,
+    output_format="print", title=None, reusable_chunks=(), output_path=None, keep_chunks=True
+):
+    """
+    Worker: format a new upload, shrink its images to print resolution and apply its export profile.
+    Returns the output path, export stats, and the output's rendered chunk keys and reuse stats
+    (no keys and None unless `keep_chunks`, when the output is rendered without storing chunks).
+    """
+    if output_format == "epub":
+        output_path = process_epub(input_path, file_id, font, genre, template, title, cache_key)
+        return output_path, export_output(output_path, export_profile), [], None
+    chunks = RenderChunks(reusable_chunks) if keep_chunks else None
+    process = process_docx if file_extension == ".docx" else process_pdf
+    output_path = asyncio.run(process(input_path, file_id, book_size, font, genre, template, cache_key, chunks, output_path))
+    image_stats = None
+    if Path(output_path).suffix == ".docx":
+        try:
+            image_stats = optimize_docx_images(output_path, book_size, font, genre, template)
+        except (zipfile.BadZipFile, ET.ParseError, KeyError) as image_err:
+            logger.warning(f"Skipping image optimization for {file_id}: {str(image_err)}")
+    export_stats = export_output(output_path, export_profile)
+    if image_stats is not None:
+        export_stats["images"] = image_stats
+    if chunks is None:
+        return output_path, export_stats, [], None
+    return output_path, export_stats, chunks.keys, chunks.stats()
+
+def reformat_job(
+    cache_key, input_path, output_path, book_size, font, genre, template, export_profile, title=None, reusable_chunks=()
+):
+    """Worker: re-render a parsed manuscript with new options and apply its export profile"""
+    manuscript = load_manuscript(cache_key, input_path)
+    if output_path.suffix == ".docx" and manuscript.get("layout"):
+        # Rebuilt from its paragraphs, the document would lose its images, tables,
+        # headers and footers, notes or section settings - format the original instead
+        input_path = ensure_input_file(input_path)
+        if not input_path.exists():
+            raise ValueError("The original upload is no longer available. Please upload the file again.")
+        return format_upload_job(
+            input_path, output_path.stem, ".docx", book_size, font, genre, template, export_profile, cache_key,
+            title=title, reusable_chunks=reusable_chunks, output_path=output_path
+        )
+    if output_path.suffix == ".epub":
+        write_epub(manuscript["paragraphs"], output_path, title, font, genre, template)
+        return output_path, export_output(output_path, export_profile), [], None
+    chunks = RenderChunks(reusable_chunks)
+    render = render_pdf_manuscript if output_path.suffix == ".pdf" else render_docx_manuscript
+    asyncio.run(render(manuscript, output_path, book_size, font, genre, template, chunks))
+    return output_path, export_output(output_path, export_profile), chunks.keys, chunks.stats()
+
+# Content-addressed input storage
+def blob_path(content_hash, file_extension):
+    return BLOBS_DIR / f"{content_hash}{file_extension}"
+
+def ensure_input_file(input_path):
+    """Return `input_path`, decompressing its cold .gz copy back in place if needed"""
+    input_path = Path(input_path)
+    if input_path.exists():
+        os.utime(input_path)
+        return input_path
+    gz_path = input_path.with_name(input_path.name + ".gz")
+    if not gz_path.exists():
+        return input_path
+    tmp_path = input_path.with_name(f"{input_path.name}.{uuid.uuid4().hex}.tmp")
+    with gzip.open(gz_path, "rb") as src, open(tmp_path, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.replace(tmp_path, input_path)
+    gz_path.unlink(missing_ok=True)
+    return input_path
+
+def write_blob(content, file_extension):
+    """Write upload bytes under their content hash unless an identical file is already stored"""
+    content_hash = hashlib.sha256(content).hexdigest()
+    path = blob_path(content_hash, file_extension)
+    gz_path = path.with_name(path.name + ".gz")
+    if path.exists() or gz_path.exists():
+        return content_hash, ensure_input_file(path), False
+    tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+    return content_hash, path, True
+
+def move_file_to_blob(source_path, file_extension, expected_sha256=None):
+    """Like write_blob, for a file already on disk - hashed in a streaming pass and moved into place"""
+    digest = hashlib.sha256()
+    size = 0
+    with open(source_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+            size += len(block)
+    content_hash = digest.hexdigest()
+    if expected_sha256 and expected_sha256.lower() != content_hash:
+        Path(source_path).unlink()
+        raise ValueError("File checksum mismatch. Please upload the file again.")
+    path = blob_path(content_hash, file_extension)
+    if path.exists() or path.with_name(path.name + ".gz").exists():
+        Path(source_path).unlink()
+        return content_hash, ensure_input_file(path), size, False
+    os.replace(source_path, path)
+    return content_hash, path, size, True
+
+async def reference_blob(content_hash, file_extension, size, written):
+    await db.blobs.update_one(
+        {"_id": content_hash},
+        {
+            "$inc": {"refcount": 1},
+            "$set": {"last_referenced_at": datetime.utcnow()},
+            "$setOnInsert": {"extension": file_extension, "size": size, "created_at": datetime.utcnow()}
+        },
+        upsert=True
+    )
+    if not written:
+        logger.info(f"Upload matches stored blob {content_hash[:12]}, skipping write")
+
+async def store_input_blob(content, file_extension):
+    """Store an upload once per content hash and take a reference on it"""
+    content_hash, path, written = await asyncio.to_thread(write_blob, content, file_extension)
+    await reference_blob(content_hash, file_extension, len(content), written)
+    return content_hash, path
+
+async def retain_input_blob(content_hash):
+    await db.blobs.update_one({"_id": content_hash}, {"$inc": {"refcount": 1}})
+
+async def release_input_blob(content_hash):
+    """Drop one reference; the blob and its parsed manuscript go once nothing refers to them"""
+    blob = await db.blobs.find_one_and_update(
+        {"_id": content_hash},
+        {"$inc": {"refcount": -1}},
+        return_document=ReturnDocument.AFTER
+    )
+    if not blob or blob["refcount"] > 0:
+        return
+    result = await db.blobs.delete_one({"_id": content_hash, "refcount": {"$lte": 0}})
+    if result.deleted_count:
+        path = blob_path(content_hash, blob["extension"])
+        for stale in (path, path.with_name(path.name + ".gz"), PARSE_CACHE_DIR / f"{content_hash}.json.gz"):
+            stale.unlink(missing_ok=True)
+        parsed_manuscripts.pop(content_hash, None)
+        logger.info(f"Deleted unreferenced blob {content_hash[:12]}")
+
+def compress_cold_blobs():
+    """Gzip blobs that haven't been read for BLOB_COLD_AFTER_SECONDS; returns bytes saved"""
+    cutoff = time.time() - BLOB_COLD_AFTER_SECONDS
+    saved = 0
+    for path in BLOBS_DIR.iterdir():
+        if path.suffix not in (".docx", ".pdf"):
+            continue
+        try:
+            stat = path.stat()
+            if stat.st_mtime > cutoff:
+                continue
+            gz_path = path.with_name(path.name + ".gz")
+            tmp_path = gz_path.with_name(f"{gz_path.name}.{uuid.uuid4().hex}.tmp")
+            with open(path, "rb") as src, gzip.open(tmp_path, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.replace(tmp_path, gz_path)
+            # A reader may have touched the blob while we were compressing - keep it hot then
+            if path.stat().st_mtime > cutoff:
+                gz_path.unlink(missing_ok=True)
+                continue
+            path.unlink()
+            saved += stat.st_size - gz_path.stat().st_size
+        except OSError as e:
+            logger.warning(f"Could not compress blob {path.name}: {str(e)}")
+    return saved
+
+async def compress_cold_blobs_periodically():
+    while True:
+        await asyncio.sleep(BLOB_SWEEP_INTERVAL_SECONDS)
+        saved = await asyncio.to_thread(compress_cold_blobs)
+        if saved:
+            logger.info(f"Compressed cold blobs, saved {saved} bytes")
+        removed = await asyncio.to_thread(purge_stale_chunks)
+        if removed:
+            logger.info(f"Removed {removed} stale rendered chunks")
+
+def manuscript_cache_key(upload):
+    """Parsed manuscripts are keyed by content hash; older uploads by their original file_id"""
+    return upload.get("content_hash") or upload.get("source_file_id") or upload["file_id"]
+
 @app.post("/api/upload")
 async def upload_file(
     file: UploadFile = File(...),
@@ -675,17 +2456,15 @@ async def upload_file(
     font: str = Form(...),
     genre: str = Form(...),
     template: str = Form("standard"),  # Default to standard template
+    export_profile: str = Form("standard"),  # PDF output size/speed trade-off, see EXPORT_PROFILES
+    output_format: str = Form("print"),  # "print" or "epub", see OUTPUT_FORMATS
+    deadline_ms: Optional[int] = Form(None),  # Drop the job if it can't start within this many ms
     current_user: User = Depends(get_current_active_user)
 ):
+    received_at = time.monotonic()
+
     # Validate input parameters
-    if book_size not in BOOK_SIZES:
-        raise HTTPException(status_code=400, detail=f"Invalid book size. Choose from: {', '.join(BOOK_SIZES.keys())}")
-    
-    if font not in FONT_OPTIONS:
-        raise HTTPException(status_code=400, detail=f"Invalid font. Choose from: {', '.join(FONT_OPTIONS)}")
-    
-    if genre not in GENRE_OPTIONS:
-        raise HTTPException(status_code=400, detail=f"Invalid genre. Choose from: {', '.join(GENRE_OPTIONS.keys())}")
+    validate_format_options(book_size, font, genre, template, export_profile, output_format)
     
     # Check if user can format this genre
     await check_genre_allowed(current_user, genre)
@@ -694,9 +2473,7 @@ async def upload_file(
     await check_usage_limit(current_user)
     
     # Validate file type
-    file_extension = Path(file.filename).suffix.lower()
-    if file_extension not in [".docx", ".pdf"]:
-        raise HTTPException(status_code=400, detail="Unsupported file format. Please upload .docx or .pdf files only.")
+    file_extension = validate_upload_filename(file.filename)
     
     # Validate file size (max 10MB)
     max_size_mb = 10
@@ -708,122 +2485,557 @@ async def upload_file(
     # Reset file position
     await file.seek(0)
     
+    # Reject zip bombs and broken packages before they take a rate-limit token or a job slot
+    if file_extension == ".docx":
+        validate_docx_upload(io.BytesIO(content))
+    
+    # Per-user and per-tier rate limits, then concurrency and queue backpressure
+    admission.check_rate_limit(current_user)
+    with admission.reserve(current_user):
+        deadline = received_at + deadline_ms / 1000 if deadline_ms else None
+        if deadline is not None and admission.estimated_wait(current_user) > deadline_ms / 1000:
+            raise rate_limited("The job cannot start before its deadline. Please retry later.", admission.estimated_wait(current_user))
+        
+        # Save the uploaded file - identical manuscripts share one stored copy
+        with tracer.span("store_input", **{"input.bytes": len(content)}):
+            content_hash, temp_input_path = await store_input_blob(content, file_extension)
+        
+        return await format_upload(
+            current_user, file.filename, content_hash, temp_input_path,
+            book_size, font, genre, template, export_profile, deadline, output_format
+        )
+
+def inspect_docx_package(source):
+    """
+    Check a DOCX package against the DOCX_* limits using only its zip central directory,
+    so nothing is decompressed. Raises ValueError describing the first problem found.
+    """
+    try:
+        with zipfile.ZipFile(source) as package:
+            members = package.infolist()
+    except (zipfile.BadZipFile, OSError):
+        raise ValueError("The file is not a valid .docx document.")
+    
+    if len(members) > DOCX_MAX_MEMBERS:
+        raise ValueError(f"The document has too many parts ({len(members)}).")
+    names = {member.filename for member in members}
+    missing = [part for part in DOCX_REQUIRED_PARTS if part not in names]
+    if missing:
+        raise ValueError(f"The file is not a valid .docx document (missing {', '.join(missing)}).")
+    
+    total_size = total_compressed = 0
+    for member in members:
+        total_size += member.file_size
+        total_compressed += member.compress_size
+        if member.filename.endswith((".xml", ".rels")) and member.file_size > DOCX_MAX_XML_PART_MB * 1024 * 1024:
+            raise ValueError(f"The document part {member.filename} is too large.")
+        # Small parts compress extremely well legitimately, so only judge ratios on big ones
+        if member.file_size > 1024 * 1024 and member.file_size > member.compress_size * DOCX_MAX_COMPRESSION_RATIO:
+            raise ValueError("The document is compressed suspiciously well and was rejected.")
+    if total_size > DOCX_MAX_UNCOMPRESSED_MB * 1024 * 1024:
+        raise ValueError(f"The document expands to more than {DOCX_MAX_UNCOMPRESSED_MB}MB.")
+    if total_size > 1024 * 1024 and total_size > max(total_compressed, 1) * DOCX_MAX_COMPRESSION_RATIO:
+        raise ValueError("The document is compressed suspiciously well and was rejected.")
+    return {"members": len(members), "uncompressed_bytes": total_size}
+
+def validate_docx_upload(source):
+    try:
+        return inspect_docx_package(source)
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+
+def validate_upload_filename(filename):
+    file_extension = Path(filename).suffix.lower()
+    if file_extension not in [".docx", ".pdf"]:
+        raise HTTPException(status_code=400, detail="Unsupported file format. Please upload .docx or .pdf files only.")
+    return file_extension
+
+async def format_upload(
+    current_user, filename, content_hash, temp_input_path,
+    book_size, font, genre, template, export_profile, deadline=None, output_format="print"
+):
+    """Record an upload whose input is already stored, format it and count it against the monthly limit"""
+    file_extension = Path(filename).suffix.lower()
+    
     # Generate a unique ID for this upload
     file_id = str(uuid.uuid4())
     
-    # Save the uploaded file
-    temp_input_path = TEMP_DIR / f"{file_id}_input{file_extension}"
-    
-    with open(temp_input_path, "wb") as buffer:
-        buffer.write(content)
+    # Link revisions of the same title so unchanged parts can be reused
+    title = manuscript_title(filename)
+    previous = await find_previous_version(current_user.email, title, file_extension, output_format)
+    keep_chunks = previous is not None or is_revision_name(filename)
     
     # Store file metadata in MongoDB
-    await db.uploads.insert_one({
+    upload = {
         "file_id": file_id,
         "user_email": current_user.email,
-        "original_filename": file.filename,
+        "tier": current_user.tier,
+        "original_filename": filename,
+        "title": title,
+        "previous_file_id": previous["file_id"] if previous else None,
         "book_size": book_size,
         "font": font,
         "genre": genre,
         "template": template,
+        "export_profile": export_profile,
+        "output_format": output_format,
+        "content_hash": content_hash,
+        "input_path": str(temp_input_path),
+        "input_bytes": Path(temp_input_path).stat().st_size,
         "status": "processing",
         "created_at": datetime.utcnow()
-    })
+    }
+    await db.uploads.insert_one(upload)
     
-    # Process the file based on its type
+    # Process the file based on its type, in an isolated worker
+    async def format_file():
+        return await run_isolated(
+            format_upload_job, temp_input_path, file_id, file_extension,
+            book_size, font, genre, template, export_profile, content_hash,
+            output_format, Path(filename).stem, previous.get("chunks", []) if previous else [],
+            None, keep_chunks
+        )
+
     try:
-        if file_extension == ".docx":
-            output_path = await process_docx(temp_input_path, file_id, book_size, font, genre, template)
-        elif file_extension == ".pdf":
-            output_path = await process_pdf(temp_input_path, file_id, book_size, font, genre, template)
+        with tracer.span("format_upload", **{
+            "file_id": file_id,
+            "input.bytes": upload["input_bytes"],
+            "input.extension": file_extension,
+            "book_size": book_size,
+            "font": font,
+            "genre": genre,
+            "template": template,
+            "export_profile": export_profile,
+            "output_format": output_format,
+        }):
+            output_path, export_stats, chunk_keys, incremental = await admission.run_job(current_user, format_file, deadline)
+        if incremental is not None:
+            incremental["previous_file_id"] = upload["previous_file_id"]
         
         # Update status in database
-        await db.uploads.update_one(
-            {"file_id": file_id},
-            {"$set": {"status": "completed", "output_path": str(output_path)}}
-        )
+        await finish_job(upload, "completed", {
+            "output_path": str(output_path),
+            "export": export_stats,
+            "chunks": chunk_keys,
+            "incremental": incremental
+        })
         
         # Increment user's usage count
         await increment_usage(current_user)
         
-        return {"file_id": file_id, "message": "File processed successfully"}
+        return {
+            "file_id": file_id,
+            "message": "File processed successfully",
+            "export": export_stats,
+            "incremental": incremental,
+            **signed_download_url({**upload, "output_path": str(output_path)})
+        }
+    
+    except JobResourceLimitExceeded as le:
+        logger.error(f"Job {file_id} stopped: {str(le)}")
+        await finish_job(upload, "failed", {"error": str(le)})
+        raise HTTPException(status_code=422, detail=str(le))
     
     except ValueError as ve:
         logger.error(f"Validation error: {str(ve)}")
-        await db.uploads.update_one(
-            {"file_id": file_id},
-            {"$set": {"status": "failed", "error": str(ve)}}
-        )
+        await finish_job(upload, "failed", {"error": str(ve)})
         raise HTTPException(status_code=400, detail=str(ve))
     
+    except JobDeadlineExceeded as de:
+        logger.warning(f"Dropping stale job {file_id}: {str(de)}")
+        await finish_job(upload, "failed", {"error": str(de)})
+        raise rate_limited(str(de), admission.estimated_wait())
+    
     except Exception as e:
         logger.error(f"Error processing file: {str(e)}")
-        await db.uploads.update_one(
-            {"file_id": file_id},
-            {"$set": {"status": "failed", "error": str(e)}}
-        )
+        await finish_job(upload, "failed", {"error": str(e)})
         raise HTTPException(status_code=500, detail=f"Error processing file: {str(e)}")
 
-async def process_docx(input_path, file_id, book_size, font, genre, template="standard"):
+async def finish_job(upload, status, fields):
+    """Record a job's final status on its upload and fold the outcome into the usage rollups"""
+    completed_at = datetime.utcnow()
+    await db.uploads.update_one(
+        {"file_id": upload["file_id"]},
+        {"$set": {"status": status, "completed_at": completed_at, **fields}}
+    )
+    month = upload["created_at"].strftime("%Y-%m")
+    await db.usage_rollups.update_one(
+        {"_id": f"{month}|{upload['tier']}|{upload['genre']}|{status}"},
+        {
+            "$inc": {
+                "jobs": 1,
+                "reformats": 1 if upload.get("source_file_id") else 0,
+                "input_bytes": upload.get("input_bytes") or 0,
+                "output_bytes": fields.get("export", {}).get("bytes_after", 0),
+                "processing_seconds": (completed_at - upload["created_at"]).total_seconds()
+            },
+            "$setOnInsert": {"month": month, "tier": upload["tier"], "genre": upload["genre"], "status": status}
+        },
+        upsert=True
+    )
+
+# Resumable uploads
+def merge_ranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def upload_session_status(session):
+    received = merge_ranges(session.get("received", []))
+    # The contiguous prefix is where a sequential client resumes from
+    offset = received[0][1] if received and received[0][0] == 0 else 0
+    missing, position = [], 0
+    for start, end in received + [[session["size"], session["size"]]]:
+        if start > position:
+            missing.append([position, start])
+        position = max(position, end)
+    return {
+        "session_id": session["session_id"],
+        "filename": session["filename"],
+        "size": session["size"],
+        "offset": offset,
+        "received_bytes": sum(end - start for start, end in received),
+        "received_ranges": received,
+        "missing_ranges": missing,
+        "chunk_size": UPLOAD_CHUNK_SIZE,
+        "expires_at": session["expires_at"].isoformat()
+    }
+
+async def get_upload_session(session_id, user):
+    session = await db.upload_sessions.find_one({"session_id": session_id, "user_email": user.email})
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    if session["expires_at"] < datetime.utcnow():
+        raise HTTPException(status_code=410, detail="Upload session has expired. Please start a new upload.")
+    return session
+
+async def purge_expired_upload_sessions(limit=UPLOAD_SESSION_PURGE_BATCH):
+    """Delete up to `limit` expired sessions and their part files; returns how many were removed"""
+    removed = 0
+    expired = db.upload_sessions.find({"expires_at": {"$lt": datetime.utcnow()}}, {"session_id": 1}).limit(limit)
+    async for session in expired:
+        if (await db.upload_sessions.delete_one({"_id": session["_id"]})).deleted_count:
+            await asyncio.to_thread((UPLOAD_SESSIONS_DIR / f"{session['session_id']}.part").unlink, missing_ok=True)
+            removed += 1
+    return removed
+
+async def purge_expired_upload_sessions_periodically():
+    while True:
+        await asyncio.sleep(UPLOAD_SESSION_SWEEP_INTERVAL_SECONDS)
+        try:
+            removed = await purge_expired_upload_sessions()
+        except Exception as e:
+            logger.warning(f"Could not purge expired upload sessions: {str(e)}")
+            continue
+        if removed:
+            logger.info(f"Removed {removed} expired upload sessions")
+
+def create_part_file(part_path, size):
+    # Pre-size the part file so chunks can be written at their offsets as they arrive
+    with open(part_path, "wb") as f:
+        f.truncate(size)
+
+def write_chunk(part_path, offset, data):
+    fd = os.open(part_path, os.O_WRONLY)
+    try:
+        os.pwrite(fd, data, offset)
+    finally:
+        os.close(fd)
+
+@app.post("/api/uploads")
+async def create_upload_session(
+    filename: str = Form(...),
+    size: int = Form(...),
+    book_size: str = Form(...),
+    font: str = Form(...),
+    genre: str = Form(...),
+    template: str = Form("standard"),
+    export_profile: str = Form("standard"),
+    output_format: str = Form("print"),
+    current_user: User = Depends(get_current_active_user)
+):
+    """
+    Start a resumable upload. Chunks are then PUT to /api/uploads/{session_id} with their
+    byte offset, in any order and in parallel, and the session is finalized once complete.
+    """
+    validate_format_options(book_size, font, genre, template, export_profile, output_format)
+    await check_genre_allowed(current_user, genre)
+    await check_usage_limit(current_user)
+    validate_upload_filename(filename)
+    
+    max_size_bytes = MAX_RESUMABLE_UPLOAD_MB * 1024 * 1024
+    if size <= 0 or size > max_size_bytes:
+        raise HTTPException(status_code=400, detail=f"File size must be between 1 byte and {MAX_RESUMABLE_UPLOAD_MB}MB.")
+    
+    session_id = str(uuid.uuid4())
+    await asyncio.to_thread(create_part_file, UPLOAD_SESSIONS_DIR / f"{session_id}.part", size)
+    
+    session = {
+        "session_id": session_id,
+        "user_email": current_user.email,
+        "filename": filename,
+        "size": size,
+        "options": {
+            "book_size": book_size,
+            "font": font,
+            "genre": genre,
+            "template": template,
+            "export_profile": export_profile,
+            "output_format": output_format
+        },
+        "received": [],
+        "created_at": datetime.utcnow(),
+        "expires_at": datetime.utcnow() + timedelta(hours=UPLOAD_SESSION_TTL_HOURS)
+    }
+    await db.upload_sessions.insert_one(session)
+    return upload_session_status(session)
+
+@app.put("/api/uploads/{session_id}")
+async def upload_chunk(
+    session_id: str,
+    request: Request,
+    offset: int,
+    x_chunk_sha256: Optional[str] = Header(None),
+    current_user: TokenData = Depends(get_current_active_claims)
+):
+    """Write one chunk (the raw request body) at `offset`. X-Chunk-SHA256 is verified when sent."""
+    session = await get_upload_session(session_id, current_user)
+    if offset < 0 or offset >= session["size"]:
+        raise HTTPException(status_code=400, detail="Chunk offset is outside the file.")
+    
+    # The whole chunk is checked before any of it is written, so a bad retry of a
+    # range that already arrived can't overwrite the good copy
+    digest = hashlib.sha256()
+    buffer = bytearray()
+    async for data in request.stream():
+        digest.update(data)
+        buffer += data
+        if len(buffer) > MAX_UPLOAD_CHUNK_BYTES:
+            raise HTTPException(status_code=413, detail=f"Chunks can be at most {MAX_UPLOAD_CHUNK_BYTES} bytes.")
+        if offset + len(buffer) > session["size"]:
+            raise HTTPException(status_code=400, detail="Chunk extends past the declared file size.")
+    if not buffer:
+        raise HTTPException(status_code=400, detail="Empty chunk.")
+    # A corrupt chunk is simply not recorded, so the client re-sends it
+    if x_chunk_sha256 and x_chunk_sha256.lower() != digest.hexdigest():
+        raise HTTPException(status_code=400, detail="Chunk checksum mismatch. Please re-send this chunk.")
+    
+    finalized = HTTPException(status_code=409, detail="Upload session was finalized or removed while this chunk was sent.")
+    try:
+        await asyncio.to_thread(write_chunk, UPLOAD_SESSIONS_DIR / f"{session_id}.part", offset, bytes(buffer))
+    except FileNotFoundError:
+        raise finalized
+    session = await db.upload_sessions.find_one_and_update(
+        {"session_id": session_id},
+        {"$push": {"received": [offset, offset + len(buffer)]}},
+        return_document=ReturnDocument.AFTER
+    )
+    if session is None:
+        raise finalized
+    return upload_session_status(session)
+
+@app.get("/api/uploads/{session_id}")
+async def get_upload_status(session_id: str, current_user: TokenData = Depends(get_current_active_claims)):
+    """How much of the file has arrived - resume from `offset`, or fill in `missing_ranges`"""
+    return upload_session_status(await get_upload_session(session_id, current_user))
+
+@app.post("/api/uploads/{session_id}/finalize")
+async def finalize_upload(
+    session_id: str,
+    sha256: Optional[str] = Form(None),  # Optional whole-file checksum
+    deadline_ms: Optional[int] = Form(None),
+    current_user: User = Depends(get_current_active_user)
+):
+    """Assemble a complete upload and run it through the same processing as /api/upload"""
+    received_at = time.monotonic()
+    session = await get_upload_session(session_id, current_user)
+    status = upload_session_status(session)
+    if status["missing_ranges"]:
+        raise HTTPException(status_code=409, detail={"message": "Upload is incomplete.", **status})
+    
+    if Path(session["filename"]).suffix.lower() == ".docx":
+        try:
+            inspect_docx_package(UPLOAD_SESSIONS_DIR / f"{session_id}.part")
+        except ValueError as ve:
+            # The assembled file itself is bad, so there is nothing to resume
+            await db.upload_sessions.delete_one({"session_id": session_id})
+            (UPLOAD_SESSIONS_DIR / f"{session_id}.part").unlink(missing_ok=True)
+            raise HTTPException(status_code=400, detail=str(ve))
+    
+    # The plan may have changed, or other uploads used up the month, since the session started
+    options = session["options"]
+    await check_genre_allowed(current_user, options["genre"])
+    await check_usage_limit(current_user)
+    admission.check_rate_limit(current_user)
+    with admission.reserve(current_user):
+        deadline = received_at + deadline_ms / 1000 if deadline_ms else None
+        if deadline is not None and admission.estimated_wait(current_user) > deadline_ms / 1000:
+            raise rate_limited("The job cannot start before its deadline. Please retry later.", admission.estimated_wait(current_user))
+        
+        # Claim the session so a retried finalize can't process the file twice
+        if not (await db.upload_sessions.delete_one({"session_id": session_id})).deleted_count:
+            raise HTTPException(status_code=404, detail="Upload session not found")
+        
+        file_extension = Path(session["filename"]).suffix.lower()
+        part_path = UPLOAD_SESSIONS_DIR / f"{session_id}.part"
+        try:
+            content_hash, input_path, size, written = await asyncio.to_thread(
+                move_file_to_blob, part_path, file_extension, sha256
+            )
+        except ValueError as ve:
+            raise HTTPException(status_code=400, detail=str(ve))
+        await reference_blob(content_hash, file_extension, size, written)
+        
+        return await format_upload(
+            current_user, session["filename"], content_hash, input_path,
+            options["book_size"], options["font"], options["genre"],
+            options["template"], options["export_profile"], deadline,
+            options.get("output_format", "print")
+        )
+
+def apply_docx_page_setup(doc, profile):
+    # Set trim size and the template's margins
+    for section in doc.sections:
+        section.page_width = Inches(profile.page_width)
+        section.page_height = Inches(profile.page_height)
+        section.left_margin = Inches(profile.margins["inside"])
+        section.right_margin = Inches(profile.margins["outside"])
+        section.top_margin = Inches(profile.margins["top"])
+        section.bottom_margin = Inches(profile.margins["bottom"])
+        
+    logger.info("Successfully applied section formatting")
+
+@tracer.traced("docx.apply_formatting")
+def apply_docx_formatting(doc, book_size, font, genre, template="standard", chunks=None):
+    """
+    Apply trim size, margins, genre typography and the template to a python-docx document in place.
+    With `chunks`, blocks of paragraphs formatted for the previous version are spliced in unchanged;
+    long documents have their paragraphs formatted block by block in the render pool.
+    """
+    profile = formatting_profiles.get(genre, font, book_size, template)
+    apply_docx_page_setup(doc, profile)
+    
+    # Resolve style names once - python-docx looks each paragraph's style up from scratch
+    style_names = {style.style_id: style.name for style in doc.styles}
+    default_style = doc.styles.default(WD_STYLE_TYPE.PARAGRAPH)
+    default_name = default_style.name if default_style is not None else ""
+    
+    def is_heading_paragraph(paragraph):
+        style_name = style_names.get(paragraph._p.style, default_name) or ""
+        return style_name.startswith(("Heading", "Title", "Subtitle"))
+    
+    # Apply font and other formatting
+    paragraphs = doc.paragraphs
+    parallel = RENDER_WORKERS > 1 and len(paragraphs) >= PARALLEL_RENDER_MIN_PARAGRAPHS
+    if chunks is None and not parallel:
+        for paragraph in paragraphs:
+            format_docx_paragraph(paragraph, profile, heading=is_heading_paragraph(paragraph))
+    else:
+        # Work in content-defined blocks: blocks formatted for the previous version are
+        # spliced in unchanged, and on long documents the rest are formatted by the render pool
+        params = RenderChunks.params("docx-inplace", book_size, font, genre, template)
+        blocks, keys, formatted = [], [], []
+        for block in content_defined_blocks(paragraphs, lambda paragraph: paragraph.text):
+            headings = [is_heading_paragraph(paragraph) for paragraph in block]
+            xml_paragraphs = [etree.tostring(paragraph._p) for paragraph in block]
+            key = RenderChunks.key(params, b"".join(
+                (b"H" if heading else b"P") + xml_paragraph for xml_paragraph, heading in zip(xml_paragraphs, headings)
+            )) if chunks is not None else None
+            blocks.append((block, headings, xml_paragraphs))
+            keys.append(key)
+            formatted.append(chunks.load_xml(key, len(block)) if chunks is not None else None)
+        pending = [index for index, xml_paragraphs in enumerate(formatted) if xml_paragraphs is None]
+        
+        if parallel and len(pending) > 1:
+            pool = get_render_pool()
+            futures = [
+                pool.submit(
+                    traced_call, tracer.inject(), "docx.format_block", _format_docx_block,
+                    blocks[index][2], blocks[index][1], book_size, font, genre, template
+                )
+                for index in pending
+            ]
+            for index, future in zip(pending, futures):
+                formatted[index] = pool_result(future.result())
+                if chunks is not None:
+                    chunks.store_xml(keys[index], formatted[index])
+        else:
+            for index in pending:
+                block, headings, _ = blocks[index]
+                for paragraph, heading in zip(block, headings):
+                    format_docx_paragraph(paragraph, profile, heading=heading)
+                if chunks is not None:
+                    chunks.store_xml(keys[index], [etree.tostring(paragraph._p, encoding="unicode") for paragraph in block])
+        
+        for index, xml_paragraphs in enumerate(formatted):
+            if xml_paragraphs is None:
+                continue  # Formatted in place
+            for paragraph, xml_paragraph in zip(blocks[index][0], xml_paragraphs):
+                paragraph._p.addprevious(parse_xml(xml_paragraph))
+                paragraph._p.getparent().remove(paragraph._p)
+            
+    logger.info("Successfully applied paragraph and font formatting")
+
+@tracer.traced("process_docx")
+async def process_docx(
+    input_path, file_id, book_size, font, genre, template="standard", cache_key=None, chunks=None, output_path=None
+):
     """Process a DOCX file and apply formatting according to specified parameters"""
     try:
         logger.info(f"Processing DOCX file: {input_path}, Size: {book_size}, Font: {font}, Genre: {genre}, Template: {template}")
         
         # Validate the DOCX file first - create a simple document if it's invalid
+        load_failed = False
         try:
             # Try to load the document
-            doc = docx.Document(input_path)
+            with tracer.span("docx.load"):
+                doc = docx.Document(input_path)
             logger.info("Successfully loaded DOCX file")
+        except MemoryError:
+            raise
         except Exception as load_err:
             logger.error(f"Error loading DOCX: {str(load_err)}. Creating a new document.")
             # Create a new document instead
             doc = docx.Document()
             doc.add_paragraph(f"Original file could not be loaded: {str(load_err)}")
             doc.add_paragraph("This is a placeholder document with your selected formatting.")
+            load_failed = True
+        
+        # Keep the parsed manuscript so re-formats don't have to parse the file again -
+        # read from the loaded document, before formatting changes it
+        manuscript_key = cache_key or file_id
+        if not load_failed and not is_manuscript_cached(manuscript_key):
+            try:
+                with tracer.span("docx.parse"):
+                    cache_manuscript(manuscript_key, manuscript_from_document(doc))
+            except MemoryError:
+                raise
+            except Exception as parse_err:
+                logger.warning(f"Could not cache parsed manuscript for {file_id}: {str(parse_err)}")
         
         # Apply formatting based on genre
         try:
-            # Get book size dimensions
-            width, height = BOOK_SIZES[book_size]
-            
-            # Set margins (1 inch for non-fiction as specified)
-            for section in doc.sections:
-                section.page_width = Inches(width)
-                section.page_height = Inches(height)
-                section.left_margin = Inches(1)
-                section.right_margin = Inches(1)
-                section.top_margin = Inches(1)
-                section.bottom_margin = Inches(1)
-                
-            logger.info("Successfully applied section formatting")
-            
-            # Apply font and other formatting
-            for paragraph in doc.paragraphs:
-                if not paragraph.text.strip():
-                    continue  # Skip empty paragraphs
-                
-                # Set paragraph formatting based on genre
-                line_spacing = GENRE_OPTIONS[genre]["line_spacing"]
-                paragraph.paragraph_format.line_spacing = line_spacing
-                
-                # Apply font to runs
-                font_size = GENRE_OPTIONS[genre]["font_size"]
-                for run in paragraph.runs:
-                    run.font.name = font
-                    run.font.size = Pt(font_size)
-                    
-            logger.info("Successfully applied paragraph and font formatting")
+            apply_docx_formatting(doc, book_size, font, genre, template, chunks)
+        except MemoryError:
+            raise
         except Exception as format_err:
             logger.error(f"Error applying formatting: {str(format_err)}")
             # Continue with saving even if formatting failed
         
         # Save the formatted document
-        output_path = TEMP_DIR / f"{file_id}_formatted.docx"
+        output_path = output_path or TEMP_DIR / f"{file_id}_formatted.docx"
         logger.info(f"Saving document to {output_path}")
-        doc.save(output_path)
+        with tracer.span("docx.save"):
+            doc.save(output_path)
         logger.info("Document saved successfully")
         
         return output_path
+    except MemoryError:
+        raise
     except Exception as e:
         logger.error(f"Error processing DOCX file: {str(e)}")
         # Create a simple error document
@@ -838,7 +3050,10 @@ async def process_docx(input_path, file_id, book_size, font, genre, template="st
             # If even this fails, raise the original error
             raise ValueError(f"Error processing DOCX file: {str(e)}")
 
-async def process_pdf(input_path, file_id, book_size, font, genre, template="standard"):
+@tracer.traced("process_pdf")
+async def process_pdf(
+    input_path, file_id, book_size, font, genre, template="standard", cache_key=None, chunks=None, output_path=None
+):
     """Process a PDF file and apply formatting according to specified parameters"""
     try:
         # This is a simplified implementation - a full version would extract content 
@@ -852,66 +3067,56 @@ async def process_pdf(input_path, file_id, book_size, font, genre, template="sta
         width_pt = width * 72  # Convert inches to points (72 points per inch)
         height_pt = height * 72
         
-        output_path = TEMP_DIR / f"{file_id}_formatted.pdf"
+        output_path = output_path or TEMP_DIR / f"{file_id}_formatted.pdf"
         
         # Verify the input PDF is readable
         num_pages = 0
         try:
-            with open(input_path, 'rb') as f:
+            with open(input_path, "rb") as f:
                 # Check for PDF signature
-                pdf_signature = f.read(5)
-                if not pdf_signature.startswith(b'%PDF'):
+                if not f.read(5).startswith(b"%PDF"):
                     raise ValueError("File is not a valid PDF - missing PDF signature")
-                
-                # Try to read with PyPDF2 - with more robust error handling
-                f.seek(0)
-                try:
-                    reader = PyPDF2.PdfReader(f)
-                    num_pages = len(reader.pages)
-                    logger.info(f"PDF has {num_pages} pages")
-                except Exception as pdf_err:
-                    # If PyPDF2 fails but file has PDF signature, assume it's valid but damaged
-                    logger.warning(f"PyPDF2 couldn't fully parse PDF: {str(pdf_err)}")
-                    num_pages = 1  # Assume at least one page
+            inspection = inspect_pdf(input_path)
+            num_pages = inspection["page_count"]
+            logger.info(f"PDF has {num_pages} pages (read via {inspection['method']})")
         except Exception as e:
             logger.error(f"Error verifying PDF: {str(e)}")
             raise ValueError(f"Invalid PDF file: {str(e)}")
         
+        # Extract the text so it can be re-laid out (and re-formatted later without parsing)
+        manuscript = None
+        try:
+            manuscript = parse_manuscript(input_path)
+            cache_manuscript(cache_key or file_id, manuscript)
+        except MemoryError:
+            raise
+        except Exception as parse_err:
+            logger.warning(f"Could not extract text from PDF: {str(parse_err)}")
+        
         try:
+            if manuscript and manuscript["paragraphs"]:
+                return await render_pdf_manuscript(manuscript, output_path, book_size, font, genre, template, chunks)
+            
+            # No extractable text (e.g. a scanned PDF) - produce a summary page instead
             # Create a new PDF with the desired dimensions
+            profile = formatting_profiles.get(genre, font, book_size, template)
             doc = SimpleDocTemplate(
                 str(output_path),
                 pagesize=(width_pt, height_pt),
-                leftMargin=72,  # 1 inch = 72 points
-                rightMargin=72,
-                topMargin=72,
-                bottomMargin=72
+                **profile.pdf_margins
             )
             
-            # Use only built-in ReportLab fonts for maximum compatibility
-            styles = getSampleStyleSheet()
-            
-            # Use entirely built-in fonts to prevent mapping errors
+            bold_font = font_registry.resolve(font)[1]
             title_style = ParagraphStyle(
                 name='CustomTitle',
-                fontName='Helvetica-Bold',
+                fontName=bold_font,
                 fontSize=16,
                 leading=20,
                 alignment=1,  # center aligned
                 spaceAfter=12
             )
             
-            # Get line spacing from genre
-            line_spacing = GENRE_OPTIONS[genre]["line_spacing"]
-            font_size = GENRE_OPTIONS[genre]["font_size"]
-            leading = font_size * line_spacing
-            
-            normal_style = ParagraphStyle(
-                name='CustomNormal',
-                fontName='Helvetica',
-                fontSize=font_size,
-                leading=leading,
-            )
+            normal_style = ParagraphStyle(name='CustomNormal', parent=profile.pdf_normal_style, firstLineIndent=0)
             
             # Create content
             content = []
@@ -922,9 +3127,9 @@ async def process_pdf(input_path, file_id, book_size, font, genre, template="sta
             
             # Add formatting details
             content.append(Paragraph(f"Book Size: {book_size}", normal_style))
-            content.append(Paragraph(f"Font: {font} (preview shown in Helvetica)", normal_style))
+            content.append(Paragraph(f"Font: {font}", normal_style))
             content.append(Paragraph(f"Genre: {GENRE_OPTIONS[genre]['name']}", normal_style))
-            content.append(Paragraph(f"Template: {template.capitalize()}", normal_style))
+            content.append(Paragraph(f"Template: {formatting_profiles.templates[template]['name']}", normal_style))
             content.append(Spacer(1, 24))
             
             # Add note about formatting
@@ -943,6 +3148,8 @@ async def process_pdf(input_path, file_id, book_size, font, genre, template="sta
             doc.build(content)
             
             return output_path
+        except MemoryError:
+            raise
         except Exception as pdf_gen_err:
             logger.error(f"Error generating formatted PDF: {str(pdf_gen_err)}")
             # Fall back to simply copying the original PDF if we can't create a new one
@@ -953,91 +3160,2198 @@ async def process_pdf(input_path, file_id, book_size, font, genre, template="sta
         logger.error(f"Error in process_pdf: {str(e)}")
         raise
 
-@app.api_route("/api/download/{file_id}", methods=["GET", "POST"])
-async def download_file(
-    file_id: str, 
-    request: Request,
-    token: str = Form(None),
-    current_user: User = Depends(get_current_active_user)
-):
-    # If token is provided in the POST request, use it for authentication
-    user = current_user
-    if token and not user:
-        try:
-            # Manually validate the token
-            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-            email = payload.get("sub")
-            if email:
-                user = await get_user(email)
-        except JWTError:
-            raise HTTPException(
-                status_code=401,
-                detail="Invalid authentication token",
-                headers={"WWW-Authenticate": "Bearer"},
+# Print-resolution image optimization for DOCX outputs
+WP_NS = "{http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing}"
+A_NS = "{http://schemas.openxmlformats.org/drawingml/2006/main}"
+R_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+PKG_REL_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+EMU_PER_INCH = 914400
+IMAGE_FORMATS = {".jpg": "JPEG", ".jpeg": "JPEG", ".png": "PNG"}
+
+def docx_image_display_sizes(package):
+    """Largest displayed size in inches of each media part, from the drawings that show it"""
+    sizes = {}
+    for name in package.namelist():
+        if not re.fullmatch(r"word/(document|header\d*|footer\d*)\.xml", name):
+            continue
+        rels_name = f"word/_rels/{name.split('/')[-1]}.rels"
+        if rels_name not in package.namelist():
+            continue
+        targets = {
+            rel.get("Id"): "word/" + rel.get("Target").lstrip("/").removeprefix("word/")
+            for rel in ET.fromstring(package.read(rels_name)).iter(PKG_REL_NS + "Relationship")
+        }
+        for _, element in ET.iterparse(package.open(name)):
+            if element.tag not in (WP_NS + "inline", WP_NS + "anchor"):
+                continue
+            extent = element.find(WP_NS + "extent")
+            blip = next(element.iter(A_NS + "blip"), None)
+            if extent is not None and blip is not None and blip.get(R_NS + "embed") in targets:
+                target = targets[blip.get(R_NS + "embed")]
+                width = int(extent.get("cx", 0)) / EMU_PER_INCH
+                height = int(extent.get("cy", 0)) / EMU_PER_INCH
+                previous = sizes.get(target, (0, 0))
+                sizes[target] = (max(previous[0], width), max(previous[1], height))
+            element.clear()
+    return sizes
+
+def _optimize_image(task):
+    """Worker: resample one image to the print DPI for its displayed size and re-encode it"""
+    name, data, max_width_in, max_height_in = task
+    image_format = IMAGE_FORMATS[Path(name).suffix.lower()]
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.load()
+            target = (
+                max(1, round(max_width_in * PRINT_IMAGE_DPI)),
+                max(1, round(max_height_in * PRINT_IMAGE_DPI))
             )
+            resized = image.width > target[0] * 1.1 or image.height > target[1] * 1.1
+            if resized:
+                image = image.copy()
+                image.thumbnail(target, Image.LANCZOS)
+            buffer = io.BytesIO()
+            if image_format == "JPEG":
+                if image.mode not in ("RGB", "L", "CMYK"):
+                    image = image.convert("RGB")
+                image.save(buffer, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+            else:
+                image.save(buffer, "PNG", optimize=True)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        logger.warning(f"Leaving image {name} as is: {str(e)}")
+        return name, None, False
+    optimized = buffer.getvalue()
+    return name, optimized if len(optimized) < len(data) else None, resized
+
+@tracer.traced("docx.optimize_images")
+def optimize_docx_images(docx_path, book_size, font, genre, template="standard"):
+    """
+    Downsample a DOCX's embedded JPEG/PNG images to PRINT_IMAGE_DPI at the size they
+    are shown (never wider or taller than the text block of the trim size), in parallel,
+    and rewrite the package. Returns byte counts for the job record.
+    """
+    profile = formatting_profiles.get(genre, font, book_size, template)
+    text_width = profile.page_width - profile.margins["inside"] - profile.margins["outside"]
+    text_height = profile.page_height - profile.margins["top"] - profile.margins["bottom"]
+    stats = {"images": 0, "resized": 0, "bytes_before": 0, "bytes_after": 0}
     
-    if not user:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    # Get file information from database
-    file_info = await db.uploads.find_one({
-        "file_id": file_id,
-        "user_email": user.email  # Ensure the file belongs to the user
-    })
-    
-    if not file_info:
-        raise HTTPException(status_code=404, detail="File not found")
+    with zipfile.ZipFile(docx_path) as package:
+        display_sizes = docx_image_display_sizes(package)
+        tasks = []
+        for name, (width, height) in display_sizes.items():
+            if Path(name).suffix.lower() not in IMAGE_FORMATS or name not in package.namelist():
+                continue
+            if package.getinfo(name).file_size < MIN_OPTIMIZED_IMAGE_BYTES:
+                continue
+            scale = min(1.0, text_width / width if width else 1.0, text_height / height if height else 1.0)
+            tasks.append((name, package.read(name), width * scale, height * scale))
+    if not tasks:
+        return stats
     
-    if file_info.get("status") != "completed":
-        raise HTTPException(status_code=400, detail="File processing not completed")
+    if RENDER_WORKERS > 1 and len(tasks) > 1:
+        results = list(get_render_pool().map(_optimize_image, tasks))
+    else:
+        results = [_optimize_image(task) for task in tasks]
     
-    output_path = file_info.get("output_path")
-    if not output_path or not os.path.exists(output_path):
-        raise HTTPException(status_code=404, detail="Output file not found")
+    replacements = {}
+    sizes = {task[0]: len(task[1]) for task in tasks}
+    for name, optimized, resized in results:
+        stats["images"] += 1
+        stats["resized"] += resized
+        stats["bytes_before"] += sizes[name]
+        stats["bytes_after"] += len(optimized) if optimized is not None else sizes[name]
+        if optimized is not None:
+            replacements[name] = optimized
+    if not replacements:
+        return stats
     
-    return FileResponse(
-        path=output_path, 
-        filename=f"formatted_{file_info.get('original_filename')}",
-        media_type="application/octet-stream"
+    tmp_path = Path(docx_path).with_suffix(".images.tmp")
+    with zipfile.ZipFile(docx_path) as source, zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_DEFLATED) as target:
+        for member in source.infolist():
+            if member.filename in replacements:
+                # Already-compressed image data gains nothing from deflate
+                target.writestr(member.filename, replacements[member.filename], zipfile.ZIP_STORED)
+            else:
+                target.writestr(member, source.read(member.filename))
+    os.replace(tmp_path, docx_path)
+    logger.info(
+        f"Optimized {len(replacements)} of {stats['images']} images in {Path(docx_path).name}, "
+        f"saved {stats['bytes_before'] - stats['bytes_after']} bytes"
     )
+    return stats
 
-@app.get("/api/status/{file_id}")
-async def get_status(file_id: str, current_user: User = Depends(get_current_active_user)):
-    file_info = await db.uploads.find_one({
-        "file_id": file_id,
-        "user_email": current_user.email  # Ensure the file belongs to the current user
-    })
-    
-    if not file_info:
-        raise HTTPException(status_code=404, detail="File not found")
-    
-    return {
-        "file_id": file_id,
-        "status": file_info.get("status"),
-        "error": file_info.get("error", None)
-    }
+# Lazy PDF inspection
+class PdfStructureError(ValueError):
+    """The cross-reference structure couldn't be followed without a full parse"""
 
-@app.get("/api/history")
-async def get_file_history(current_user: User = Depends(get_current_active_user)):
-    # Get the user's file history
-    cursor = db.uploads.find({
-        "user_email": current_user.email
-    }).sort("created_at", -1)
-    
-    history = []
-    async for file in cursor:
-        history.append({
-            "file_id": file.get("file_id"),
-            "original_filename": file.get("original_filename"),
-            "book_size": file.get("book_size"),
-            "font": file.get("font"),
-            "genre": GENRE_OPTIONS[file.get("genre")]["name"],
-            "status": file.get("status"),
-            "created_at": file.get("created_at").isoformat() if file.get("created_at") else None
-        })
-    
-    return history
+class PdfInspector:
+    """
+    Reads a PDF's header, trailer and page-tree count straight from a memory map.
+    Only the last kilobytes, the cross-reference entries for the catalog and page
+    tree root, and those two objects are touched, so the cost doesn't grow with
+    the size of the file.
+    """
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
+    TAIL_BYTES = 2048
+    OBJECT_WINDOW = 64 * 1024
+    MAX_STREAM_BYTES = 32 * 1024 * 1024  # Decoded size of an xref or object stream
+    # A name ends at whitespace or a delimiter, so /Length doesn't match /Length1
+    NAME_END = rb"(?![^\x00\t\n\x0c\r /<>\[\](){}%])"
+    XREF_ENTRY = re.compile(rb"(\d{10})[ ](\d{5})[ ]([nf])")
+    OBJECT_HEADER = re.compile(rb"\s*(\d+)\s+(\d+)\s+obj\b")
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self._file = open(self.path, "rb")
+        self.data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._sections = []
+        self._object_streams = {}
+        return self
+
+    def __exit__(self, *exc):
+        self.data.close()
+        self._file.close()
+
+    def version(self):
+        match = re.search(rb"%PDF-(\d\.\d)", self.data[:1024])
+        if not match:
+            raise ValueError("File is not a valid PDF - missing PDF signature")
+        return match.group(1).decode()
+
+    def page_count(self):
+        root = self._ref(self.trailer(), b"Root")
+        pages = self._ref(self.object(*root), b"Pages")
+        count = self._value(self.object(*pages), b"Count")
+        if count is None:
+            raise PdfStructureError("Page tree has no /Count")
+        return count
+
+    def trailer(self):
+        return self._section(self._startxref())["trailer"]
+
+    @staticmethod
+    def _dictionary(data, start):
+        """The << ... >> dictionary beginning at or after `start`"""
+        start = data.find(b"<<", start)
+        if start < 0:
+            raise PdfStructureError("Expected a dictionary")
+        depth, position = 0, start
+        while position < len(data) - 1:
+            pair = data[position:position + 2]
+            if pair == b"<<":
+                depth += 1
+                position += 2
+            elif pair == b">>":
+                depth -= 1
+                position += 2
+                if depth == 0:
+                    return bytes(data[start:position])
+            else:
+                position += 1
+        raise PdfStructureError("Unterminated dictionary")
+
+    def _ref(self, dictionary, key):
+        match = re.search(rb"/" + key + self.NAME_END + rb"\s*(\d+)\s+(\d+)\s+R", dictionary)
+        if not match:
+            raise PdfStructureError(f"Missing /{key.decode()} reference")
+        return int(match.group(1)), int(match.group(2))
+
+    def _value(self, dictionary, key):
+        """An integer entry, following it if it's an indirect reference"""
+        try:
+            number, generation = self._ref(dictionary, key)
+            return int(self.object(number, generation).split()[0])
+        except PdfStructureError:
+            pass
+        match = re.search(rb"/" + key + self.NAME_END + rb"\s*(-?\d+)", dictionary)
+        return int(match.group(1)) if match else None
+
+    def _array(self, dictionary, key):
+        match = re.search(rb"/" + key + self.NAME_END + rb"\s*\[([^\]]*)\]", dictionary)
+        return [int(value) for value in match.group(1).split()] if match else None
+
+    def _startxref(self):
+        tail_start = max(0, len(self.data) - self.TAIL_BYTES)
+        position = self.data.rfind(b"startxref", tail_start)
+        if position < 0:
+            raise PdfStructureError("No startxref")
+        match = re.match(rb"startxref\s+(\d+)", self.data[position:position + 40])
+        if not match or int(match.group(1)) >= len(self.data):
+            raise PdfStructureError("Bad startxref offset")
+        return int(match.group(1))
+
+    def _section(self, offset):
+        """Parse the cross-reference section header at `offset` (table or stream), without reading its entries"""
+        for section in self._sections:
+            if section["offset"] == offset:
+                return section
+        if self.data[offset:offset + 4] == b"xref":
+            section = self._table_section(offset)
+        else:
+            section = self._stream_section(offset)
+        section["offset"] = offset
+        self._sections.append(section)
+        return section
+
+    def _table_section(self, offset):
+        subsections = []
+        position = offset + 4
+        while True:
+            match = re.match(rb"\s*(\d+)\s+(\d+)[ \t]*\r?\n?", self.data[position:position + 64])
+            if not match:
+                break
+            first, count = int(match.group(1)), int(match.group(2))
+            entries_start = position + match.end()
+            # Entries are exactly 20 bytes, so a single entry can be read without scanning the table
+            if not self.XREF_ENTRY.match(self.data[entries_start:entries_start + 20]) and count:
+                raise PdfStructureError("Malformed xref table")
+            subsections.append((first, count, entries_start))
+            position = entries_start + count * 20
+        if self.data.find(b"trailer", position, position + 64) < 0:
+            raise PdfStructureError("Missing trailer")
+        return {"kind": "table", "subsections": subsections, "trailer": self._dictionary(self.data, position)}
+
+    def _stream_section(self, offset):
+        dictionary, data = self._stream(offset)
+        widths = self._array(dictionary, b"W")
+        size = self._value(dictionary, b"Size")
+        if not widths or len(widths) != 3 or size is None:
+            raise PdfStructureError("Malformed xref stream")
+        index = self._array(dictionary, b"Index") or [0, size]
+        return {
+            "kind": "stream",
+            "widths": widths,
+            "index": list(zip(index[::2], index[1::2])),
+            "entries": data,
+            "trailer": dictionary,
+        }
+
+    def _stream(self, offset):
+        """The dictionary and decoded data of the stream object at `offset`"""
+        header = self.OBJECT_HEADER.match(self.data, offset)
+        if not header:
+            raise PdfStructureError("Expected an object")
+        dictionary = self._dictionary(self.data, header.end())
+        length = self._value(dictionary, b"Length")
+        start = self.data.find(b"stream", header.end() + len(dictionary))
+        if length is None or start < 0:
+            raise PdfStructureError("Malformed stream")
+        start += 6
+        if self.data[start:start + 2] == b"\r\n":
+            start += 2
+        elif self.data[start:start + 1] in (b"\n", b"\r"):
+            start += 1
+        data = self.data[start:start + length]
+        if b"/FlateDecode" in dictionary:
+            decompressor = zlib.decompressobj()
+            data = decompressor.decompress(data, self.MAX_STREAM_BYTES)
+            if decompressor.unconsumed_tail:
+                raise PdfStructureError("Stream decodes to more than MAX_STREAM_BYTES")
+            if not decompressor.eof:
+                raise PdfStructureError("Truncated stream")
+        elif b"/Filter" in dictionary:
+            raise PdfStructureError("Unsupported stream filter")
+        predictor = self._value(dictionary, b"Predictor") or 1
+        if predictor >= 10:
+            data = self._png_unpredict(data, self._value(dictionary, b"Columns") or 1)
+        elif predictor != 1:
+            raise PdfStructureError("Unsupported stream predictor")
+        return dictionary, data
+
+    @staticmethod
+    def _png_unpredict(data, columns):
+        rows, previous = [], bytes(columns)
+        for start in range(0, len(data), columns + 1):
+            kind, row = data[start], data[start + 1:start + 1 + columns]
+            if kind == 2:
+                row = bytes((a + b) & 0xFF for a, b in zip(row, previous))
+            elif kind != 0:
+                raise PdfStructureError("Unsupported PNG predictor")
+            rows.append(row)
+            previous = row
+        return b"".join(rows)
+
+    def _lookup(self, section, number):
+        """The (type, field2, field3) entry for an object in one section, or None"""
+        if section["kind"] == "table":
+            for first, count, entries_start in section["subsections"]:
+                if first <= number < first + count:
+                    match = self.XREF_ENTRY.match(self.data, entries_start + (number - first) * 20)
+                    if not match:
+                        raise PdfStructureError("Malformed xref entry")
+                    return (1 if match.group(3) == b"n" else 0), int(match.group(1)), int(match.group(2))
+            return None
+        widths, skipped = section["widths"], 0
+        for first, count in section["index"]:
+            if first <= number < first + count:
+                row_size = sum(widths)
+                row = section["entries"][(skipped + number - first) * row_size:][:row_size]
+                fields, position = [], 0
+                for width in widths:
+                    fields.append(int.from_bytes(row[position:position + width], "big"))
+                    position += width
+                if widths[0] == 0:
+                    fields[0] = 1
+                return tuple(fields)
+            skipped += count
+        return None
+
+    def _entry(self, number):
+        """Find an object's entry, newest section first, following /XRefStm and /Prev"""
+        pending, seen = [self._startxref()], set()
+        while pending:
+            offset = pending.pop(0)
+            if offset in seen:
+                continue
+            seen.add(offset)
+            section = self._section(offset)
+            entry = self._lookup(section, number)
+            if entry is not None:
+                return entry
+            for key in (b"XRefStm", b"Prev"):
+                linked = self._value(section["trailer"], key)
+                if linked is not None:
+                    pending.append(linked)
+        raise PdfStructureError(f"Object {number} is not in the xref")
+
+    def object(self, number, generation=0):
+        """The body of an indirect object, from its header to the end of its dictionary or value"""
+        kind, field2, field3 = self._entry(number)
+        if kind == 1:
+            header = self.OBJECT_HEADER.match(self.data, field2)
+            if not header or int(header.group(1)) != number:
+                raise PdfStructureError(f"Object {number} is not at its xref offset")
+            window = self.data[header.end():header.end() + self.OBJECT_WINDOW]
+        elif kind == 2:
+            window = self._compressed_object(field2, field3)
+        else:
+            raise PdfStructureError(f"Object {number} is free")
+        if window.lstrip().startswith(b"<<"):
+            return self._dictionary(window, 0)
+        return bytes(window.split(b"endobj")[0])
+
+    def _compressed_object(self, stream_number, index):
+        if stream_number not in self._object_streams:
+            kind, offset, _ = self._entry(stream_number)
+            if kind != 1:
+                raise PdfStructureError("Object stream is not a plain object")
+            dictionary, data = self._stream(offset)
+            first, count = self._value(dictionary, b"First"), self._value(dictionary, b"N")
+            if first is None or count is None:
+                raise PdfStructureError("Malformed object stream")
+            pairs = [int(value) for value in data[:first].split()[:2 * count]]
+            self._object_streams[stream_number] = (data, first, pairs[1::2])
+        data, first, offsets = self._object_streams[stream_number]
+        end = offsets[index + 1] + first if index + 1 < len(offsets) else len(data)
+        return data[first + offsets[index]:end]
+
+@tracer.traced("pdf.inspect")
+def inspect_pdf(input_path):
+    """
+    Validate a PDF and count its pages from the cross-reference data alone, only
+    falling back to a full PyPDF2 parse when that structure is broken.
+    """
+    with PdfInspector(input_path) as inspector:
+        version = inspector.version()
+        try:
+            return {"version": version, "page_count": inspector.page_count(), "method": "xref"}
+        except (PdfStructureError, zlib.error, IndexError, ValueError) as structure_err:
+            logger.info(f"Falling back to a full parse of {Path(input_path).name}: {str(structure_err)}")
+    
+    try:
+        page_count = len(PyPDF2.PdfReader(str(input_path)).pages)
+    except Exception as pdf_err:
+        # If PyPDF2 fails but file has PDF signature, assume it's valid but damaged
+        logger.warning(f"PyPDF2 couldn't fully parse PDF: {str(pdf_err)}")
+        page_count = 1  # Assume at least one page
+    return {"version": version, "page_count": page_count, "method": "full"}
+
+# PDF size optimization
+DEDUPE_OBJECT_TYPES = ("/Font", "/FontDescriptor", "/XObject", "/ExtGState")
+
+def _replace_references(obj, replacements, writer):
+    if isinstance(obj, IndirectObject):
+        if obj.idnum in replacements:
+            return IndirectObject(replacements[obj.idnum], 0, writer)
+        return obj
+    if isinstance(obj, DictionaryObject):
+        for key, value in list(obj.items()):
+            obj[key] = _replace_references(value, replacements, writer)
+    elif isinstance(obj, ArrayObject):
+        for index, value in enumerate(obj):
+            obj[index] = _replace_references(value, replacements, writer)
+    return obj
+
+def _dedupe_pdf_objects(writer):
+    """Collapse byte-identical streams, fonts and images onto one copy; returns objects removed"""
+    removed = 0
+    while True:
+        # Merging streams can make the dictionaries that point at them identical, so repeat
+        canonical = {}
+        replacements = {}
+        for idnum, obj in enumerate(writer._objects, start=1):
+            if isinstance(obj, StreamObject):
+                data = obj._data
+            elif isinstance(obj, DictionaryObject) and obj.get("/Type") in DEDUPE_OBJECT_TYPES:
+                data = b""
+            else:
+                continue
+            serialized = io.BytesIO()
+            DictionaryObject({k: v for k, v in obj.items() if k != "/Length"}).write_to_stream(serialized, None)
+            key = hashlib.sha256(serialized.getvalue() + b"\0" + data).digest()
+            if key in canonical:
+                replacements[idnum] = canonical[key]
+            else:
+                canonical[key] = idnum
+        if not replacements:
+            return removed
+        for idnum in replacements:
+            writer._objects[idnum - 1] = NullObject()
+        for obj in writer._objects:
+            _replace_references(obj, replacements, writer)
+        writer._root_object = _replace_references(writer._root_object, replacements, writer)
+        removed += len(replacements)
+
+def optimize_pdf(input_path, output_path):
+    """Rewrite a PDF with Flate-compressed streams and a single copy of each identical object"""
+    reader = PyPDF2.PdfReader(str(input_path))
+    writer = PyPDF2.PdfWriter()
+    for page in reader.pages:
+        writer.add_page(page)
+    if reader.metadata:
+        writer.add_metadata(reader.metadata)
+    
+    removed = _dedupe_pdf_objects(writer)
+    for obj in writer._objects:
+        if isinstance(obj, StreamObject) and "/Filter" not in obj:
+            obj._data = zlib.compress(obj._data, 9)
+            obj[NameObject("/Filter")] = NameObject("/FlateDecode")
+    
+    with open(output_path, "wb") as f:
+        writer.write(f)
+    return removed
+
+@tracer.traced("export_output")
+def export_output(output_path, export_profile):
+    """Apply the export profile to a finished output and report its size before and after"""
+    output_path = Path(output_path)
+    profile = EXPORT_PROFILES[export_profile]
+    bytes_before = output_path.stat().st_size
+    stats = {"profile": export_profile, "bytes_before": bytes_before, "bytes_after": bytes_before}
+    if output_path.suffix != ".pdf" or not profile["optimize"]:
+        return stats
+    
+    optimized_path = output_path.with_name(f"{output_path.stem}_optimized.pdf")
+    try:
+        stats["objects_deduplicated"] = optimize_pdf(output_path, optimized_path)
+        linearized = False
+        if profile["linearize"]:
+            stats["linearized"] = False
+            if pikepdf is None:
+                logger.warning("pikepdf is not installed; skipping PDF linearization")
+                stats["linearize_skipped"] = "PDF linearization is not available on this server"
+            else:
+                with pikepdf.open(optimized_path, allow_overwriting_input=True) as pdf:
+                    pdf.save(
+                        optimized_path,
+                        linearize=True,
+                        compress_streams=True,
+                        object_stream_mode=pikepdf.ObjectStreamMode.generate
+                    )
+                linearized = True
+        # Never ship something bigger than what we started with
+        if optimized_path.stat().st_size < bytes_before:
+            os.replace(optimized_path, output_path)
+            if linearized:
+                stats["linearized"] = True
+        elif linearized:
+            stats["linearize_skipped"] = "The linearized file was larger than the original"
+    except Exception as e:
+        logger.error(f"Error optimizing PDF {output_path}: {str(e)}")
+    finally:
+        optimized_path.unlink(missing_ok=True)
+    
+    stats["bytes_after"] = output_path.stat().st_size
+    logger.info(f"Exported {output_path.name} with '{export_profile}' profile: {bytes_before} -> {stats['bytes_after']} bytes")
+    return stats
+
+# Parsed manuscript representation
+#
+# A manuscript is a plain dict that serializes compactly to JSON:
+#   {"version": 2, "source": "docx" | "pdf",
+#    "paragraphs": [{"style": "Heading1" | None, "align": "center" | None,
+#                    "runs": [[text, flags], ...]}, ...],
+#    "layout": ["images", "tables", ...]}
+# where flags is a bitmask of RUN_BOLD, RUN_ITALIC and RUN_UNDERLINE, and layout
+# lists the parts of a DOCX source the paragraphs don't carry (see DOCX_LAYOUT_TAGS).
+MANUSCRIPT_VERSION = 2
+RUN_BOLD = 1
+RUN_ITALIC = 2
+RUN_UNDERLINE = 4
+
+W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+CHAPTER_HEADING_RE = re.compile(r"^(chapter|part|book|prologue|epilogue)\b", re.IGNORECASE)
+
+# A DOCX with any of these can't be rebuilt from its paragraphs without losing them
+DOCX_LAYOUT_TAGS = {
+    W_NS + "tbl": "tables",
+    W_NS + "drawing": "images",
+    W_NS + "pict": "images",
+    W_NS + "object": "images",
+    W_NS + "footnoteReference": "notes",
+    W_NS + "endnoteReference": "notes",
+}
+DOCX_LAYOUT_PARTS = {"word/media/": "images", "word/header": "headers_footers", "word/footer": "headers_footers"}
+# Section settings beyond the trim size and margins that formatting sets
+DOCX_SECTION_SETTINGS = ("titlePg", "pgNumType", "lnNumType", "vAlign", "textDirection")
+
+parsed_manuscripts = OrderedDict()
+parse_cache_stats = {"hits": 0, "misses": 0}
+
+def paragraph_text(paragraph):
+    return "".join(text for text, _ in paragraph["runs"])
+
+def is_heading(paragraph):
+    style = paragraph.get("style") or ""
+    if style.startswith("Heading") or style in ("Title", "Subtitle"):
+        return True
+    text = paragraph_text(paragraph).strip()
+    return len(text) < 80 and bool(CHAPTER_HEADING_RE.match(text))
+
+def _docx_flag(rpr, tag):
+    element = rpr.find(W_NS + tag)
+    if element is None:
+        return False
+    value = element.get(W_NS + "val", "true")
+    return value not in ("0", "false", "none")
+
+def docx_part_layout(part_names):
+    return {
+        feature for name in part_names for prefix, feature in DOCX_LAYOUT_PARTS.items()
+        if name.lstrip("/").startswith(prefix)
+    }
+
+def _is_custom_section(section_properties):
+    columns = section_properties.find(W_NS + "cols")
+    if columns is not None and columns.get(W_NS + "num", "1") not in ("", "0", "1"):
+        return True
+    size = section_properties.find(W_NS + "pgSz")
+    if size is not None and size.get(W_NS + "orient") == "landscape":
+        return True
+    return any(section_properties.find(W_NS + setting) is not None for setting in DOCX_SECTION_SETTINGS)
+
+def _docx_paragraphs(elements, layout=None, clear=False):
+    """
+    Convert the w:p elements among `elements` (in end-tag order) to manuscript paragraphs,
+    adding what else the document has to `layout` on the way
+    """
+    sections = 0
+    for element in elements:
+        if layout is not None:
+            feature = DOCX_LAYOUT_TAGS.get(element.tag)
+            if feature is not None:
+                layout.add(feature)
+            elif element.tag == W_NS + "sectPr":
+                sections += 1
+                if sections > 1 or _is_custom_section(element):
+                    layout.add("sections")
+        if element.tag != W_NS + "p":
+            continue
+        style = align = None
+        ppr = element.find(W_NS + "pPr")
+        if ppr is not None:
+            style_el = ppr.find(W_NS + "pStyle")
+            align_el = ppr.find(W_NS + "jc")
+            style = style_el.get(W_NS + "val") if style_el is not None else None
+            align = align_el.get(W_NS + "val") if align_el is not None else None
+        runs = []
+        for run in element.iter(W_NS + "r"):
+            pieces = []
+            for child in run:
+                if child.tag == W_NS + "t":
+                    pieces.append(child.text or "")
+                elif child.tag == W_NS + "tab":
+                    pieces.append("\t")
+                elif child.tag in (W_NS + "br", W_NS + "cr"):
+                    pieces.append("\n")
+            if not pieces:
+                continue
+            flags = 0
+            rpr = run.find(W_NS + "rPr")
+            if rpr is not None:
+                flags |= RUN_BOLD if _docx_flag(rpr, "b") else 0
+                flags |= RUN_ITALIC if _docx_flag(rpr, "i") else 0
+                flags |= RUN_UNDERLINE if _docx_flag(rpr, "u") else 0
+            runs.append(["".join(pieces), flags])
+        if clear:
+            element.clear()
+        yield {"style": style, "align": align, "runs": runs}
+
+def iter_docx_paragraphs(input_path, layout=None):
+    """Stream paragraphs out of word/document.xml without building the whole document"""
+    with zipfile.ZipFile(input_path) as package:
+        if layout is not None:
+            layout.update(docx_part_layout(package.namelist()))
+        with package.open("word/document.xml") as document_xml:
+            elements = (element for _, element in ET.iterparse(document_xml, events=("end",)))
+            yield from _docx_paragraphs(elements, layout, clear=True)
+
+def manuscript_from_document(doc):
+    """Parse an already loaded python-docx Document, before anything has changed it"""
+    layout = docx_part_layout(str(part.partname) for part in doc.part.package.iter_parts())
+    elements = (element for _, element in etree.iterwalk(doc.element.body, events=("end",)))
+    return {
+        "version": MANUSCRIPT_VERSION,
+        "source": "docx",
+        "paragraphs": list(_docx_paragraphs(elements, layout)),
+        "layout": sorted(layout)
+    }
+
+def paragraphs_from_page_texts(page_texts):
+    """Re-join extracted lines into paragraphs across page boundaries"""
+    pending = []
+    for text in page_texts:
+        lines = [line.strip() for line in (text or "").split("\n")]
+        full_width = max((len(line) for line in lines), default=0)
+        for line in lines:
+            if not line:
+                if pending:
+                    yield {"style": None, "align": None, "runs": [[" ".join(pending), 0]]}
+                    pending = []
+                continue
+            pending.append(line)
+            # A short line ends its paragraph; a full one continues (even onto the next page)
+            if len(line) < full_width * 0.75:
+                yield {"style": None, "align": None, "runs": [[" ".join(pending), 0]]}
+                pending = []
+    if pending:
+        yield {"style": None, "align": None, "runs": [[" ".join(pending), 0]]}
+
+def _extract_pdf_pages(input_path, start, stop):
+    """Extract the text of pages [start, stop) with pdfplumber, timing each page"""
+    pages = []
+    with pdfplumber.open(input_path, pages=range(start + 1, stop + 1)) as pdf:
+        for page in pdf.pages:
+            started = time.perf_counter()
+            text = page.extract_text()
+            page.close()  # Drop the page's parsed layout objects
+            pages.append((text, (time.perf_counter() - started) * 1000))
+    return pages
+
+def pdf_page_ranges(page_count, workers):
+    """Split pages into contiguous ranges, a few per worker so a slow range doesn't hold up the rest"""
+    range_count = min(page_count, workers * EXTRACT_RANGES_PER_WORKER)
+    bounds = [page_count * index // range_count for index in range(range_count + 1)]
+    return list(zip(bounds, bounds[1:]))
+
+def extract_pdf_page_texts(input_path):
+    """
+    Return the text of every page in order. Long PDFs are split into page ranges
+    extracted in parallel by the render workers, each opening the file itself.
+    """
+    with tracer.span("pdf.extract") as span:
+        page_count = inspect_pdf(input_path)["page_count"]
+        if RENDER_WORKERS > 1 and page_count >= PARALLEL_EXTRACT_MIN_PAGES:
+            ranges = pdf_page_ranges(page_count, RENDER_WORKERS)
+            pool = get_render_pool()
+            futures = [
+                pool.submit(traced_call, tracer.inject(), "pdf.extract_range", _extract_pdf_pages, input_path, start, stop)
+                for start, stop in ranges
+            ]
+            pages = [page for future in futures for page in pool_result(future.result())]
+        else:
+            ranges = [(0, page_count)]
+            pages = _extract_pdf_pages(input_path, 0, page_count)
+        
+        page_ms = [round(ms, 1) for _, ms in pages]
+        slowest = sorted(range(len(page_ms)), key=lambda index: -page_ms[index])[:5]
+        span.set_attribute("pages", len(pages))
+        span.set_attribute("ranges", len(ranges))
+        span.set_attribute("page_ms", page_ms)
+        span.set_attribute("slowest_pages", [[index + 1, page_ms[index]] for index in slowest])
+        for index, ms in enumerate(page_ms):
+            if ms > SLOW_PDF_PAGE_MS:
+                logger.warning(f"Page {index + 1} of {Path(input_path).name} took {ms:.0f}ms to extract")
+        return [text for text, _ in pages]
+
+def iter_pdf_paragraphs(input_path):
+    """Extract text page by page with pdfplumber, which keeps reading order best"""
+    yield from paragraphs_from_page_texts(extract_pdf_page_texts(input_path))
+
+def iter_pdf_paragraphs_fast(input_path):
+    """Extract text with PyPDF2 - far quicker than pdfplumber, at some cost in layout fidelity"""
+    reader = PyPDF2.PdfReader(input_path)
+    yield from paragraphs_from_page_texts(page.extract_text() for page in reader.pages)
+
+def iter_manuscript_paragraphs(input_path, file_extension=None, fast=False):
+    """Lazily yield paragraphs from a path or, given `file_extension`, a file-like object"""
+    if (file_extension or Path(input_path).suffix.lower()) == ".pdf":
+        return iter_pdf_paragraphs_fast(input_path) if fast else iter_pdf_paragraphs(input_path)
+    return iter_docx_paragraphs(input_path)
+
+@tracer.traced("parse_manuscript")
+def parse_manuscript(input_path):
+    """Parse a DOCX or PDF into the compact manuscript representation"""
+    source = Path(input_path).suffix.lower().lstrip(".")
+    layout = set()
+    if source == "docx":
+        paragraphs = list(iter_docx_paragraphs(input_path, layout))
+    else:
+        paragraphs = list(iter_manuscript_paragraphs(input_path))
+    return {
+        "version": MANUSCRIPT_VERSION,
+        "source": source,
+        "paragraphs": paragraphs,
+        "layout": sorted(layout)
+    }
+
+def _remember_manuscript(key, manuscript):
+    parsed_manuscripts[key] = manuscript
+    parsed_manuscripts.move_to_end(key)
+    while len(parsed_manuscripts) > PARSE_CACHE_SIZE:
+        parsed_manuscripts.popitem(last=False)
+
+def cache_manuscript(key, manuscript):
+    """Store a parsed manuscript in memory and gzipped on disk"""
+    cache_path = PARSE_CACHE_DIR / f"{key}.json.gz"
+    tmp_path = cache_path.with_suffix(".tmp")
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+        json.dump(manuscript, f, separators=(",", ":"))
+    os.replace(tmp_path, cache_path)
+    _remember_manuscript(key, manuscript)
+
+def cached_manuscript(key):
+    """Return the parsed manuscript for `key` from memory or disk, or None if it isn't cached"""
+    manuscript = parsed_manuscripts.get(key)
+    if manuscript is not None:
+        parsed_manuscripts.move_to_end(key)
+        parse_cache_stats["hits"] += 1
+        return manuscript
+    
+    cache_path = PARSE_CACHE_DIR / f"{key}.json.gz"
+    try:
+        with gzip.open(cache_path, "rt", encoding="utf-8") as f:
+            manuscript = json.load(f)
+        if manuscript.get("version") == MANUSCRIPT_VERSION:
+            parse_cache_stats["hits"] += 1
+            _remember_manuscript(key, manuscript)
+            return manuscript
+    except (OSError, ValueError):
+        pass
+    return None
+
+def is_manuscript_cached(key):
+    return key in parsed_manuscripts or (PARSE_CACHE_DIR / f"{key}.json.gz").exists()
+
+def load_manuscript(key, input_path):
+    """Return the parsed manuscript for `key`, parsing `input_path` only on a cache miss"""
+    manuscript = cached_manuscript(key)
+    if manuscript is not None:
+        return manuscript
+    
+    parse_cache_stats["misses"] += 1
+    input_path = ensure_input_file(input_path)
+    if not input_path.exists():
+        raise ValueError("The original upload is no longer available. Please upload the file again.")
+    try:
+        manuscript = parse_manuscript(input_path)
+    except (zipfile.BadZipFile, KeyError, ET.ParseError) as parse_err:
+        raise ValueError(f"The original file could not be parsed: {str(parse_err)}")
+    cache_manuscript(key, manuscript)
+    return manuscript
+
+DOCX_ALIGNMENTS = {
+    "center": WD_ALIGN_PARAGRAPH.CENTER,
+    "right": WD_ALIGN_PARAGRAPH.RIGHT,
+    "end": WD_ALIGN_PARAGRAPH.RIGHT,
+    "both": WD_ALIGN_PARAGRAPH.JUSTIFY,
+}
+
+# Chapter-parallel rendering
+_render_pool = None
+
+def get_render_pool():
+    global _render_pool
+    if _render_pool is None:
+        _render_pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS, initializer=font_registry.load)
+    return _render_pool
+
+def is_chapter_start(paragraph):
+    style = paragraph.get("style") or ""
+    if style in ("Heading1", "Title"):
+        return True
+    text = paragraph_text(paragraph).strip()
+    return len(text) < 80 and bool(CHAPTER_HEADING_RE.match(text))
+
+def split_chapters(paragraphs):
+    """Split paragraphs into chapters; front matter before the first heading is its own chunk"""
+    chapters = [[]]
+    for paragraph in paragraphs:
+        if is_chapter_start(paragraph) and chapters[-1]:
+            chapters.append([])
+        chapters[-1].append(paragraph)
+    return [chapter for chapter in chapters if chapter]
+
+def should_render_in_parallel(paragraphs, chapters):
+    return (
+        RENDER_WORKERS > 1
+        and len(chapters) > 1
+        and len(paragraphs) >= PARALLEL_RENDER_MIN_PARAGRAPHS
+    )
+
+# Incremental re-rendering
+#
+# Outputs are rendered in chunks - chapters for PDFs, content-defined blocks of
+# paragraphs for DOCX - each stored under a hash of its content and everything
+# else it was rendered from. A revised manuscript is linked to the user's
+# previous upload of the same title and reuses the chunks that upload rendered,
+# so only changed chunks are rendered again. Chunks are only kept for uploads
+# that are part of a revision chain - a revision of an earlier upload, or a file
+# named as one ("draft", "v1", ...) - so one-off uploads write nothing extra.
+REVISION_SUFFIX_RE = re.compile(
+    r"[\s_.-]*(v(er(sion)?)?[\s_.-]*\d+|rev(ision)?[\s_.-]*\d*|draft[\s_.-]*\d*|final|edited|copy|\(\d+\))$",
+    re.IGNORECASE
+)
+
+def manuscript_title(filename):
+    """Title used to link revisions of a manuscript, e.g. "My Novel v3 (2).docx" -> "my novel" """
+    title = Path(filename).stem.strip()
+    while True:
+        stripped = REVISION_SUFFIX_RE.sub("", title)
+        if stripped == title or not stripped:
+            return title.lower()
+        title = stripped
+
+def is_revision_name(filename):
+    """Whether a filename marks a version of a manuscript, e.g. "My Novel draft.docx" """
+    return manuscript_title(filename) != Path(filename).stem.strip().lower()
+
+def content_defined_blocks(items, text_of, average=DOCX_BLOCK_PARAGRAPHS):
+    """
+    Group items into blocks that end after a paragraph whose text hash picks it as
+    a boundary, so inserting or deleting a paragraph only changes its own block
+    """
+    block = []
+    for item in items:
+        block.append(item)
+        if zlib.crc32(text_of(item).encode()) % average == 0 or len(block) >= average * 4:
+            yield block
+            block = []
+    if block:
+        yield block
+
+def _write_chunk(path, write):
+    tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+class RenderChunks:
+    """The chunks making up one output; only those rendered for the previous version are reused"""
+
+    def __init__(self, reusable=()):
+        self.reusable = set(reusable)
+        self.keys = []
+        self.reused = 0
+        self.paragraphs = 0
+        self.paragraphs_reused = 0
+
+    @staticmethod
+    def params(kind, book_size, font, genre, template):
+        """Everything apart from the content that a rendered chunk depends on"""
+        return json.dumps([
+            kind, MANUSCRIPT_VERSION, book_size, font_registry.resolve(font),
+            GENRE_OPTIONS[genre], formatting_profiles.templates[template]
+        ], sort_keys=True, default=str)
+
+    @staticmethod
+    def key(params, content):
+        return hashlib.sha256(params.encode() + b"\0" + content).hexdigest()
+
+    @staticmethod
+    def path(key, suffix):
+        return CHUNKS_DIR / f"{key}{suffix}"
+
+    def lookup(self, key, suffix):
+        """Path of a reusable chunk, or None if it has to be rendered"""
+        if key not in self.reusable:
+            return None
+        path = self.path(key, suffix)
+        try:
+            os.utime(path)  # Keep it from being swept while revisions keep using it
+        except OSError:
+            return None
+        return path
+
+    def count(self, key, paragraph_count, reused):
+        self.keys.append(key)
+        self.paragraphs += paragraph_count
+        if reused:
+            self.reused += 1
+            self.paragraphs_reused += paragraph_count
+
+    def load_xml(self, key, paragraph_count):
+        """Reuse a block of rendered WordprocessingML paragraphs, or None (counting the block either way)"""
+        xml_paragraphs = None
+        path = self.lookup(key, ".xml.gz")
+        if path is not None:
+            try:
+                with gzip.open(path, "rt", encoding="utf-8") as f:
+                    xml_paragraphs = json.load(f)
+            except (OSError, ValueError):
+                pass
+        self.count(key, paragraph_count, reused=xml_paragraphs is not None)
+        return xml_paragraphs
+
+    def store_xml(self, key, xml_paragraphs):
+        def write(tmp_path):
+            with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+                json.dump(xml_paragraphs, f, separators=(",", ":"))
+        _write_chunk(self.path(key, ".xml.gz"), write)
+
+    def stats(self):
+        return {
+            "chunks": len(self.keys),
+            "chunks_reused": self.reused,
+            "paragraphs": self.paragraphs,
+            "paragraphs_reused": self.paragraphs_reused,
+            "reused_fraction": round(self.paragraphs_reused / self.paragraphs, 4) if self.paragraphs else 0.0,
+        }
+
+def purge_stale_chunks():
+    """Delete rendered chunks no revision has used for CHUNK_TTL_DAYS"""
+    cutoff = time.time() - CHUNK_TTL_DAYS * 86400
+    removed = 0
+    for path in CHUNKS_DIR.iterdir():
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+                removed += 1
+        except OSError:
+            pass
+    return removed
+
+async def find_previous_version(user_email, title, file_extension, output_format="print"):
+    """The user's latest completed upload of the same title, whose rendered chunks a revision can reuse"""
+    # Only a direct upload with the same input type and output renders chunks of the same kind;
+    # reformats render in place and EPUB output has no chunks
+    return await db.uploads.find_one(
+        {
+            "user_email": user_email,
+            "title": title,
+            "status": "completed",
+            "source_file_id": {"$exists": False},
+            "original_filename": {"$regex": f"{re.escape(file_extension)}$", "$options": "i"},
+            "output_format": {"$in": [output_format, None]} if output_format == "print" else output_format
+        },
+        {"_id": 0, "file_id": 1, "chunks": 1},
+        sort=[("created_at", -1)]
+    )
+
+def format_docx_paragraph(paragraph, profile, heading=False):
+    if not paragraph.text.strip():
+        return  # Skip empty paragraphs
+    paragraph_format = paragraph.paragraph_format
+    paragraph_format.line_spacing = profile.line_spacing
+    if heading:
+        paragraph.alignment = profile.docx_heading_alignment
+    else:
+        paragraph_format.first_line_indent = profile.docx_first_line_indent
+        paragraph_format.space_after = profile.docx_paragraph_spacing
+        if profile.docx_body_alignment is not None and paragraph.alignment is None:
+            paragraph.alignment = profile.docx_body_alignment
+    for run in paragraph.runs:
+        run.font.name = profile.font
+        run.font.size = profile.docx_font_size
+
+def _format_docx_block(xml_paragraphs, headings, book_size, font, genre, template="standard"):
+    """Worker: format one block of an uploaded document's paragraphs, passed and returned as WordprocessingML"""
+    profile = formatting_profiles.get(genre, font, book_size, template)
+    formatted = []
+    for xml_paragraph, heading in zip(xml_paragraphs, headings):
+        paragraph = DocxParagraph(parse_xml(xml_paragraph), None)
+        format_docx_paragraph(paragraph, profile, heading=heading)
+        formatted.append(etree.tostring(paragraph._p, encoding="unicode"))
+    return formatted
+
+def _render_docx_chapter(paragraphs, book_size, font, genre, template="standard"):
+    """Worker: build one chapter's formatted paragraphs and return them as WordprocessingML"""
+    doc = docx.Document()
+    styles = {style.style_id: style for style in doc.styles}
+    profile = formatting_profiles.get(genre, font, book_size, template)
+    xml_paragraphs = []
+    for paragraph in paragraphs:
+        p = doc.add_paragraph()
+        if paragraph.get("style") in styles:
+            p.style = styles[paragraph["style"]]
+        if paragraph.get("align") in DOCX_ALIGNMENTS:
+            p.alignment = DOCX_ALIGNMENTS[paragraph["align"]]
+        for text, flags in paragraph["runs"]:
+            run = p.add_run(text)
+            run.bold = bool(flags & RUN_BOLD) or None
+            run.italic = bool(flags & RUN_ITALIC) or None
+            run.underline = bool(flags & RUN_UNDERLINE) or None
+        format_docx_paragraph(p, profile, heading=is_heading(paragraph))
+        xml_paragraphs.append(p._p.xml)
+    return xml_paragraphs
+
+@tracer.traced("render_docx")
+async def render_docx_manuscript(manuscript, output_path, book_size, font, genre, template="standard", chunks=None):
+    """
+    Build a formatted DOCX from a parsed manuscript, chapter by chapter - or, with
+    `chunks`, block by block, reusing blocks rendered for the previous version
+    """
+    paragraphs = manuscript["paragraphs"]
+    chapters = split_chapters(paragraphs)
+    parallel = should_render_in_parallel(paragraphs, chapters)
+    if chunks is None:
+        units, rendered = chapters, [None] * len(chapters)
+    else:
+        params = RenderChunks.params("docx", book_size, font, genre, template)
+        units = [block for chapter in chapters for block in content_defined_blocks(chapter, paragraph_text)]
+        keys = [RenderChunks.key(params, json.dumps(unit, separators=(",", ":")).encode()) for unit in units]
+        rendered = [chunks.load_xml(key, len(unit)) for key, unit in zip(keys, units)]
+    pending = [index for index, xml_paragraphs in enumerate(rendered) if xml_paragraphs is None]
+    
+    if parallel and len(pending) > 1:
+        loop = asyncio.get_running_loop()
+        pool = get_render_pool()
+        results = [pool_result(result) for result in await asyncio.gather(*(
+            loop.run_in_executor(
+                pool, traced_call, tracer.inject(), "render_chapter",
+                _render_docx_chapter, units[index], book_size, font, genre, template
+            )
+            for index in pending
+        ))]
+    else:
+        results = [_render_docx_chapter(units[index], book_size, font, genre, template) for index in pending]
+    for index, xml_paragraphs in zip(pending, results):
+        rendered[index] = xml_paragraphs
+        if chunks is not None:
+            chunks.store_xml(keys[index], xml_paragraphs)
+    
+    # Splice the chapters into the body in order, ahead of the final section properties
+    doc = docx.Document()
+    body = doc.element.body
+    for paragraph in list(body.iterchildren(qn("w:p"))):
+        body.remove(paragraph)
+    section_properties = body.find(qn("w:sectPr"))
+    for xml_paragraphs in rendered:
+        for xml_paragraph in xml_paragraphs:
+            element = parse_xml(xml_paragraph)
+            if section_properties is not None:
+                section_properties.addprevious(element)
+            else:
+                body.append(element)
+    apply_docx_page_setup(doc, formatting_profiles.get(genre, font, book_size, template))
+    doc.save(output_path)
+    return output_path
+
+def _pdf_markup(paragraph):
+    """Convert runs to ReportLab paragraph markup"""
+    parts = []
+    for text, flags in paragraph["runs"]:
+        text = escape(text).replace("\t", "    ").replace("\n", "<br/>")
+        if flags & RUN_BOLD:
+            text = f"<b>{text}</b>"
+        if flags & RUN_ITALIC:
+            text = f"<i>{text}</i>"
+        if flags & RUN_UNDERLINE:
+            text = f"<u>{text}</u>"
+        parts.append(text)
+    return "".join(parts)
+
+def _draw_page_number(canvas, number, page_width):
+    canvas.saveState()
+    canvas.setFont('Helvetica', 9)
+    canvas.drawCentredString(page_width / 2, 36, str(number))
+    canvas.restoreState()
+
+def _build_pdf(chapters, output_path, book_size, font, genre, template="standard", number_pages=True):
+    """Lay out chapters as a PDF in the selected trim size; each chapter starts a new page"""
+    profile = formatting_profiles.get(genre, font, book_size, template)
+    page_width = profile.page_size[0]
+    doc = SimpleDocTemplate(
+        str(output_path) if isinstance(output_path, (str, Path)) else output_path,
+        pagesize=profile.page_size,
+        **profile.pdf_margins
+    )
+    normal_style, heading_style = profile.pdf_normal_style, profile.pdf_heading_style
+    
+    content = []
+    for chapter in chapters:
+        if content:
+            content.append(PageBreak())
+        for paragraph in chapter:
+            if not paragraph_text(paragraph).strip():
+                continue
+            style = heading_style if is_heading(paragraph) else normal_style
+            content.append(Paragraph(_pdf_markup(paragraph), style))
+    if not content:
+        content.append(Spacer(1, 12))
+    
+    def on_page(canvas, doc):
+        _draw_page_number(canvas, canvas.getPageNumber(), page_width)
+    
+    if number_pages and profile.page_numbers:
+        doc.build(content, onFirstPage=on_page, onLaterPages=on_page)
+    else:
+        doc.build(content)
+    return output_path
+
+def _render_pdf_chapter(chapter, output_path, book_size, font, genre, template="standard"):
+    """Worker: render one chapter without page numbers - they are stamped after the merge"""
+    return _build_pdf([chapter], output_path, book_size, font, genre, template, number_pages=False)
+
+def _merge_pdf_chapters(chapter_paths, output_path, book_size, number_pages=True):
+    """Concatenate chapter PDFs in order and stamp continuous page numbers across them"""
+    writer = PyPDF2.PdfWriter()
+    for chapter_path in chapter_paths:
+        for page in PyPDF2.PdfReader(str(chapter_path)).pages:
+            writer.add_page(page)
+    if not number_pages:
+        with open(output_path, "wb") as f:
+            writer.write(f)
+        return output_path
+    
+    # Append a tiny content stream per page rather than merging overlay pages,
+    # which would decompress and rewrite every chapter's content
+    page_width = BOOK_SIZES[book_size][0] * 72
+    number_font = writer._add_object(DictionaryObject({
+        NameObject("/Type"): NameObject("/Font"),
+        NameObject("/Subtype"): NameObject("/Type1"),
+        NameObject("/BaseFont"): NameObject("/Helvetica"),
+    }))
+    save_state = StreamObject()
+    save_state._data = b"q\n"
+    save_state_ref = writer._add_object(save_state)
+    for number, page in enumerate(writer.pages, start=1):
+        label = str(number)
+        x = page_width / 2 - pdfmetrics.stringWidth(label, 'Helvetica', 9) / 2
+        number_stream = StreamObject()
+        number_stream._data = f"Q q BT /FPageNo 9 Tf {x:.2f} 36 Td ({label}) Tj ET Q\n".encode()
+        contents = page.get("/Contents")
+        if contents is None:
+            contents = ArrayObject()
+        elif not isinstance(contents.get_object(), ArrayObject):
+            contents = ArrayObject([contents])
+        else:
+            contents = ArrayObject(contents.get_object())
+        page[NameObject("/Contents")] = ArrayObject(
+            [save_state_ref, *contents, writer._add_object(number_stream)]
+        )
+        resources = page.setdefault(NameObject("/Resources"), DictionaryObject()).get_object()
+        fonts = resources.setdefault(NameObject("/Font"), DictionaryObject()).get_object()
+        fonts[NameObject("/FPageNo")] = number_font
+    
+    with open(output_path, "wb") as f:
+        writer.write(f)
+    return output_path
+
+@tracer.traced("render_pdf")
+async def render_pdf_manuscript(manuscript, output_path, book_size, font, genre, template="standard", chunks=None):
+    """
+    Lay out a parsed manuscript as a PDF, rendering chapters in parallel for long books.
+    With `chunks`, chapters are kept as chunks and those rendered for the previous version reused.
+    """
+    paragraphs = manuscript["paragraphs"]
+    chapters = split_chapters(paragraphs)
+    parallel = should_render_in_parallel(paragraphs, chapters)
+    if not parallel and (chunks is None or len(chapters) < 2):
+        return _build_pdf(chapters, output_path, book_size, font, genre, template)
+    
+    output_path = Path(output_path)
+    chapter_paths, pending = [], []
+    if chunks is None:
+        for index, chapter in enumerate(chapters):
+            chapter_paths.append(output_path.with_name(f"{output_path.stem}_chapter{index}.pdf"))
+            pending.append((chapter, chapter_paths[-1]))
+    else:
+        params = RenderChunks.params("pdf", book_size, font, genre, template)
+        for chapter in chapters:
+            key = RenderChunks.key(params, json.dumps(chapter, separators=(",", ":")).encode())
+            chapter_path = chunks.lookup(key, ".pdf")
+            chunks.count(key, len(chapter), reused=chapter_path is not None)
+            if chapter_path is None:
+                chapter_path = RenderChunks.path(key, ".pdf")
+                pending.append((chapter, chapter_path))
+            chapter_paths.append(chapter_path)
+    
+    # Chapters are rendered to temporary names so a shared chunk is never seen half-written
+    rendering = [
+        (chapter, chapter_path, chapter_path.with_name(f"{chapter_path.stem}.{uuid.uuid4().hex}.tmp.pdf"))
+        for chapter, chapter_path in pending
+    ]
+    try:
+        if parallel and len(rendering) > 1:
+            loop = asyncio.get_running_loop()
+            pool = get_render_pool()
+            for result in await asyncio.gather(*(
+                loop.run_in_executor(
+                    pool, traced_call, tracer.inject(), "render_chapter",
+                    _render_pdf_chapter, chapter, tmp_path, book_size, font, genre, template
+                )
+                for chapter, _, tmp_path in rendering
+            )):
+                pool_result(result)
+        else:
+            for chapter, _, tmp_path in rendering:
+                _render_pdf_chapter(chapter, tmp_path, book_size, font, genre, template)
+        for _, chapter_path, tmp_path in rendering:
+            os.replace(tmp_path, chapter_path)
+        number_pages = formatting_profiles.get(genre, font, book_size, template).page_numbers
+        return _merge_pdf_chapters(chapter_paths, output_path, book_size, number_pages)
+    finally:
+        for _, _, tmp_path in rendering:
+            tmp_path.unlink(missing_ok=True)
+        if chunks is None:
+            for chapter_path in chapter_paths:
+                chapter_path.unlink(missing_ok=True)
+
+
+# EPUB export
+EPUB_CONTAINER_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+"""
+
+def epub_stylesheet(font, genre, template="standard"):
+    """Reflowable CSS carrying the genre's type size and spacing and the template's paragraph style"""
+    genre_options = GENRE_OPTIONS[genre]
+    template_options = formatting_profiles.templates[template]
+    font_size_em = genre_options["font_size"] / 12
+    return f"""body {{
+  font-family: "{font}", serif;
+  font-size: {font_size_em:.3f}em;
+  line-height: {genre_options["line_spacing"]};
+  margin: 0 5%;
+}}
+p {{
+  margin: 0 0 {template_options["paragraph_spacing"] / genre_options["font_size"]:.3f}em 0;
+  text-indent: {template_options["first_line_indent"] / genre_options["font_size"]:.3f}em;
+  text-align: {"justify" if template_options["justify"] else "left"};
+}}
+h1, h2 {{
+  font-weight: bold;
+  text-align: {template_options["heading_alignment"]};
+  line-height: 1.2;
+  margin: 1.5em 0 1em 0;
+  page-break-after: avoid;
+}}
+h1 {{ font-size: {1 + template_options["heading_size_delta"] / genre_options["font_size"]:.3f}em; }}
+.u {{ text-decoration: underline; }}
+"""
+
+def _epub_markup(paragraph):
+    parts = []
+    for text, flags in paragraph["runs"]:
+        text = escape(text).replace("\t", " ").replace("\n", "<br/>")
+        if flags & RUN_BOLD:
+            text = f"<b>{text}</b>"
+        if flags & RUN_ITALIC:
+            text = f"<i>{text}</i>"
+        if flags & RUN_UNDERLINE:
+            text = f'<span class="u">{text}</span>'
+        parts.append(text)
+    return "".join(parts)
+
+def _epub_chapter_start(title):
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n<!DOCTYPE html>\n'
+        '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">\n'
+        f'<head><title>{escape(title)}</title>'
+        '<link rel="stylesheet" type="text/css" href="style.css"/></head>\n<body>\n'
+    )
+
+@tracer.traced("epub.write")
+def write_epub(paragraphs, output_path, title, font, genre, template="standard"):
+    """
+    Stream paragraphs into an EPUB 3 package, one XHTML file per chapter. Only the
+    chapter being written is held in memory; the manifest is written once all
+    chapters are known.
+    """
+    book_id = f"urn:uuid:{uuid.uuid4()}"
+    chapters = []  # (file name, title)
+    with zipfile.ZipFile(output_path, "w", zipfile.ZIP_DEFLATED) as epub:
+        # The mimetype entry must come first and be stored uncompressed
+        epub.writestr("mimetype", "application/epub+zip", zipfile.ZIP_STORED)
+        epub.writestr("META-INF/container.xml", EPUB_CONTAINER_XML)
+        epub.writestr("OEBPS/style.css", epub_stylesheet(font, genre, template))
+        
+        chapter = None
+        def close_chapter():
+            chapter.write(b"</body>\n</html>\n")
+            chapter.close()
+        
+        for paragraph in paragraphs:
+            text = paragraph_text(paragraph).strip()
+            if chapter is None or (is_chapter_start(paragraph) and chapters[-1][2]):
+                if chapter is not None:
+                    close_chapter()
+                name = f"chapter{len(chapters) + 1}.xhtml"
+                chapter_title = text if is_chapter_start(paragraph) else title
+                chapters.append([name, chapter_title, False])
+                chapter = epub.open(f"OEBPS/{name}", "w")
+                chapter.write(_epub_chapter_start(chapter_title).encode())
+            if not text:
+                continue
+            if is_heading(paragraph):
+                tag = "h1" if is_chapter_start(paragraph) else "h2"
+                chapter.write(f"<{tag}>{_epub_markup(paragraph)}</{tag}>\n".encode())
+            else:
+                chapter.write(f"<p>{_epub_markup(paragraph)}</p>\n".encode())
+                chapters[-1][2] = True  # Has body text, so the next chapter heading starts a new file
+        if chapter is None:
+            chapters.append(["chapter1.xhtml", title, False])
+            chapter = epub.open("OEBPS/chapter1.xhtml", "w")
+            chapter.write(_epub_chapter_start(title).encode())
+        close_chapter()
+        
+        nav_items = "\n".join(
+            f'      <li><a href="{name}">{escape(chapter_title)}</a></li>' for name, chapter_title, _ in chapters
+        )
+        epub.writestr("OEBPS/nav.xhtml", (
+            '<?xml version="1.0" encoding="UTF-8"?>\n<!DOCTYPE html>\n'
+            '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">\n'
+            f'<head><title>{escape(title)}</title></head>\n<body>\n'
+            f'  <nav epub:type="toc" id="toc">\n    <h1>Contents</h1>\n    <ol>\n{nav_items}\n    </ol>\n  </nav>\n'
+            '</body>\n</html>\n'
+        ))
+        
+        manifest = "\n".join(
+            f'    <item id="c{index}" href="{name}" media-type="application/xhtml+xml"/>'
+            for index, (name, _, _) in enumerate(chapters, start=1)
+        )
+        spine = "\n".join(f'    <itemref idref="c{index}"/>' for index in range(1, len(chapters) + 1))
+        epub.writestr("OEBPS/content.opf", f"""<?xml version="1.0" encoding="UTF-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="book-id">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:identifier id="book-id">{book_id}</dc:identifier>
+    <dc:title>{escape(title)}</dc:title>
+    <dc:language>en</dc:language>
+    <meta property="dcterms:modified">{datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")}</meta>
+  </metadata>
+  <manifest>
+    <item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>
+    <item id="css" href="style.css" media-type="text/css"/>
+{manifest}
+  </manifest>
+  <spine>
+{spine}
+  </spine>
+</package>
+""")
+    return output_path
+
+@tracer.traced("process_epub")
+def process_epub(input_path, file_id, font, genre, template="standard", title=None, cache_key=None):
+    """
+    Write an upload straight to EPUB. A cached parse is reused; otherwise the
+    paragraphs stream from the parser into the writer without being collected.
+    """
+    input_path = ensure_input_file(input_path)
+    if input_path.suffix.lower() == ".pdf":
+        try:
+            inspect_pdf(input_path)
+        except Exception as e:
+            raise ValueError(f"Invalid PDF file: {str(e)}")
+    
+    manuscript = cached_manuscript(cache_key or file_id)
+    paragraphs = manuscript["paragraphs"] if manuscript is not None else iter_manuscript_paragraphs(input_path)
+    output_path = TEMP_DIR / f"{file_id}_formatted.epub"
+    try:
+        write_epub(paragraphs, output_path, title or "Untitled", font, genre, template)
+    except (zipfile.BadZipFile, KeyError, ET.ParseError) as parse_err:
+        output_path.unlink(missing_ok=True)
+        raise ValueError(f"The file could not be parsed: {str(parse_err)}")
+    logger.info(f"Wrote EPUB {output_path.name} ({output_path.stat().st_size} bytes)")
+    return output_path
+
+# Fast first-pages preview
+preview_cache = OrderedDict()
+preview_stats = {"hits": 0, "misses": 0, "over_budget": 0, "rejected": 0, "timeouts": 0}
+
+def preview_paragraphs(source, file_extension, book_size, genre, pages):
+    """Read only as many paragraphs as could fill the first `pages` pages"""
+    width, height = BOOK_SIZES[book_size]
+    font_size = GENRE_OPTIONS[genre]["font_size"]
+    leading = font_size * GENRE_OPTIONS[genre]["line_spacing"]
+    # Generous estimate: assume narrow glyphs so we never stop reading too early
+    chars_per_line = (width * 72 - 144) / (font_size * 0.4)
+    lines_per_page = (height * 72 - 144) / leading
+    char_budget = chars_per_line * lines_per_page * pages
+    
+    paragraphs = []
+    chars = chapters = 0
+    for paragraph in iter_manuscript_paragraphs(source, file_extension, fast=True):
+        if is_chapter_start(paragraph):
+            chapters += 1
+            if chapters > pages:
+                break  # Chapters start on a new page, so this one can't be in the preview
+        paragraphs.append(paragraph)
+        chars += len(paragraph_text(paragraph))
+        if chars >= char_budget:
+            break
+    return paragraphs
+
+def render_preview(paragraphs, book_size, font, genre, template, pages):
+    buffer = io.BytesIO()
+    _build_pdf(split_chapters(paragraphs), buffer, book_size, font, genre, template)
+    reader = PyPDF2.PdfReader(buffer)
+    if len(reader.pages) <= pages:
+        return buffer.getvalue()
+    writer = PyPDF2.PdfWriter()
+    for page in reader.pages[:pages]:
+        writer.add_page(page)
+    trimmed = io.BytesIO()
+    writer.write(trimmed)
+    return trimmed.getvalue()
+
+def _preview_worker_init():
+    font_registry.load()
+    if resource is not None:
+        with open("/proc/self/statm") as f:
+            inherited = int(f.read().split()[0]) * resource.getpagesize()
+        memory_limit = inherited + JOB_MEMORY_MB * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+class PreviewRenderer:
+    """
+    A small pool of long-lived processes that only render previews, so a preview neither
+    forks a worker of its own nor queues behind formatting jobs. At most `workers` previews
+    render at once and `max_waiting` more may wait; a preview over `timeout` seconds has
+    the pool's processes killed and a fresh pool started.
+    """
+
+    def __init__(self, workers, max_waiting, timeout):
+        self.workers = workers
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self.pending = 0
+        self._pool = None
+        self._semaphore = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("fork"),
+                initializer=_preview_worker_init
+            )
+        return self._pool
+
+    async def render(self, *args):
+        if self.pending >= self.workers + self.max_waiting:
+            preview_stats["rejected"] += 1
+            raise rate_limited("Too many previews are being rendered. Please retry shortly.", 1)
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.workers)
+        self.pending += 1
+        try:
+            async with self._semaphore:
+                pool = self._get_pool()
+                future = asyncio.get_running_loop().run_in_executor(
+                    pool, traced_call, tracer.inject(), "preview", preview_job, *args
+                )
+                try:
+                    return pool_result(await asyncio.wait_for(future, self.timeout))
+                except asyncio.TimeoutError:
+                    preview_stats["timeouts"] += 1
+                    self.restart(pool)
+                    raise JobResourceLimitExceeded(
+                        f"The preview took longer than {self.timeout:g} seconds and was stopped. "
+                        "The document may be damaged or unusually complex."
+                    )
+                except MemoryError:
+                    raise JobResourceLimitExceeded(
+                        f"The preview needed more than {JOB_MEMORY_MB}MB of memory and was stopped. "
+                        "The document may be damaged or unusually complex."
+                    )
+                except BrokenProcessPool:
+                    self.restart(pool)
+                    raise RuntimeError("The preview worker stopped unexpectedly")
+        finally:
+            self.pending -= 1
+
+    def restart(self, pool):
+        """Kill `pool`'s processes - a stuck preview can't be cancelled - and start afresh next time"""
+        if self._pool is pool:
+            self._pool = None
+        for process in list((pool._processes or {}).values()):
+            process.kill()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+
+preview_renderer = PreviewRenderer(PREVIEW_WORKERS, PREVIEW_MAX_WAITING, PREVIEW_TIMEOUT_SECONDS)
+
+def preview_job(content, file_extension, book_size, font, genre, template, pages):
+    """Worker: read just enough of the manuscript and lay out its first `pages` pages"""
+    try:
+        paragraphs = preview_paragraphs(io.BytesIO(content), file_extension, book_size, genre, pages)
+    except Exception as e:
+        logger.error(f"Error reading manuscript for preview: {str(e)}")
+        raise ValueError("The file could not be read. Please upload a valid .docx or .pdf file.")
+    return render_preview(paragraphs, book_size, font, genre, template, pages)
+
+@app.post("/api/preview")
+async def preview_file(
+    file: UploadFile = File(...),
+    book_size: str = Form(...),
+    font: str = Form(...),
+    genre: str = Form(...),
+    template: str = Form("standard"),
+    pages: int = Form(3),
+    current_user: TokenData = Depends(get_current_active_claims)
+):
+    """
+    Lay out the first few pages of a manuscript with the chosen options and return them as a PDF.
+    Previews don't count against the monthly limit and don't wait behind formatting jobs.
+    """
+    started = time.perf_counter()
+    validate_format_options(book_size, font, genre, template)
+    await check_genre_allowed(current_user, genre)
+    if not 1 <= pages <= PREVIEW_MAX_PAGES:
+        raise HTTPException(status_code=400, detail=f"Pages must be between 1 and {PREVIEW_MAX_PAGES}.")
+    
+    file_extension = Path(file.filename).suffix.lower()
+    if file_extension not in [".docx", ".pdf"]:
+        raise HTTPException(status_code=400, detail="Unsupported file format. Please upload .docx or .pdf files only.")
+    
+    max_size_mb = 10
+    max_size_bytes = max_size_mb * 1024 * 1024
+    content = await file.read(max_size_bytes + 1)
+    if len(content) > max_size_bytes:
+        raise HTTPException(status_code=400, detail=f"File too large. Maximum size is {max_size_mb}MB.")
+    
+    if file_extension == ".docx":
+        validate_docx_upload(io.BytesIO(content))
+    
+    cache_key = (hashlib.sha256(content).hexdigest(), book_size, font, genre, template, formatting_profiles.version, pages)
+    preview = preview_cache.get(cache_key)
+    if preview is not None:
+        preview_cache.move_to_end(cache_key)
+        preview_stats["hits"] += 1
+        cache_status = "hit"
+    else:
+        preview_stats["misses"] += 1
+        cache_status = "miss"
+        
+        try:
+            preview = await preview_renderer.render(content, file_extension, book_size, font, genre, template, pages)
+        except ValueError as ve:
+            raise HTTPException(status_code=400, detail=str(ve))
+        except JobResourceLimitExceeded as le:
+            logger.error(f"Preview stopped: {str(le)}")
+            raise HTTPException(status_code=422, detail=str(le))
+        preview_cache[cache_key] = preview
+        while len(preview_cache) > PREVIEW_CACHE_SIZE:
+            preview_cache.popitem(last=False)
+    
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if elapsed_ms > PREVIEW_LATENCY_BUDGET_MS:
+        preview_stats["over_budget"] += 1
+        logger.warning(f"Preview took {elapsed_ms:.0f}ms, over the {PREVIEW_LATENCY_BUDGET_MS:.0f}ms budget")
+    
+    return Response(
+        content=preview,
+        media_type="application/pdf",
+        headers={"X-Preview-Cache": cache_status, "X-Render-Time-Ms": f"{elapsed_ms:.0f}"}
+    )
+
+# Page-count estimation without rendering
+def metrics_font_name(font):
+    return font_registry.resolve(font)[0]
+
+@functools.lru_cache(maxsize=200000)
+def word_width(font_name, word):
+    """Width of `word` at 1pt - scale by the font size"""
+    return pdfmetrics.stringWidth(word, font_name, 1)
+
+def estimate_page_counts(paragraphs, font, template="standard"):
+    """Estimate page counts for every BOOK_SIZES trim x GENRE_OPTIONS genre at once"""
+    font_name = metrics_font_name(font)
+    vocabulary = {}
+    word_ids = []
+    paragraph_starts = []
+    chapter_starts = []
+    for paragraph in paragraphs:
+        words = paragraph_text(paragraph).split()
+        if not words:
+            continue
+        if is_chapter_start(paragraph) or not chapter_starts:
+            chapter_starts.append(len(paragraph_starts))
+        paragraph_starts.append(len(word_ids))
+        word_ids.extend(vocabulary.setdefault(word, len(vocabulary)) for word in words)
+    
+    sizes = list(BOOK_SIZES)
+    genres = list(GENRE_OPTIONS)
+    if not word_ids:
+        return {size: {genre: 0 for genre in genres} for size in sizes}
+    
+    # Per-paragraph natural width at 1pt, measuring each distinct word once
+    unique_widths = np.array([word_width(font_name, word) for word in vocabulary])
+    widths = unique_widths[np.array(word_ids)]
+    starts = np.array(paragraph_starts)
+    word_counts = np.diff(np.append(starts, len(word_ids)))
+    space = word_width(font_name, " ")
+    paragraph_widths = np.add.reduceat(widths, starts) + space * (word_counts - 1)
+    average_word = (paragraph_widths / word_counts)[None, :]
+    
+    # One row per (trim, genre) combination, laid out with the same profile the renderers use
+    profiles = [formatting_profiles.get(genre, font, size, template) for size in sizes for genre in genres]
+    line_widths = np.array([
+        profile.page_size[0] - profile.pdf_margins["leftMargin"] - profile.pdf_margins["rightMargin"]
+        for profile in profiles
+    ])[:, None]
+    text_heights = np.array([
+        profile.page_size[1] - profile.pdf_margins["topMargin"] - profile.pdf_margins["bottomMargin"]
+        for profile in profiles
+    ])
+    size_pt = np.array([profile.font_size for profile in profiles], dtype=float)[:, None]
+    leading = np.array([profile.font_size * profile.line_spacing for profile in profiles])
+    first_line_indents = np.array([profile.first_line_indent for profile in profiles], dtype=float)[:, None]
+    
+    # Greedy filling leaves roughly one word's width unused at the end of each line
+    usable = np.maximum(line_widths - size_pt * (average_word + space), size_pt)
+    lines = np.ceil((paragraph_widths[None, :] * size_pt + first_line_indents) / usable)
+    lines_per_page = np.maximum(np.floor(text_heights / leading), 1)
+    
+    # Chapters start on a fresh page
+    chapter_lines = np.add.reduceat(lines, np.array(chapter_starts), axis=1)
+    pages = np.ceil(chapter_lines / lines_per_page[:, None]).sum(axis=1).astype(int)
+    
+    estimates = {}
+    for index, count in enumerate(pages.tolist()):
+        size, genre = sizes[index // len(genres)], genres[index % len(genres)]
+        estimates.setdefault(size, {})[genre] = count
+    return estimates
+
+@app.post("/api/estimate")
+async def estimate_pages(
+    file: Optional[UploadFile] = File(None),
+    file_id: Optional[str] = Form(None),
+    font: str = Form("Times New Roman"),
+    template: str = Form("standard"),
+    current_user: TokenData = Depends(get_current_active_claims)
+):
+    """
+    Estimate the page count of a manuscript in every trim size and genre without rendering it.
+    Accepts either a new file or the file_id of an earlier upload. Doesn't count against the monthly limit.
+    """
+    started = time.perf_counter()
+    if font not in FONT_OPTIONS:
+        raise HTTPException(status_code=400, detail=f"Invalid font. Choose from: {', '.join(FONT_OPTIONS)}")
+    formatting_profiles.reload_if_changed()
+    if template not in formatting_profiles.templates:
+        raise HTTPException(status_code=400, detail=f"Invalid template. Choose from: {', '.join(formatting_profiles.templates)}")
+    
+    source = content = None
+    if file_id:
+        source = await db.uploads.find_one({"file_id": file_id, "user_email": current_user.email})
+        if not source:
+            raise HTTPException(status_code=404, detail="File not found")
+    elif file:
+        file_extension = Path(file.filename).suffix.lower()
+        if file_extension not in [".docx", ".pdf"]:
+            raise HTTPException(status_code=400, detail="Unsupported file format. Please upload .docx or .pdf files only.")
+        max_size_mb = 10
+        max_size_bytes = max_size_mb * 1024 * 1024
+        content = await file.read(max_size_bytes + 1)
+        if len(content) > max_size_bytes:
+            raise HTTPException(status_code=400, detail=f"File too large. Maximum size is {max_size_mb}MB.")
+    else:
+        raise HTTPException(status_code=400, detail="Provide either a file or a file_id.")
+    
+    def estimate():
+        # Parsing, estimating and counting words all scale with the manuscript, so none of it runs on the event loop
+        if source is not None:
+            try:
+                paragraphs = load_manuscript(manuscript_cache_key(source), source.get("input_path", ""))["paragraphs"]
+            except ValueError as ve:
+                raise HTTPException(status_code=400, detail=str(ve))
+        else:
+            if file_extension == ".docx":
+                validate_docx_upload(io.BytesIO(content))
+            try:
+                paragraphs = list(iter_manuscript_paragraphs(io.BytesIO(content), file_extension, fast=True))
+            except Exception as e:
+                logger.error(f"Error reading manuscript for estimate: {str(e)}")
+                raise HTTPException(status_code=400, detail="The file could not be read. Please upload a valid .docx or .pdf file.")
+        words = sum(len(paragraph_text(paragraph).split()) for paragraph in paragraphs)
+        return estimate_page_counts(paragraphs, font, template), words
+    
+    estimates, words = await asyncio.to_thread(estimate)
+    return {
+        "font": font,
+        "template": template,
+        "words": words,
+        "estimates": estimates,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)
+    }
+
+@app.post("/api/reformat/{file_id}")
+async def reformat_file(
+    file_id: str,
+    book_size: str = Form(...),
+    font: str = Form(...),
+    genre: str = Form(...),
+    template: str = Form("standard"),
+    export_profile: str = Form("standard"),
+    output_format: str = Form("print"),
+    current_user: TokenData = Depends(get_current_active_claims)
+):
+    """
+    Re-render an earlier upload with new formatting parameters.
+    The cached parsed manuscript is reused, and no monthly quota is consumed
+    since the manuscript itself was already processed.
+    """
+    validate_format_options(book_size, font, genre, template, export_profile, output_format)
+    await check_genre_allowed(current_user, genre)
+    
+    source = await db.uploads.find_one({
+        "file_id": file_id,
+        "user_email": current_user.email  # Ensure the file belongs to the current user
+    })
+    if not source:
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    # Re-formats of a re-format all share the original upload's parsed manuscript
+    source_file_id = source.get("source_file_id", file_id)
+    cache_key = manuscript_cache_key(source)
+    content_hash = source.get("content_hash")
+    file_extension = Path(source["original_filename"]).suffix.lower()
+    input_path = Path(source.get("input_path") or TEMP_DIR / f"{source_file_id}_input{file_extension}")
+    
+    admission.check_rate_limit(current_user)
+    
+    with admission.reserve(current_user):
+        new_file_id = str(uuid.uuid4())
+        if content_hash:
+            await retain_input_blob(content_hash)
+        upload = {
+            "file_id": new_file_id,
+            "source_file_id": source_file_id,
+            "user_email": current_user.email,
+            "tier": current_user.tier,
+            "original_filename": source["original_filename"],
+            "title": source.get("title") or manuscript_title(source["original_filename"]),
+            "previous_file_id": file_id,
+            "book_size": book_size,
+            "font": font,
+            "genre": genre,
+            "template": template,
+            "export_profile": export_profile,
+            "output_format": output_format,
+            "content_hash": content_hash,
+            "input_path": str(input_path),
+            "input_bytes": source.get("input_bytes"),
+            "status": "processing",
+            "created_at": datetime.utcnow()
+        }
+        await db.uploads.insert_one(upload)
+        
+        async def render():
+            output_extension = ".epub" if output_format == "epub" else file_extension
+            output_path = TEMP_DIR / f"{new_file_id}_formatted{output_extension}"
+            return await run_isolated(
+                reformat_job, cache_key, input_path, output_path,
+                book_size, font, genre, template, export_profile,
+                Path(source["original_filename"]).stem, source.get("chunks", [])
+            )
+        
+        try:
+            with tracer.span("reformat", **{
+                "file_id": new_file_id,
+                "source_file_id": source_file_id,
+                "input.bytes": source.get("input_bytes"),
+                "book_size": book_size,
+                "font": font,
+                "genre": genre,
+                "template": template,
+                "export_profile": export_profile,
+                "output_format": output_format,
+            }):
+                output_path, export_stats, chunk_keys, incremental = await admission.run_job(current_user, render)
+            if incremental is not None:
+                incremental["previous_file_id"] = file_id
+            await finish_job(upload, "completed", {
+                "output_path": str(output_path),
+                "export": export_stats,
+                "chunks": chunk_keys,
+                "incremental": incremental
+            })
+            return {
+                "file_id": new_file_id,
+                "source_file_id": source_file_id,
+                "message": "File reformatted successfully",
+                "export": export_stats,
+                "incremental": incremental,
+                **signed_download_url({**upload, "output_path": str(output_path)})
+            }
+        
+        except JobResourceLimitExceeded as le:
+            logger.error(f"Job {new_file_id} stopped: {str(le)}")
+            await finish_job(upload, "failed", {"error": str(le)})
+            raise HTTPException(status_code=422, detail=str(le))
+        
+        except ValueError as ve:
+            logger.error(f"Validation error: {str(ve)}")
+            await finish_job(upload, "failed", {"error": str(ve)})
+            raise HTTPException(status_code=400, detail=str(ve))
+        
+        except Exception as e:
+            logger.error(f"Error reformatting file: {str(e)}")
+            await finish_job(upload, "failed", {"error": str(e)})
+            raise HTTPException(status_code=500, detail=f"Error reformatting file: {str(e)}")
+
+# Signed download URLs
+def download_user_tag(email):
+    """Opaque tag binding a download URL to its owner without putting their email in it"""
+    return hmac.new(DOWNLOAD_URL_SECRET, email.lower().encode(), hashlib.sha256).hexdigest()[:16]
+
+def download_signature(file_id, file, name, user, expires):
+    message = "\n".join([file_id, file, name, user, str(expires)]).encode()
+    digest = hmac.new(DOWNLOAD_URL_SECRET, message, hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+def signed_download_url(file_info, ttl_seconds=DOWNLOAD_URL_TTL_SECONDS):
+    """A download URL for a completed upload, valid for `ttl_seconds` without any other credentials"""
+    output_path = Path(file_info["output_path"])
+    params = {
+        "file": output_path.name,
+        "name": f"formatted_{Path(file_info['original_filename']).stem}{output_path.suffix}",
+        "user": download_user_tag(file_info["user_email"]),
+        "expires": int(time.time()) + ttl_seconds,
+    }
+    params["sig"] = download_signature(file_info["file_id"], **params)
+    return {
+        "download_url": f"{DOWNLOAD_BASE_URL}/api/download/{file_info['file_id']}?{urlencode(params)}",
+        "download_expires_at": datetime.utcfromtimestamp(params["expires"]).isoformat()
+    }
+
+@app.get("/api/download/{file_id}")
+async def download_file(file_id: str, file: str, name: str, user: str, expires: int, sig: str):
+    """
+    Serve an output from a signed URL issued by /api/status or a finished job. The
+    signature covers the file, its owner and the expiry, so nothing is looked up.
+    """
+    if not hmac.compare_digest(sig, download_signature(file_id, file, name, user, expires)):
+        raise HTTPException(status_code=403, detail="Invalid download link")
+    if expires < time.time():
+        raise HTTPException(status_code=403, detail="Download link has expired. Please request a new one.")
+    
+    output_path = TEMP_DIR / Path(file).name
+    try:
+        stat_result = os.stat(output_path)
+    except OSError:
+        raise HTTPException(status_code=404, detail="Output file not found")
+    
+    return FileResponse(
+        path=output_path,
+        filename=name,
+        media_type="application/octet-stream",
+        stat_result=stat_result
+    )
+
+@app.get("/api/status/{file_id}")
+async def get_status(file_id: str, current_user: TokenData = Depends(get_current_active_claims)):
+    file_info = await db.uploads.find_one({
+        "file_id": file_id,
+        "user_email": current_user.email  # Ensure the file belongs to the current user
+    })
+    
+    if not file_info:
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    status = {
+        "file_id": file_id,
+        "status": file_info.get("status"),
+        "error": file_info.get("error", None)
+    }
+    if file_info.get("status") == "completed" and file_info.get("output_path"):
+        status.update(signed_download_url(file_info))
+    return status
+
+@app.get("/api/history")
+async def get_file_history(current_user: TokenData = Depends(get_current_active_claims)):
+    # Get the user's file history
+    cursor = db.uploads.find({
+        "user_email": current_user.email
+    }).sort("created_at", -1)
+    
+    history = []
+    async for file in cursor:
+        history.append({
+            "file_id": file.get("file_id"),
+            "original_filename": file.get("original_filename"),
+            "book_size": file.get("book_size"),
+            "font": file.get("font"),
+            "genre": GENRE_OPTIONS[file.get("genre")]["name"],
+            "status": file.get("status"),
+            "created_at": file.get("created_at").isoformat() if file.get("created_at") else None
+        })
+    
+    return history
+
+@app.delete("/api/files/{file_id}")
+async def delete_file(file_id: str, current_user: TokenData = Depends(get_current_active_claims)):
+    """Delete an upload and its output; the stored manuscript goes once no upload refers to it"""
+    upload = await db.uploads.find_one_and_delete({
+        "file_id": file_id,
+        "user_email": current_user.email  # Ensure the file belongs to the current user
+    })
+    if not upload:
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    if upload.get("output_path"):
+        Path(upload["output_path"]).unlink(missing_ok=True)
+    if upload.get("content_hash"):
+        await release_input_blob(upload["content_hash"])
+    elif upload.get("input_path") and not await db.uploads.find_one({"input_path": upload["input_path"]}, {"_id": 1}):
+        # Uploads from before content-hash storage have their own input file, shared only with their re-formats
+        Path(upload["input_path"]).unlink(missing_ok=True)
+    
+    return {"file_id": file_id, "message": "File deleted"}
+
+@app.get("/api/admin/analytics")
+async def get_usage_analytics(
+    months: int = 12,
+    current_user: TokenData = Depends(get_current_admin_claims)
+):
+    """Jobs, failure rate and average sizes per month and tier, read from the usage rollups"""
+    now = datetime.utcnow()
+    # The current month plus the `months - 1` before it, counted in calendar months
+    year, month = divmod(now.year * 12 + now.month - 1 - (max(months, 1) - 1), 12)
+    since = f"{year:04d}-{month + 1:02d}"
+    analytics = {}
+    async for rollup in db.usage_rollups.find({"month": {"$gte": since}}):
+        tier = analytics.setdefault(rollup["month"], {}).setdefault(rollup["tier"], {
+            "jobs": 0, "completed": 0, "failed": 0, "reformats": 0,
+            "input_bytes": 0, "output_bytes": 0, "processing_seconds": 0.0, "genres": {}
+        })
+        tier["jobs"] += rollup["jobs"]
+        tier[rollup["status"]] = tier.get(rollup["status"], 0) + rollup["jobs"]
+        for field in ("reformats", "input_bytes", "output_bytes", "processing_seconds"):
+            tier[field] += rollup.get(field, 0)
+        tier["genres"][rollup["genre"]] = tier["genres"].get(rollup["genre"], 0) + rollup["jobs"]
+    
+    for tiers in analytics.values():
+        for tier in tiers.values():
+            jobs = tier["jobs"]
+            tier["failure_rate"] = round(tier["failed"] / jobs, 4)
+            tier["avg_input_bytes"] = round(tier.pop("input_bytes") / jobs)
+            tier["avg_output_bytes"] = round(tier.pop("output_bytes") / tier["completed"]) if tier["completed"] else None
+            tier["avg_processing_seconds"] = round(tier.pop("processing_seconds") / jobs, 2)
+    
+    return {"months": dict(sorted(analytics.items(), reverse=True))}
+
+async def backfill_usage_rollups():
+    """
+    Rebuild usage_rollups from the uploads collection. Uploads from before rollups
+    existed don't record the tier they ran under, so the user's current tier is used.
+    Each rollup is replaced in place and rollups no longer produced are removed
+    afterwards, so readers never see the collection empty or half written.
+    """
+    pipeline = [
+        {"$match": {"status": {"$in": ["completed", "failed"]}}},
+        {"$lookup": {"from": "users", "localField": "user_email", "foreignField": "email", "as": "user"}},
+        {"$lookup": {"from": "blobs", "localField": "content_hash", "foreignField": "_id", "as": "blob"}},
+        {"$project": {
+            "month": {"$dateToString": {"format": "%Y-%m", "date": "$created_at"}},
+            "tier": {"$ifNull": ["$tier", {"$ifNull": [{"$arrayElemAt": ["$user.tier", 0]}, "free"]}]},
+            "genre": 1,
+            "status": 1,
+            "reformat": {"$cond": [{"$ifNull": ["$source_file_id", False]}, 1, 0]},
+            "input_bytes": {"$ifNull": ["$input_bytes", {"$ifNull": [{"$arrayElemAt": ["$blob.size", 0]}, 0]}]},
+            "output_bytes": {"$ifNull": ["$export.bytes_after", 0]},
+            "processing_seconds": {"$cond": [
+                {"$and": [{"$ifNull": ["$completed_at", False]}, {"$ifNull": ["$created_at", False]}]},
+                {"$divide": [{"$subtract": ["$completed_at", "$created_at"]}, 1000]},
+                0
+            ]}
+        }},
+        {"$group": {
+            "_id": {"month": "$month", "tier": "$tier", "genre": "$genre", "status": "$status"},
+            "jobs": {"$sum": 1},
+            "reformats": {"$sum": "$reformat"},
+            "input_bytes": {"$sum": "$input_bytes"},
+            "output_bytes": {"$sum": "$output_bytes"},
+            "processing_seconds": {"$sum": "$processing_seconds"}
+        }}
+    ]
+    rollup_ids, replacements = [], []
+    async for group in db.uploads.aggregate(pipeline):
+        key = group.pop("_id")
+        rollup_ids.append(f"{key['month']}|{key['tier']}|{key['genre']}|{key['status']}")
+        replacements.append(ReplaceOne({"_id": rollup_ids[-1]}, {**key, **group}, upsert=True))
+    
+    if replacements:
+        await db.usage_rollups.bulk_write(replacements, ordered=False)
+    await db.usage_rollups.delete_many({"_id": {"$nin": rollup_ids}})
+    return len(rollup_ids)
+
+# Event-loop blocking watchdog
+class LoopWatchdog:
+    """
+    Pings the event loop from a background thread and records how long each ping
+    waits. When a ping goes unanswered past the threshold, something is blocking
+    the loop: the loop thread's stack is captured, and once the loop recovers the
+    block is logged with its route and counted against the call site in our code.
+    """
+
+    def __init__(self, threshold_ms, interval_seconds):
+        self.threshold_ms = threshold_ms
+        self.interval_seconds = interval_seconds
+        self.blocks = 0
+        self.call_sites = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pending = None  # perf_counter() when the unanswered ping was sent
+        self._blocked = None  # Stack, call site and route captured for the current block
+        self._endpoint_routes = None
+
+    def start(self, loop):
+        self.loop = loop
+        self.loop_thread_id = threading.get_ident()
+        self._stop.clear()
+        self._pending = None
+        self._thread = threading.Thread(target=self._run, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _ack(self, sent):
+        global event_loop_lag_ms
+        event_loop_lag_ms = (time.perf_counter() - sent) * 1000
+        self._pending = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval_seconds):
+            sent = self._pending
+            if sent is None:
+                if self._blocked is not None:
+                    self._record_block(event_loop_lag_ms)
+                self._pending = sent = time.perf_counter()
+                try:
+                    self.loop.call_soon_threadsafe(self._ack, sent)
+                except RuntimeError:
+                    return  # Loop closed
+            elif self._blocked is None and (time.perf_counter() - sent) * 1000 > self.threshold_ms:
+                self._blocked = self._capture()
+
+    def _capture(self):
+        frame = sys._current_frames().get(self.loop_thread_id)
+        if frame is None:
+            return None
+        stack = traceback.extract_stack(frame)
+        # Attribute the block to the innermost line of our own code - the call that blocked
+        site = next((entry for entry in reversed(stack) if entry.filename == __file__), stack[-1])
+        return {
+            "call_site": f"{Path(site.filename).name}:{site.lineno} in {site.name}",
+            "route": self._route(frame),
+            "stack": "".join(traceback.format_list(stack[-LOOP_BLOCK_STACK_DEPTH:])),
+        }
+
+    def _route(self, frame):
+        if self._endpoint_routes is None:
+            self._endpoint_routes = {
+                route.endpoint.__code__: f"{','.join(sorted(route.methods))} {route.path}"
+                for route in app.routes if getattr(route, "methods", None)
+            }
+        while frame is not None:
+            route = self._endpoint_routes.get(frame.f_code)
+            if route is not None:
+                return route
+            if frame.f_code.co_name == "solve_dependencies":
+                # Blocked in a dependency, before the endpoint was called
+                request = frame.f_locals.get("request")
+                scope_route = request.scope.get("route") if request is not None else None
+                if scope_route is not None:
+                    return f"{request.method} {scope_route.path}"
+            frame = frame.f_back
+        return "background"
+
+    def _record_block(self, blocked_ms):
+        blocked, self._blocked = self._blocked, None
+        if blocked is None:
+            return
+        with self._lock:
+            self.blocks += 1
+            site = self.call_sites.setdefault(
+                blocked["call_site"], {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "routes": {}}
+            )
+            site["count"] += 1
+            site["total_ms"] += blocked_ms
+            site["max_ms"] = max(site["max_ms"], blocked_ms)
+            site["routes"][blocked["route"]] = site["routes"].get(blocked["route"], 0) + 1
+        logger.warning(
+            f"Event loop blocked for {blocked_ms:.0f}ms at {blocked['call_site']} "
+            f"({blocked['route']}):\n{blocked['stack']}"
+        )
+
+    def stats(self):
+        with self._lock:
+            call_sites = {
+                call_site: {**site, "total_ms": round(site["total_ms"], 1), "max_ms": round(site["max_ms"], 1), "routes": dict(site["routes"])}
+                for call_site, site in sorted(self.call_sites.items(), key=lambda item: -item[1]["total_ms"])
+            }
+        return {
+            "lag_ms": round(event_loop_lag_ms, 2),
+            "threshold_ms": self.threshold_ms,
+            "blocks": self.blocks,
+            "call_sites": call_sites,
+        }
+
+loop_watchdog = LoopWatchdog(LOOP_BLOCK_THRESHOLD_MS, LOOP_WATCHDOG_INTERVAL_SECONDS)
+
+@app.on_event("startup")
+async def load_fonts():
+    font_registry.load()
+
+@app.on_event("startup")
+async def load_formatting_templates():
+    formatting_profiles.reload_if_changed()
+
+@app.on_event("startup")
+async def start_event_loop_monitor():
+    loop_watchdog.start(asyncio.get_running_loop())
+
+@app.on_event("startup")
+async def create_refresh_token_indexes():
+    # Mongo's TTL monitor deletes refresh tokens once they expire; rotation and resets look them up by jti and email
+    await db.refresh_tokens.create_index("expires_at", expireAfterSeconds=0)
+    await db.refresh_tokens.create_index("jti", unique=True)
+    await db.refresh_tokens.create_index("email")
+
+@app.on_event("startup")
+async def start_blob_compressor():
+    app.state.blob_compressor_task = asyncio.create_task(compress_cold_blobs_periodically())
+
+@app.on_event("startup")
+async def start_upload_session_purger():
+    app.state.upload_session_purger_task = asyncio.create_task(purge_expired_upload_sessions_periodically())
+
+@app.on_event("shutdown")
+async def stop_event_loop_monitor():
+    loop_watchdog.stop()
+
+@app.on_event("shutdown")
+async def shutdown_db_client():
+    client.close()
+
+@app.on_event("shutdown")
+async def shutdown_render_pool():
+    if _render_pool is not None:
+        _render_pool.shutdown(cancel_futures=True)
+    preview_renderer.shutdown()
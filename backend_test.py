@@ -1,12 +1,28 @@
 import requests
+import docx
+import io
+import time
+import hmac
+import hashlib
+import json
+import base64
+import zipfile
+import zlib
 import pytest
 import os
-from datetime import datetime
+import sys
+import asyncio
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from urllib.parse import urlsplit, parse_qsl
+from pymongo import MongoClient
 
 class BookFormatAITester:
     def __init__(self, base_url):
         self.base_url = base_url
         self.token = None
+        self.refresh_token = None
         self.tests_run = 0
         self.tests_passed = 0
         self.test_user_email = f"test_user_{datetime.now().strftime('%H%M%S')}@test.com"
@@ -82,6 +98,7 @@ class BookFormatAITester:
                 print(f"Response: {response_data}")
                 if 'access_token' in response_data:
                     self.token = response_data['access_token']
+                    self.refresh_token = response_data.get('refresh_token')
                     return True
             else:
                 print(f"❌ Failed - Expected 200, got {response.status_code}")
@@ -92,6 +109,20 @@ class BookFormatAITester:
             print(f"❌ Failed - Error: {str(e)}")
             return False
 
+    def test_refresh_token(self):
+        """Test rotating the refresh token for a new access token"""
+        success, response = self.run_test(
+            "Refresh Token",
+            "POST",
+            "token/refresh",
+            200,
+            data={"refresh_token": self.refresh_token}
+        )
+        if success:
+            self.token = response['access_token']
+            self.refresh_token = response['refresh_token']
+        return success
+
     def test_google_auth(self):
         """Test Google OAuth login"""
         success, response = self.run_test(
@@ -103,6 +134,12 @@ class BookFormatAITester:
         )
         return success
 
+    def test_health(self):
+        """Test liveness and readiness probes"""
+        live, _ = self.run_test("Liveness Probe", "GET", "health/live", 200)
+        ready, _ = self.run_test("Readiness Probe", "GET", "health/ready", 200)
+        return live and ready
+
     def test_get_subscription_tiers(self):
         """Test getting subscription tiers"""
         return self.run_test(
@@ -150,10 +187,11 @@ class BookFormatAITester:
 
     def test_upload_file(self):
         """Test file upload"""
-        # Create a small test DOCX file
+        # Create a small, valid test DOCX file
         test_file_path = "test.docx"
-        with open(test_file_path, "w") as f:
-            f.write("Test content")
+        document = docx.Document()
+        document.add_paragraph("Test content")
+        document.save(test_file_path)
 
         files = {
             'file': ('test.docx', open(test_file_path, 'rb'), 'application/vnd.openxmlformats-officedocument.wordprocessingml.document')
@@ -177,6 +215,623 @@ class BookFormatAITester:
         os.remove(test_file_path)
         return success
 
+    def check(self, name, passed, detail=""):
+        """Record the outcome of a check that needs more than one request"""
+        self.tests_run += 1
+        print(f"\n🔍 Testing {name}...")
+        if passed:
+            self.tests_passed += 1
+            print(f"✅ Passed {detail}")
+        else:
+            print(f"❌ Failed {detail}")
+        return passed
+
+    def session_headers(self, tier="business"):
+        """Register a separate user on `tier` so multi-upload tests don't use up the main user's quota"""
+        email = f"test_{tier}_{datetime.now().strftime('%H%M%S%f')}@test.com"
+        requests.post(f"{self.base_url}/api/register", json={"email": email, "password": self.test_password})
+        tokens = requests.post(f"{self.base_url}/api/token", data={"username": email, "password": self.test_password}).json()
+        headers = {'Authorization': f"Bearer {tokens['access_token']}"}
+        if tier != "free":
+            tokens = requests.put(f"{self.base_url}/api/subscription/upgrade", params={"tier": tier}, headers=headers).json()
+            headers = {'Authorization': f"Bearer {tokens['access_token']}"}
+        return headers
+
+    def database(self):
+        """Direct database access for checks the API doesn't expose; needs MONGO_URL and DB_NAME"""
+        if not (os.environ.get("MONGO_URL") and os.environ.get("DB_NAME")):
+            print("\n⏭️  Skipping - set MONGO_URL and DB_NAME to run database checks")
+            return None
+        return MongoClient(os.environ["MONGO_URL"])[os.environ["DB_NAME"]]
+
+    def manuscript(self, paragraphs=200, revised=False):
+        """A DOCX manuscript with chapters; `revised` edits one paragraph in the middle"""
+        document = docx.Document()
+        for i in range(paragraphs):
+            if i % 40 == 0:
+                document.add_heading(f"Chapter {i // 40 + 1}", level=1)
+            text = f"Paragraph {i} of the test manuscript, long enough to wrap across a line or two of the page."
+            if revised and i == paragraphs // 2:
+                text = "REVISED " + text
+            document.add_paragraph(text)
+        content = io.BytesIO()
+        document.save(content)
+        return content.getvalue()
+
+    def upload(self, headers, content, filename="book.docx", **options):
+        data = {'book_size': '6x9', 'font': 'Times New Roman', 'genre': 'non_fiction', **options}
+        files = {'file': (filename, content, 'application/vnd.openxmlformats-officedocument.wordprocessingml.document')}
+        return requests.post(f"{self.base_url}/api/upload", headers=headers, data=data, files=files)
+
+    def test_revision_reuses_chunks(self):
+        """Test that a revision reuses the last draft upload's chunks even after a reformat and an EPUB export"""
+        headers = self.session_headers()
+        first = self.upload(headers, self.manuscript(), filename="book draft.docx").json()
+        requests.post(
+            f"{self.base_url}/api/reformat/{first['file_id']}", headers=headers,
+            data={'book_size': '5x8', 'font': 'Georgia', 'genre': 'non_fiction'}
+        )
+        self.upload(headers, self.manuscript(), output_format='epub')
+        response = self.upload(headers, self.manuscript(revised=True), filename="book v2.docx")
+        incremental = response.json().get("incremental") if response.status_code == 200 else None
+        return self.check(
+            "Revision Reuses Chunks",
+            bool(incremental) and incremental["previous_file_id"] == first["file_id"] and incremental["chunks_reused"] > 0,
+            f"- {incremental}"
+        )
+
+    def test_refresh_token_indexes(self):
+        """Test that expired refresh tokens are cleaned up by a TTL index and jti is unique"""
+        db = self.database()
+        if db is None:
+            return True
+        indexes = db.refresh_tokens.index_information().values()
+        ttl = any(index["key"] == [("expires_at", 1)] and index.get("expireAfterSeconds") == 0 for index in indexes)
+        unique_jti = any(index["key"] == [("jti", 1)] and index.get("unique") for index in indexes)
+        return self.check("Refresh Token Indexes", ttl and unique_jti, f"- ttl={ttl} unique_jti={unique_jti}")
+
+    def test_reset_password_revokes_refresh_tokens(self):
+        """Test that resetting the password signs out sessions opened with the old one"""
+        db = self.database()
+        if db is None:
+            return True
+        email = f"test_reset_{datetime.now().strftime('%H%M%S%f')}@test.com"
+        requests.post(f"{self.base_url}/api/register", json={"email": email, "password": self.test_password})
+        tokens = requests.post(f"{self.base_url}/api/token", data={"username": email, "password": self.test_password}).json()
+        requests.post(f"{self.base_url}/api/forgot-password", json={"email": email})
+        reset_token = db.users.find_one({"email": email})["reset_token"]
+        reset = requests.post(
+            f"{self.base_url}/api/reset-password", json={"token": reset_token, "new_password": "NewPass456!"}
+        )
+        refresh = requests.post(f"{self.base_url}/api/token/refresh", json={"refresh_token": tokens["refresh_token"]})
+        return self.check(
+            "Reset Password Revokes Refresh Tokens",
+            reset.status_code == 200 and refresh.status_code == 401 and not db.refresh_tokens.count_documents({"email": email}),
+            f"- reset {reset.status_code}, refresh with the old token {refresh.status_code}"
+        )
+
+    def signed_download(self, headers, file_id):
+        """The signed download URL /api/status hands out for a finished upload, split into path and query"""
+        status = requests.get(f"{self.base_url}/api/status/{file_id}", headers=headers).json()
+        url = urlsplit(status["download_url"])
+        return url.path, dict(parse_qsl(url.query))
+
+    def test_signed_download_rejects_tampering(self):
+        """Test that signed download URLs can't be altered, reused after expiry or pointed at other files"""
+        headers = self.session_headers()
+        other_headers = self.session_headers()
+        file_id = self.upload(headers, self.manuscript(paragraphs=20)).json()["file_id"]
+        second_file_id = self.upload(headers, self.manuscript(paragraphs=30)).json()["file_id"]
+        other_file_id = self.upload(other_headers, self.manuscript(paragraphs=20)).json()["file_id"]
+        path, params = self.signed_download(headers, file_id)
+        _, other_params = self.signed_download(other_headers, other_file_id)
+
+        # Sign an already-expired link the way the server does, with the same secret
+        secret = (
+            os.environ.get("DOWNLOAD_URL_SECRET")
+            or hmac.new(os.environ.get("SECRET_KEY", "your-secret-key-for-jwt").encode(), b"download-urls", hashlib.sha256).hexdigest()
+        ).encode()
+        expired = {**params, "expires": str(int(time.time()) - 60)}
+        message = "\n".join([file_id, expired["file"], expired["name"], expired["user"], expired["expires"]]).encode()
+        expired["sig"] = base64.urlsafe_b64encode(hmac.new(secret, message, hashlib.sha256).digest()).rstrip(b"=").decode()
+
+        cases = {
+            "valid link": (path, params, 200),
+            "tampered signature": (path, {**params, "sig": params["sig"][:-2] + ("AA" if params["sig"][-2:] != "AA" else "BB")}, 403),
+            "extended expiry": (path, {**params, "expires": str(int(params["expires"]) + 86400)}, 403),
+            "expired link": (path, expired, 403),
+            "another file_id": (f"/api/download/{second_file_id}", params, 403),
+            "another user's file": (path, {**params, "file": other_params["file"]}, 403),
+            "another user's tag": (path, {**params, "user": other_params["user"]}, 403),
+        }
+        failures = []
+        for case, (case_path, case_params, expected) in cases.items():
+            response = requests.get(f"{self.base_url}{case_path}", params=case_params)
+            if response.status_code != expected:
+                failures.append(f"{case}: expected {expected}, got {response.status_code}")
+            elif case == "expired link" and "expired" not in response.json()["detail"]:
+                failures.append(f"{case}: {response.json()['detail']}")
+        return self.check("Signed Download Rejects Tampering", not failures, f"- {failures or len(cases)}")
+
+    def start_upload_session(self, headers, content, filename="book.docx"):
+        data = {'filename': filename, 'size': len(content), 'book_size': '6x9', 'font': 'Times New Roman', 'genre': 'non_fiction'}
+        return requests.post(f"{self.base_url}/api/uploads", headers=headers, data=data).json()["session_id"]
+
+    def put_chunk(self, headers, session_id, offset, chunk, sha256=None):
+        chunk_headers = {**headers, 'X-Chunk-SHA256': sha256} if sha256 else headers
+        return requests.put(
+            f"{self.base_url}/api/uploads/{session_id}", params={"offset": offset}, headers=chunk_headers, data=chunk
+        )
+
+    def test_resumable_upload(self):
+        """Test out-of-order, duplicate and bad chunks, incomplete finalize and session expiry"""
+        headers = self.session_headers()
+        content = self.manuscript(paragraphs=100)
+        half = len(content) // 2
+        failures = []
+
+        def expect(case, response, status):
+            if response.status_code != status:
+                failures.append(f"{case}: expected {status}, got {response.status_code}")
+            return response.json() if response.status_code == status else {}
+
+        session_id = self.start_upload_session(headers, content)
+        # The second half first: nothing is contiguous from 0 yet
+        status = expect("out-of-order chunk", self.put_chunk(headers, session_id, half, content[half:]), 200)
+        if status and (status["offset"] != 0 or status["missing_ranges"] != [[0, half]]):
+            failures.append(f"out-of-order chunk: {status}")
+        expect("offset past the end", self.put_chunk(headers, session_id, len(content), b"x"), 400)
+        expect("chunk overrunning the end", self.put_chunk(headers, session_id, half, content[half:] + b"x"), 400)
+        expect(
+            "checksum mismatch",
+            self.put_chunk(headers, session_id, 0, content[:half], sha256=hashlib.sha256(b"other").hexdigest()),
+            400
+        )
+        status = expect(
+            "first chunk", self.put_chunk(headers, session_id, 0, content[:half], sha256=hashlib.sha256(content[:half]).hexdigest()), 200
+        )
+        if status and (status["offset"] != len(content) or status["missing_ranges"]):
+            failures.append(f"first chunk: {status}")
+        # A retried chunk is merged, not double counted
+        status = expect("duplicate chunk", self.put_chunk(headers, session_id, 0, content[:half]), 200)
+        if status and status["received_bytes"] != len(content):
+            failures.append(f"duplicate chunk: received {status['received_bytes']} of {len(content)} bytes")
+        expect(
+            "finalize",
+            requests.post(
+                f"{self.base_url}/api/uploads/{session_id}/finalize", headers=headers,
+                data={"sha256": hashlib.sha256(content).hexdigest()}
+            ),
+            200
+        )
+
+        incomplete_id = self.start_upload_session(headers, content)
+        self.put_chunk(headers, incomplete_id, 0, content[:half])
+        detail = expect(
+            "finalize with missing bytes",
+            requests.post(f"{self.base_url}/api/uploads/{incomplete_id}/finalize", headers=headers),
+            409
+        ).get("detail", {})
+        if detail and detail.get("missing_ranges") != [[half, len(content)]]:
+            failures.append(f"finalize with missing bytes: {detail}")
+
+        db = self.database()
+        if db is not None:
+            db.upload_sessions.update_one(
+                {"session_id": incomplete_id}, {"$set": {"expires_at": datetime.utcnow() - timedelta(minutes=1)}}
+            )
+            expect("chunk after expiry", self.put_chunk(headers, incomplete_id, half, content[half:]), 410)
+            expect("status after expiry", requests.get(f"{self.base_url}/api/uploads/{incomplete_id}", headers=headers), 410)
+            expect(
+                "finalize after expiry",
+                requests.post(f"{self.base_url}/api/uploads/{incomplete_id}/finalize", headers=headers),
+                410
+            )
+        return self.check("Resumable Upload", not failures, f"- {failures or 'all cases'}")
+
+    def docx_package(self, members):
+        """A zip holding the two parts every DOCX needs plus `members` (name -> bytes)"""
+        content = io.BytesIO()
+        with zipfile.ZipFile(content, "w", zipfile.ZIP_DEFLATED) as package:
+            package.writestr("[Content_Types].xml", "<Types/>")
+            package.writestr("word/document.xml", "<document/>")
+            for name, data in members.items():
+                package.writestr(name, data)
+        return content.getvalue()
+
+    def test_docx_package_limits(self):
+        """Test that malformed and zip-bomb DOCX packages are rejected with 400 before any processing"""
+        headers = self.session_headers()
+        # ~50:1 blocks stay under the ratio limit, so only the total size trips
+        block = os.urandom(20 * 1024) + bytes(1024 * 1024 - 20 * 1024)
+        cases = {
+            "too many entries": (self.docx_package({f"word/media/{i}.bin": b"" for i in range(5001)}), "too many parts"),
+            "oversized uncompressed total": (
+                self.docx_package({f"word/media/{i}.bin": block * 10 for i in range(26)}), "expands to more than"
+            ),
+            "excessive compression ratio": (
+                self.docx_package({"word/media/zeros.bin": bytes(8 * 1024 * 1024)}), "compressed suspiciously well"
+            ),
+            "non-zip payload": (os.urandom(4096), "not a valid .docx"),
+        }
+        failures = []
+        for case, (content, message) in cases.items():
+            response = self.upload(headers, content)
+            detail = response.json().get("detail", "") if response.status_code == 400 else ""
+            if message not in detail:
+                failures.append(f"{case}: {response.status_code} {detail}")
+        return self.check("DOCX Package Limits", not failures, f"- {failures or len(cases)}")
+
+    def test_metrics_requires_admin(self):
+        """Test that worker metrics aren't served without an admin token"""
+        anonymous = requests.get(f"{self.base_url}/api/metrics")
+        user = requests.get(f"{self.base_url}/api/metrics", headers=self.session_headers("free"))
+        return self.check(
+            "Metrics Requires Admin",
+            anonymous.status_code == 401 and user.status_code == 403,
+            f"- anonymous {anonymous.status_code}, non-admin {user.status_code}"
+        )
+
+def test_loop_watchdog_records_blocking_call_site():
+    """A deliberate blocking call on the event loop is detected and attributed to the line that made it"""
+    server = import_server()
+    watchdog = server.LoopWatchdog(threshold_ms=50, interval_seconds=0.01)
+
+    async def block_the_loop():
+        watchdog.start(asyncio.get_running_loop())
+        try:
+            await asyncio.sleep(0.1)
+            time.sleep(0.3)  # Blocks the loop
+            await asyncio.sleep(0.1)  # Let the watchdog see it recover and record the block
+        finally:
+            watchdog.stop()
+
+    asyncio.run(block_the_loop())
+    stats = watchdog.stats()
+    assert stats["blocks"] == 1
+    [(call_site, site)] = stats["call_sites"].items()
+    assert call_site.startswith("backend_test.py:") and call_site.endswith("in block_the_loop")
+    assert site["max_ms"] >= 250
+    assert site["routes"] == {"background": 1}
+
+def import_server():
+    os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+    import server
+    return server
+
+def test_job_worker_cache_activity_reaches_parent(tmp_path):
+    """Cache hits made inside forked job workers are counted by the API process"""
+    server = import_server()
+    server.font_registry.load()
+    document = docx.Document()
+    for i in range(40):
+        document.add_paragraph(f"Paragraph {i} of a manuscript rendered twice by separate job workers.")
+    input_path = tmp_path / "book.docx"
+    document.save(input_path)
+    cache_key = hashlib.sha256(os.urandom(16)).hexdigest()
+    
+    def render(name):
+        return asyncio.run(server.run_isolated(
+            server.reformat_job, cache_key, input_path, tmp_path / name,
+            "6x9", "Times New Roman", "literary_fiction", "standard", "standard"
+        ))
+    
+    render("first.pdf")
+    parse_hits = server.parse_cache_stats["hits"]
+    profile_hits = server.formatting_profiles.hits
+    subset_hits = server.font_registry.subset_stats["hits"]
+    render("second.pdf")
+    assert server.parse_cache_stats["hits"] > parse_hits
+    assert server.formatting_profiles.hits > profile_hits
+    if server.font_registry.stats()["embedded"]:
+        assert server.font_registry.subset_stats["hits"] > subset_hits
+
+def test_scheduler_skips_cancelled_waiter():
+    """A job cancelled while queued doesn't take the next free slot"""
+    server = import_server()
+    scheduler = server.FairShareScheduler(slots=1, aging_seconds=60)
+    running, cancelled, next_in_line = (SimpleNamespace(email=f"{name}@example.com", tier="free") for name in ("a", "b", "c"))
+    
+    async def cancel_while_queued():
+        await scheduler.acquire(running)
+        waiter = asyncio.create_task(scheduler.acquire(cancelled))
+        queued = asyncio.create_task(scheduler.acquire(next_in_line))
+        await asyncio.sleep(0)  # Both are waiting for the one slot
+        assert len(scheduler.waiting) == 2
+        waiter.cancel()
+        scheduler.release()  # Before the cancelled task has had a chance to clean up
+        await asyncio.wait_for(queued, timeout=1)
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+    
+    asyncio.run(cancel_while_queued())
+    assert scheduler.busy == 1
+    assert scheduler.waiting == []
+
+def write_test_pdf(path, pages):
+    from reportlab.pdfgen import canvas
+    pdf = canvas.Canvas(str(path))
+    for number in range(pages):
+        pdf.drawString(72, 720, f"Page {number + 1}")
+        pdf.showPage()
+    pdf.save()
+    return path
+
+def pypdf2_page_count(path):
+    import PyPDF2
+    return len(PyPDF2.PdfReader(str(path)).pages)
+
+def test_inspect_pdf_xref_table(tmp_path):
+    """A classic cross-reference table is read without a full parse"""
+    server = import_server()
+    path = write_test_pdf(tmp_path / "table.pdf", 7)
+    inspection = server.inspect_pdf(path)
+    assert inspection["method"] == "xref"
+    assert inspection["page_count"] == pypdf2_page_count(path) == 7
+
+@pytest.mark.parametrize("linearize", [False, True])
+def test_inspect_pdf_xref_and_object_streams(tmp_path, linearize):
+    """Cross-reference streams, and a page tree stored inside an object stream, are followed"""
+    pikepdf = pytest.importorskip("pikepdf")
+    server = import_server()
+    path = tmp_path / "streams.pdf"
+    with pikepdf.open(write_test_pdf(tmp_path / "source.pdf", 12)) as pdf:
+        pdf.save(path, linearize=linearize, object_stream_mode=pikepdf.ObjectStreamMode.generate)
+    data = path.read_bytes()
+    assert b"/XRef" in data and b"/ObjStm" in data
+    with server.PdfInspector(path) as inspector:
+        pages = inspector._ref(inspector.object(*inspector._ref(inspector.trailer(), b"Root")), b"Pages")
+        assert inspector._entry(pages[0])[0] == 2  # Compressed into an object stream
+    inspection = server.inspect_pdf(path)
+    assert inspection["method"] == "xref"
+    assert inspection["page_count"] == pypdf2_page_count(path) == 12
+
+def test_inspect_pdf_malformed_falls_back(tmp_path):
+    """Broken cross-reference data falls back to PyPDF2, which recovers the page count"""
+    server = import_server()
+    path = write_test_pdf(tmp_path / "broken.pdf", 5)
+    data = path.read_bytes()
+    position = data.rindex(b"startxref")
+    path.write_bytes(data[:position] + b"startxref\n123\n%%EOF\n")
+    inspection = server.inspect_pdf(path)
+    assert inspection["method"] == "full"
+    assert inspection["page_count"] == pypdf2_page_count(path) == 5
+    
+    path.write_bytes(b"%PDF-1.4\nnot really a pdf")
+    assert server.inspect_pdf(path) == {"version": "1.4", "page_count": 1, "method": "full"}
+
+def test_pdf_inspector_limits_and_names(tmp_path):
+    """Stream decoding is bounded, and /Length doesn't match /Length1"""
+    server = import_server()
+    bomb = zlib.compress(bytes(server.PdfInspector.MAX_STREAM_BYTES + 1), 9)
+    path = tmp_path / "bomb.pdf"
+    path.write_bytes(
+        b"%PDF-1.5\n1 0 obj\n<< /Length1 3 /Length " + str(len(bomb)).encode()
+        + b" /Filter /FlateDecode >>\nstream\n" + bomb + b"\nendstream\nendobj\n"
+    )
+    with server.PdfInspector(path) as inspector:
+        assert inspector._value(b"<< /Length1 3 /Length 42 >>", b"Length") == 42
+        assert inspector._value(b"<< /Length1 3 >>", b"Length") is None
+        with pytest.raises(server.PdfStructureError):
+            inspector._stream(len(b"%PDF-1.5\n"))
+
+@pytest.mark.parametrize("filename, title", [
+    ("My Novel.docx", "my novel"),
+    ("My Novel v3 (2).docx", "my novel"),
+    ("my_novel_draft_2.docx", "my_novel"),
+    ("My Novel - FINAL edited.pdf", "my novel"),
+    ("Version 2.docx", "version 2"),
+    ("Draft.docx", "draft"),
+])
+def test_manuscript_title(filename, title):
+    """Revision suffixes are stripped, repeatedly, but never down to nothing"""
+    server = import_server()
+    assert server.manuscript_title(filename) == title
+    assert server.is_revision_name(filename) == (title != filename.rsplit(".", 1)[0].lower())
+
+def test_content_defined_blocks_stable_after_insert():
+    """Inserting a paragraph early only changes the block it lands in"""
+    server = import_server()
+    texts = [f"Paragraph {i} of a manuscript split into content-defined blocks." for i in range(400)]
+    
+    def blocks(items):
+        return [tuple(block) for block in server.content_defined_blocks(items, lambda text: text)]
+    
+    before = blocks(texts)
+    after = blocks(texts[:5] + ["An inserted paragraph."] + texts[5:])
+    assert sum(map(len, before)) == 400 and len(before) > 10
+    assert after[-(len(before) - 1):] == before[1:]
+
+@pytest.mark.parametrize("keep_chunks", [False, True])
+def test_format_upload_keeps_chunks_only_for_revisions(tmp_path, keep_chunks):
+    """A one-off upload renders without storing chunks; one in a revision chain keeps them"""
+    server = import_server()
+    server.font_registry.load()
+    server.formatting_profiles.reload_if_changed()
+    document = docx.Document()
+    for i in range(40):
+        document.add_paragraph(f"Paragraph {i} of manuscript {os.urandom(8).hex()}.")
+    input_path = tmp_path / "book.docx"
+    document.save(input_path)
+    stored = set(server.CHUNKS_DIR.iterdir())
+    output_path, _, chunk_keys, incremental = server.format_upload_job(
+        input_path, "book", ".docx", "6x9", "Times New Roman", "literary_fiction", "standard", "standard",
+        hashlib.sha256(os.urandom(16)).hexdigest(), output_path=tmp_path / "formatted.docx", keep_chunks=keep_chunks
+    )
+    added = set(server.CHUNKS_DIR.iterdir()) - stored
+    assert output_path.exists()
+    assert bool(added) == bool(chunk_keys) == (incremental is not None) == keep_chunks
+
+def test_server_timing_reports_db_round_trips_and_budget_overruns():
+    """Each response carries a Server-Timing db entry, and routes over their round-trip budget are counted"""
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+    server = import_server()
+    app = FastAPI()
+    app.middleware("http")(server.instrument_db_commands)
+    
+    def issue(*commands):
+        for name in commands:
+            server.command_monitor.succeeded(SimpleNamespace(command_name=name, duration_micros=1500))
+    
+    @app.get("/api/download/{file_id}")  # Budget 0
+    async def over_budget(file_id: str):
+        issue("find", "update")
+        return {}
+    
+    @app.get("/api/within-budget")
+    async def within_budget():
+        issue("find")
+        return {}
+    
+    client = TestClient(app)
+    before = {path: dict(stats) for path, stats in server.db_route_stats.items()}
+    over = client.get("/api/download/abc")
+    within = client.get("/api/within-budget")
+    assert over.headers["Server-Timing"] == 'db;dur=3.00;desc="2 commands"'
+    assert within.headers["Server-Timing"] == 'db;dur=1.50;desc="1 commands"'
+    
+    def added(path, field):
+        return server.db_route_stats[path][field] - before.get(path, {}).get(field, 0)
+    
+    assert added("/api/download/{file_id}", "requests") == 1
+    assert added("/api/download/{file_id}", "over_budget") == 1
+    assert server.db_route_stats["/api/download/{file_id}"]["max_commands"] >= 2
+    assert added("/api/within-budget", "requests") == 1
+    assert added("/api/within-budget", "over_budget") == 0
+
+def test_epub_package_layout(tmp_path):
+    """The mimetype entry comes first, stored uncompressed, and the OPF spine lists the chapters in order"""
+    server = import_server()
+    server.formatting_profiles.reload_if_changed()
+    document = docx.Document()
+    document.add_paragraph("A foreword before the first chapter.")
+    for chapter in range(1, 4):
+        document.add_heading(f"Chapter {chapter}", level=1)
+        for i in range(3):
+            document.add_paragraph(f"Paragraph {i} of chapter {chapter}.")
+    input_path = tmp_path / "book.docx"
+    document.save(input_path)
+    output_path = server.process_epub(input_path, hashlib.sha256(os.urandom(16)).hexdigest(), "Georgia", "literary_fiction", title="Book")
+    try:
+        with zipfile.ZipFile(output_path) as epub:
+            first = epub.infolist()[0]
+            assert first.filename == "mimetype" and first.compress_type == zipfile.ZIP_STORED
+            assert epub.read("mimetype") == b"application/epub+zip"
+            # The fixed-offset magic readers check for without parsing the zip directory
+            assert output_path.read_bytes()[30:58] == b"mimetypeapplication/epub+zip"
+            opf = {"opf": "http://www.idpf.org/2007/opf"}
+            package = ET.fromstring(epub.read("OEBPS/content.opf"))
+            hrefs = {item.get("id"): item.get("href") for item in package.iterfind("opf:manifest/opf:item", opf)}
+            spine = [hrefs[itemref.get("idref")] for itemref in package.iterfind("opf:spine/opf:itemref", opf)]
+            chapters = sorted(
+                (name[len("OEBPS/"):] for name in epub.namelist() if name.startswith("OEBPS/chapter")),
+                key=lambda name: int(name[len("chapter"):-len(".xhtml")])
+            )
+            assert spine == chapters == [f"chapter{i}.xhtml" for i in range(1, 5)]
+            assert b"<h1>Chapter 2</h1>" in epub.read("OEBPS/chapter3.xhtml")
+    finally:
+        output_path.unlink(missing_ok=True)
+
+def file_tracer(server, monkeypatch, tmp_path):
+    """Install a tracer sampling every trace into a fresh trace file"""
+    tracer = server.Tracer({"file"}, tmp_path / "traces.jsonl", sample_rate=1.0)
+    monkeypatch.setattr(server, "tracer", tracer)
+    return tracer
+
+def read_spans(path, count, timeout=5):
+    """The spans written to a trace file by name, waiting for the background writer to flush `count` of them"""
+    deadline = time.monotonic() + timeout
+    while True:
+        lines = path.read_text().splitlines() if path.exists() else []
+        if len(lines) >= count or time.monotonic() > deadline:
+            return {span["name"]: span for span in map(json.loads, lines)}
+        time.sleep(0.05)
+
+def test_spans_nest_across_awaits_and_threads(tmp_path, monkeypatch):
+    """Spans opened inside another span, across an await or in a thread, are recorded as its children"""
+    server = import_server()
+    tracer = file_tracer(server, monkeypatch, tmp_path)
+    
+    def in_thread():
+        with tracer.span("thread_work"):
+            pass
+    
+    async def handle():
+        with tracer.span("request"):
+            with tracer.span("parse"):
+                await asyncio.sleep(0)
+            with tracer.span("render"):
+                await asyncio.to_thread(in_thread)
+        return server.current_span.get()
+    
+    assert asyncio.run(handle()) is None
+    spans = read_spans(tmp_path / "traces.jsonl", 4)
+    assert set(spans) == {"request", "parse", "render", "thread_work"}
+    assert spans["request"]["parent_id"] is None
+    assert spans["parse"]["parent_id"] == spans["render"]["parent_id"] == spans["request"]["span_id"]
+    assert spans["thread_work"]["parent_id"] == spans["render"]["span_id"]
+    assert len({span["trace_id"] for span in spans.values()}) == 1
+
+def test_trace_continues_in_job_worker(tmp_path, monkeypatch):
+    """Spans recorded in a forked job worker reach the trace file under the span that started the job"""
+    server = import_server()
+    tracer = file_tracer(server, monkeypatch, tmp_path)
+    
+    def traced_job():
+        with server.tracer.span("child_work"):
+            return os.getpid()
+    
+    async def handle():
+        with tracer.span("request"):
+            return await server.run_isolated(traced_job)
+    
+    worker_pid = asyncio.run(handle())
+    spans = read_spans(tmp_path / "traces.jsonl", 4)
+    assert set(spans) == {"request", "job_worker", "traced_job", "child_work"}
+    assert len({span["trace_id"] for span in spans.values()}) == 1
+    assert spans["job_worker"]["parent_id"] == spans["request"]["span_id"]
+    assert spans["traced_job"]["parent_id"] == spans["job_worker"]["span_id"]
+    assert spans["child_work"]["parent_id"] == spans["traced_job"]["span_id"]
+    assert spans["traced_job"]["pid"] == spans["child_work"]["pid"] == worker_pid != os.getpid()
+    assert spans["job_worker"]["attributes"]["worker.pid"] == worker_pid
+
+def test_concurrent_upload_cap():
+    """A burst of simultaneous jobs can't exceed the tier's concurrent-job cap, and finished jobs free their slots"""
+    server = import_server()
+    controller = server.AdmissionController(max_concurrent=8, max_queue_wait=60)
+    user = SimpleNamespace(email="burst@example.com", tier="business")
+    cap = server.SUBSCRIPTION_TIERS[user.tier]["max_concurrent_jobs"]
+    burst = cap * 2
+    
+    async def burst_of_jobs():
+        # Admitted jobs hold their slot until every request in the burst has been admitted or rejected
+        settled = asyncio.Event()
+        outcomes = []
+        
+        async def job():
+            try:
+                with controller.reserve(user):
+                    outcomes.append(200)
+                    if len(outcomes) == burst:
+                        settled.set()
+                    await settled.wait()
+            except server.HTTPException as e:
+                outcomes.append((e.status_code, e.detail))
+                if len(outcomes) == burst:
+                    settled.set()
+        
+        await asyncio.gather(*(job() for _ in range(burst)))
+        return outcomes
+    
+    outcomes = asyncio.run(burst_of_jobs())
+    assert outcomes.count(200) == cap
+    assert all(status == 429 and "being formatted" in detail for status, detail in outcomes[cap:])
+    assert user.email not in controller.user_jobs
+    with controller.reserve(user):
+        pass
+
 def main():
     # Get backend URL from environment
     backend_url = os.environ.get('REACT_APP_BACKEND_URL')
@@ -190,6 +845,9 @@ def main():
     # Run tests
     print("\n🚀 Starting API Tests...")
 
+    # Test health probes
+    tester.test_health()
+
     # Test registration and login flow
     if not tester.test_register():
         print("❌ Registration failed, stopping tests")
@@ -199,9 +857,19 @@ def main():
         print("❌ Login failed, stopping tests")
         return 1
 
+    # Test token refresh
+    tester.test_refresh_token()
+
+    # Test refresh token cleanup and revocation on password reset
+    tester.test_refresh_token_indexes()
+    tester.test_reset_password_revokes_refresh_tokens()
+
     # Test Google auth
     tester.test_google_auth()
 
+    # Test that worker metrics are admin-only
+    tester.test_metrics_requires_admin()
+
     # Test getting subscription tiers
     tester.test_get_subscription_tiers()
 
@@ -220,6 +888,18 @@ def main():
     # Test file upload (requires auth)
     tester.test_upload_file()
 
+    # Test that malformed DOCX packages are rejected
+    tester.test_docx_package_limits()
+
+    # Test resumable uploads
+    tester.test_resumable_upload()
+
+    # Test that revisions reuse unchanged rendered chunks
+    tester.test_revision_reuses_chunks()
+
+    # Test that signed download links can't be tampered with
+    tester.test_signed_download_rejects_tampering()
+
     # Print results
     print(f"\n📊 Tests Summary:")
     print(f"Total tests: {tester.tests_run}")
@@ -41,6 +41,7 @@ function App() {
   const [font, setFont] = useState('Times New Roman');
   const [genre, setGenre] = useState('non_fiction');
   const [template, setTemplate] = useState('standard');
+  const [outputFormat, setOutputFormat] = useState('print');
   const [loading, setLoading] = useState(false);
   const [error, setError] = useState(null);
   const [success, setSuccess] = useState(null);
@@ -71,6 +72,44 @@ function App() {
     }
   }, []);
   
+  // Store a freshly issued access/refresh token pair
+  const storeTokens = (data) => {
+    setToken(data.access_token);
+    localStorage.setItem('token', data.access_token);
+    if (data.refresh_token) {
+      localStorage.setItem('refreshToken', data.refresh_token);
+    }
+  };
+  
+  // Fetch with the bearer token, refreshing it once if it has expired
+  const authFetch = async (url, options = {}, userToken = token) => {
+    const withAuth = (accessToken) => ({
+      ...options,
+      headers: { ...(options.headers || {}), 'Authorization': `Bearer ${accessToken}` }
+    });
+    
+    const response = await fetch(url, withAuth(userToken));
+    const refreshToken = localStorage.getItem('refreshToken');
+    if (response.status !== 401 || !refreshToken) {
+      return response;
+    }
+    
+    const refreshResponse = await fetch(`${BACKEND_URL}/api/token/refresh`, {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json'
+      },
+      body: JSON.stringify({ refresh_token: refreshToken })
+    });
+    if (!refreshResponse.ok) {
+      return response;
+    }
+    
+    const data = await refreshResponse.json();
+    storeTokens(data);
+    return fetch(url, withAuth(data.access_token));
+  };
+  
   // Fetch user data when logged in
   const fetchUserData = async (userToken) => {
     try {
@@ -80,11 +119,7 @@ function App() {
       setSubscriptionTiers(tiersData);
       
       // Fetch available genres
-      const genresResponse = await fetch(`${BACKEND_URL}/api/genres`, {
-        headers: {
-          'Authorization': `Bearer ${userToken}`
-        }
-      });
+      const genresResponse = await authFetch(`${BACKEND_URL}/api/genres`, {}, userToken);
       const genresData = await genresResponse.json();
       setGenreOptions(genresData);
       
@@ -95,20 +130,12 @@ function App() {
       }
       
       // Fetch usage data
-      const usageResponse = await fetch(`${BACKEND_URL}/api/usage/current`, {
-        headers: {
-          'Authorization': `Bearer ${userToken}`
-        }
-      });
+      const usageResponse = await authFetch(`${BACKEND_URL}/api/usage/current`, {}, userToken);
       const usageData = await usageResponse.json();
       setUsageData(usageData);
       
       // Fetch file history
-      const historyResponse = await fetch(`${BACKEND_URL}/api/history`, {
-        headers: {
-          'Authorization': `Bearer ${userToken}`
-        }
-      });
+      const historyResponse = await authFetch(`${BACKEND_URL}/api/history`, {}, userToken);
       const historyData = await historyResponse.json();
       setFileHistory(historyData);
       
@@ -177,12 +204,11 @@ function App() {
       }
       
       const data = await response.json();
-      setToken(data.access_token);
       setUserTier(data.user_tier);
       setIsLoggedIn(true);
       
-      // Store token in localStorage
-      localStorage.setItem('token', data.access_token);
+      // Store tokens in localStorage
+      storeTokens(data);
       localStorage.setItem('userTier', data.user_tier);
       
       // Fetch user data
@@ -217,12 +243,11 @@ function App() {
       }
       
       const data = await response.json();
-      setToken(data.access_token);
       setUserTier(data.user_tier);
       setIsLoggedIn(true);
       
-      // Store token in localStorage
-      localStorage.setItem('token', data.access_token);
+      // Store tokens in localStorage
+      storeTokens(data);
       localStorage.setItem('userTier', data.user_tier);
       
       // Fetch user data
@@ -308,6 +333,7 @@ function App() {
     
     // Clear localStorage
     localStorage.removeItem('token');
+    localStorage.removeItem('refreshToken');
     localStorage.removeItem('userTier');
   };
   
@@ -317,24 +343,23 @@ function App() {
     setError(null);
     
     try {
-      const response = await fetch(`${BACKEND_URL}/api/subscription/upgrade?tier=${tierId}`, {
-        method: 'PUT',
-        headers: {
-          'Authorization': `Bearer ${token}`
-        }
+      const response = await authFetch(`${BACKEND_URL}/api/subscription/upgrade?tier=${tierId}`, {
+        method: 'PUT'
       });
       
+      const data = await response.json();
       if (!response.ok) {
-        const data = await response.json();
         throw new Error(data.detail || 'Upgrade failed');
       }
       
+      // The new tier is carried in the reissued access token
+      storeTokens(data);
       setUserTier(tierId);
       localStorage.setItem('userTier', tierId);
       setSuccess(`Subscription upgraded to ${tierId} successfully!`);
       
       // Refetch user data
-      fetchUserData(token);
+      fetchUserData(data.access_token);
     } catch (err) {
       setError(err.message || 'Upgrade failed');
     } finally {
@@ -379,13 +404,11 @@ function App() {
     formData.append('font', font);
     formData.append('genre', genre);
     formData.append('template', template);
+    formData.append('output_format', outputFormat);
     
     try {
-      const response = await fetch(`${BACKEND_URL}/api/upload`, {
+      const response = await authFetch(`${BACKEND_URL}/api/upload`, {
         method: 'POST',
-        headers: {
-          'Authorization': `Bearer ${token}`
-        },
         body: formData,
       });
       
@@ -413,25 +436,20 @@ function App() {
     if (!fileToDownload) return;
     
     try {
-      // Create a hidden form to post the authorization token to the download endpoint
-      const form = document.createElement('form');
-      form.method = 'POST';
-      form.action = `${BACKEND_URL}/api/download/${fileToDownload}`;
-      form.target = '_blank';
+      // Get a fresh signed link - it needs no auth header, so the browser can open it directly
+      const response = await authFetch(`${BACKEND_URL}/api/status/${fileToDownload}`);
+      const data = await response.json();
       
-      // Add token as hidden input
-      const tokenInput = document.createElement('input');
-      tokenInput.type = 'hidden';
-      tokenInput.name = 'token';
-      tokenInput.value = token;
-      form.appendChild(tokenInput);
+      if (!response.ok || !data.download_url) {
+        throw new Error(data.detail || data.error || 'File is not ready for download');
+      }
       
-      // Add form to document and submit
-      document.body.appendChild(form);
-      form.submit();
-      document.body.removeChild(form);
+      const downloadUrl = data.download_url.startsWith('http')
+        ? data.download_url
+        : `${BACKEND_URL}${data.download_url}`;
+      window.location.assign(downloadUrl);
     } catch (err) {
-      setError('Error downloading file');
+      setError(err.message || 'Error downloading file');
     }
   };
   
@@ -921,6 +939,19 @@ function App() {
                 Choose a pre-defined template to speed up your formatting process.
               </div>
             </div>
+            
+            <div className="form-group">
+              <label htmlFor="outputFormat">Output:</label>
+              <select 
+                id="outputFormat" 
+                value={outputFormat} 
+                onChange={(e) => setOutputFormat(e.target.value)}
+                className="form-select"
+              >
+                <option value="print">Print-ready (same format as upload)</option>
+                <option value="epub">EPUB ebook</option>
+              </select>
+            </div>
           </div>
           
           <button 